@@ -6,4 +6,12 @@ timeout = 120
 accesslog = "/var/log/gunicorn/imstransform_access.log"
 errorlog = "/var/log/gunicorn/imstransform_error.log"
 capture_output = True
-loglevel = "info" 
\ No newline at end of file
+loglevel = "info" 
+
+def post_worker_init(worker):
+    # Compile the PDF templates and load fonts before the first PDF request,
+    # unless PDFs are laid out by the pdf_render_server daemon
+    from django.conf import settings
+    from inventory.utils import warm_pdf_resources
+    if not settings.PDF_RENDER_SOCKET:
+        warm_pdf_resources()
@@ -1,5 +1,8 @@
+from datetime import timedelta
+
 from django.contrib import admin
-from .models import Category, Supplier, Client, Product, StockTransaction, Invoice, InvoiceItem
+from django.utils import timezone
+from .models import Category, Supplier, Client, Product, ProductStock, StockLot, CostLayer, StockTransaction, Invoice, InvoiceItem, InvoiceExportJob, InvoiceSequence, KpiCounter, StockAlertDigest, ProductPriceHistory, ReorderSuggestion, PdfRenderTiming
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
@@ -18,12 +21,53 @@ class ClientAdmin(admin.ModelAdmin):
     list_filter = ('country', 'city')
     search_fields = ('name', 'contact_person', 'email', 'phone')
 
+class ProductStockInline(admin.TabularInline):
+    """Read-only: stock levels change through stock transactions so totals and KPIs stay in sync"""
+    model = ProductStock
+    extra = 0
+    can_delete = False
+    readonly_fields = ('warehouse', 'quantity', 'updated_at')
+    
+    def has_add_permission(self, request, obj=None):
+        return False
+
+class StockLotInline(admin.TabularInline):
+    """Read-only: lots are opened and consumed by stock transactions"""
+    model = StockLot
+    extra = 0
+    can_delete = False
+    fields = ('warehouse', 'lot_number', 'expiry_date', 'quantity', 'received_quantity', 'received_at', 'stock_transaction')
+    readonly_fields = fields
+    ordering = ('warehouse', 'expiry_date')
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).filter(quantity__gt=0)
+    
+    def has_add_permission(self, request, obj=None):
+        return False
+
+class CostLayerInline(admin.TabularInline):
+    """Read-only: cost layers are opened and consumed by stock transactions"""
+    model = CostLayer
+    extra = 0
+    can_delete = False
+    fields = ('received_at', 'unit_cost', 'quantity', 'received_quantity', 'stock_transaction')
+    readonly_fields = fields
+    ordering = ('received_at', 'id')
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).filter(quantity__gt=0)
+    
+    def has_add_permission(self, request, obj=None):
+        return False
+
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
     list_display = ('name', 'sku', 'category', 'warehouse', 'quantity', 'unit_of_measure', 'buying_price', 'selling_price', 'profit_margin', 'is_low_stock')
     list_filter = ('category', 'supplier', 'warehouse')
     search_fields = ('name', 'sku', 'description')
     readonly_fields = ('profit_margin', 'is_low_stock')
+    inlines = [ProductStockInline, StockLotInline, CostLayerInline]
 
 class InvoiceItemInline(admin.TabularInline):
     model = InvoiceItem
@@ -36,9 +80,67 @@ class InvoiceAdmin(admin.ModelAdmin):
     search_fields = ('invoice_number', 'client__name')
     inlines = [InvoiceItemInline]
 
+@admin.register(InvoiceExportJob)
+class InvoiceExportJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'status', 'total_invoices', 'completed_invoices', 'failed_invoices', 'created_by', 'created_at', 'finished_at')
+    list_filter = ('status', 'created_at')
+    readonly_fields = ('status', 'filters', 'total_invoices', 'completed_invoices', 'failed_invoices', 'error', 'created_by', 'created_at', 'finished_at')
+
+@admin.register(InvoiceSequence)
+class InvoiceSequenceAdmin(admin.ModelAdmin):
+    list_display = ('series', 'year', 'last_number', 'updated_at')
+    list_filter = ('series', 'year')
+    readonly_fields = ('updated_at',)
+
 @admin.register(StockTransaction)
 class StockTransactionAdmin(admin.ModelAdmin):
     list_display = ('product', 'transaction_type', 'quantity', 'unit_price', 'total_price', 'transaction_date', 'created_by')
     list_filter = ('transaction_type', 'transaction_date', 'created_by')
     search_fields = ('product__name', 'reference_number', 'notes')
     date_hierarchy = 'transaction_date'
+
+@admin.register(KpiCounter)
+class KpiCounterAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'inventory_value', 'due_receivables', 'due_payables', 'updated_at')
+    readonly_fields = ('warehouse', 'inventory_value', 'due_receivables', 'due_payables', 'updated_at')
+
+@admin.register(StockAlertDigest)
+class StockAlertDigestAdmin(admin.ModelAdmin):
+    list_display = ('generated_on', 'warehouse', 'window_days', 'low_stock_count', 'expiring_soon_count', 'expired_count')
+    list_filter = ('generated_on', 'warehouse')
+    date_hierarchy = 'generated_on'
+
+@admin.register(ReorderSuggestion)
+class ReorderSuggestionAdmin(admin.ModelAdmin):
+    list_display = ('product', 'generated_on', 'smoothed_daily_demand', 'average_daily_demand', 'safety_stock', 'suggested_reorder_level')
+    search_fields = ('product__name', 'product__sku')
+    list_select_related = ('product',)
+
+@admin.register(ProductPriceHistory)
+class ProductPriceHistoryAdmin(admin.ModelAdmin):
+    list_display = ('product', 'previous_selling_price', 'selling_price', 'buying_price', 'source', 'changed_by', 'changed_at')
+    list_filter = ('source', 'changed_at')
+    search_fields = ('product__name', 'product__sku', 'note')
+    date_hierarchy = 'changed_at'
+    raw_id_fields = ('product',)
+
+@admin.register(PdfRenderTiming)
+class PdfRenderTimingAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'report_type', 'backend', 'total_ms', 'db_ms', 'template_ms', 'layout_ms', 'merge_ms', 'queries', 'size_bytes', 'pages', 'user')
+    list_filter = ('report_type', 'backend', 'created_at')
+    date_hierarchy = 'created_at'
+    change_list_template = 'admin/inventory/pdfrendertiming/change_list.html'
+    summary_days = 7
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        extra_context['summary_days'] = self.summary_days
+        extra_context['timing_summary'] = PdfRenderTiming.summary(
+            timezone.now() - timedelta(days=self.summary_days))
+        return super().changelist_view(request, extra_context=extra_context)
@@ -0,0 +1,192 @@
+"""
+Consolidated periodic invoicing.
+
+With INVOICE_BILLING_MODE = 'consolidated', sales are not invoiced one by
+one as they are saved. The build_invoices command instead bills each
+client's uninvoiced sales once per period (week or month) on a single
+multi-line invoice. Invoice numbers are reserved in bulk and the invoices
+and their items are written with bulk_create, a batch of clients at a time.
+"""
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from itertools import groupby
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Invoice, InvoiceItem, InvoiceSequence, StockTransaction
+
+BILLING_PERIODS = ('week', 'month')
+
+# Invoices written per database transaction
+BATCH_INVOICES = 200
+
+CENTS = Decimal('0.01')
+
+
+class BillingConflict(Exception):
+    pass
+
+
+def period_bounds(day, period):
+    """First and last day of the billing period that contains day"""
+    if period == 'week':
+        start = day - timedelta(days=day.weekday())
+        return start, start + timedelta(days=6)
+    if period == 'month':
+        start = day.replace(day=1)
+        next_month = (start + timedelta(days=32)).replace(day=1)
+        return start, next_month - timedelta(days=1)
+    raise ValueError(f'Unknown billing period "{period}"')
+
+
+def last_closed_day(period, until):
+    """Last day of the latest period that has ended by `until`"""
+    start, end = period_bounds(until, period)
+    return end if end <= until else start - timedelta(days=1)
+
+
+def uninvoiced_sales(cutoff):
+    """
+    Sales to clients up to and including the cutoff date that have never
+    been invoiced. A sale whose invoice was deleted keeps its invoiced_at
+    and is not billed again.
+    """
+    return StockTransaction.objects.filter(
+        transaction_type='out',
+        client__isnull=False,
+        invoice__isnull=True,
+        invoiced_at__isnull=True,
+        transaction_date__date__lte=cutoff,
+    )
+
+
+def build_consolidated_invoices(period='month', until=None, user=None, dry_run=False):
+    """
+    Invoice the uninvoiced sales of every period that has ended by `until`
+    (default yesterday), one invoice per client and period. Returns
+    (invoices, sales) counted; with dry_run nothing is written.
+    """
+    until = until or timezone.localdate() - timedelta(days=1)
+    sales = uninvoiced_sales(last_closed_day(period, until)).only(
+        'id', 'client_id', 'product_id', 'quantity', 'unit_price', 'total_price', 'apply_taxes',
+        'vat_rate', 'ait_rate', 'final_price', 'payment_status', 'transaction_date',
+    ).order_by('client_id', 'transaction_date', 'id')
+
+    def billing_key(sale):
+        return sale.client_id, period_bounds(timezone.localtime(sale.transaction_date).date(), period)
+
+    invoice_count = sale_count = 0
+    batch = []
+    for (client_id, (start, end)), lines in groupby(sales.iterator(chunk_size=2000), key=billing_key):
+        lines = list(lines)
+        batch.append((client_id, start, end, lines))
+        invoice_count += 1
+        sale_count += len(lines)
+        if len(batch) >= BATCH_INVOICES:
+            if not dry_run:
+                _write_invoices(batch, user)
+            batch = []
+    if batch and not dry_run:
+        _write_invoices(batch, user)
+    return invoice_count, sale_count
+
+
+def _write_invoices(batch, user):
+    invoiced_at = timezone.now()
+    with transaction.atomic():
+        # One reservation per year, for series that restart each year
+        numbers = {}
+        by_year = defaultdict(list)
+        for group in batch:
+            by_year[group[2].year].append(group)
+        for groups in by_year.values():
+            reserved = InvoiceSequence.reserve(len(groups), issue_date=groups[0][2])
+            numbers.update(zip((id(group) for group in groups), reserved))
+
+        invoices = Invoice.objects.bulk_create([
+            _consolidated_invoice(numbers[id(group)], *group, user=user) for group in batch
+        ])
+
+        items = []
+        for invoice, (_client_id, _start, _end, lines) in zip(invoices, batch):
+            items.extend(
+                InvoiceItem(
+                    invoice=invoice,
+                    product_id=sale.product_id,
+                    quantity=sale.quantity,
+                    unit_price=sale.unit_price,
+                    # As InvoiceItem.save() works it out
+                    total_price=(sale.quantity * sale.unit_price).quantize(CENTS, rounding=ROUND_HALF_UP),
+                )
+                for sale in lines
+            )
+            sale_ids = [sale.id for sale in lines]
+            linked = StockTransaction.objects.filter(id__in=sale_ids, invoice__isnull=True).update(
+                invoice=invoice, invoiced_at=invoiced_at,
+            )
+            if linked != len(sale_ids):
+                raise BillingConflict('Some sales were invoiced while the billing run was in progress. Run it again.')
+        InvoiceItem.objects.bulk_create(items, batch_size=1000)
+
+
+def remove_sale_from_invoice(sale):
+    """
+    Take a sale that is being deleted off its invoice. An invoice that bills
+    other sales too loses the sale's line and its totals are worked out again
+    from the remaining sales; an invoice for this sale alone is deleted.
+    Returns the invoice if it was kept.
+    """
+    with transaction.atomic():
+        invoice = Invoice.objects.select_for_update().filter(pk=sale.invoice_id).first()
+        if invoice is None:
+            return None
+        others = list(invoice.stock_transactions.exclude(pk=sale.pk).only(
+            'quantity', 'total_price', 'apply_taxes', 'vat_rate', 'ait_rate', 'final_price',
+        ))
+        if not others:
+            invoice.delete()
+            return None
+
+        line = invoice.items.filter(
+            product_id=sale.product_id, quantity=sale.quantity, unit_price=sale.unit_price,
+        ).order_by('id').first()
+        if line:
+            line.delete()
+        invoice.subtotal, invoice.tax_rate, invoice.tax_amount = invoice_totals(others)
+        invoice.total = invoice.subtotal - invoice.discount
+        invoice.save(update_fields=['subtotal', 'tax_rate', 'tax_amount', 'total', 'updated_at'])
+    return invoice
+
+
+def invoice_totals(lines):
+    """Subtotal, tax rate and tax amount of an invoice billing these sales"""
+    subtotal = sum((sale.total_price for sale in lines), Decimal('0'))
+    tax_amount = sum((
+        sale.total_price - sale.quantity * sale.final_price
+        for sale in lines if sale.apply_taxes and sale.final_price
+    ), Decimal('0'))
+    # The rate is only shown when every line was taxed at the same rate
+    tax_rates = {sale.vat_rate + sale.ait_rate if sale.apply_taxes else Decimal('0') for sale in lines}
+    tax_rate = tax_rates.pop() if len(tax_rates) == 1 else Decimal('0')
+    return subtotal, tax_rate, tax_amount.quantize(CENTS, rounding=ROUND_HALF_UP)
+
+
+def _consolidated_invoice(invoice_number, client_id, start, end, lines, user=None):
+    subtotal, tax_rate, tax_amount = invoice_totals(lines)
+
+    return Invoice(
+        invoice_number=invoice_number,
+        client_id=client_id,
+        issue_date=end,
+        due_date=end + timedelta(days=30),
+        status='pending' if any(sale.payment_status in ['due', 'partial', 'credit'] for sale in lines) else 'paid',
+        subtotal=subtotal,
+        tax_rate=tax_rate,
+        tax_amount=tax_amount,
+        discount=0,
+        total=subtotal,
+        notes=f"Consolidated invoice for {len(lines)} sale(s) from {start:%Y-%m-%d} to {end:%Y-%m-%d}",
+        created_by=user,
+    )
@@ -0,0 +1,405 @@
+"""
+Bulk product catalog import and export.
+
+The importer reads CSV rows one at a time and writes them in chunks with
+bulk_create/bulk_update. Categories, suppliers, warehouses and the existing
+SKUs are each loaded with a single query up front, so an import costs a few
+queries per chunk instead of several per row.
+"""
+import csv
+import hashlib
+import json
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from .models import Product, ProductStock, StockLot, CostLayer, Category, Supplier, Warehouse, KpiCounter, ProductPriceHistory
+from .lookup import product_index
+
+CATALOG_COLUMNS = [
+    'sku', 'name', 'category', 'supplier', 'warehouse', 'description', 'unit_of_measure',
+    'buying_price', 'selling_price', 'reorder_level', 'quantity', 'shipment_number',
+    'location', 'expiry_date',
+]
+
+REQUIRED_COLUMNS = ['sku', 'name', 'warehouse', 'unit_of_measure', 'buying_price', 'selling_price']
+
+# Model fields an import may change on an existing product. Quantity and
+# warehouse are only used for the opening stock of new products; later stock
+# changes go through stock transactions.
+UPDATE_FIELDS = [
+    'name', 'category_id', 'supplier_id', 'description', 'unit_of_measure', 'buying_price',
+    'selling_price', 'reorder_level', 'shipment_number', 'location', 'expiry_date',
+]
+
+DECIMAL_COLUMNS = ('buying_price', 'selling_price', 'reorder_level', 'quantity')
+
+
+class ImportReport:
+    """Counts, per-row errors and field-level changes collected during an import"""
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.errors = []    # (line, message)
+        self.changes = []   # (line, action, sku, warehouse, {column: (old, new)})
+
+    @property
+    def has_errors(self):
+        return bool(self.errors)
+
+    def summary(self):
+        if self.dry_run:
+            counts = f'Dry run: would create {self.created}, update {self.updated}'
+        else:
+            counts = f'Created {self.created}, updated {self.updated}'
+        return f'{counts}, {self.unchanged} unchanged, {len(self.errors)} error(s)'
+
+
+class CatalogImporter:
+    """Create or update products from catalog rows keyed by SKU"""
+
+    def __init__(self, dry_run=False, chunk_size=1000, user=None):
+        self.dry_run = dry_run
+        self.chunk_size = chunk_size
+        self.user = user
+        self.report = ImportReport(dry_run=dry_run)
+
+    def load_lookups(self):
+        """One query per table; names are matched case-insensitively"""
+        self.categories = self._names_to_ids(Category)
+        self.suppliers = self._names_to_ids(Supplier)
+        self.warehouses = self._names_to_ids(Warehouse)
+        self.category_names = dict(Category.objects.values_list('id', 'name'))
+        self.supplier_names = dict(Supplier.objects.values_list('id', 'name'))
+        self.existing = dict(Product.objects.values_list('sku', 'id').order_by())
+        self.seen = set()
+
+    @staticmethod
+    def _names_to_ids(model):
+        names = {}
+        # Ordered by id so the oldest record wins when names are duplicated
+        for pk, name in model.objects.values_list('id', 'name').order_by('-id'):
+            names[name.strip().lower()] = pk
+        return names
+
+    def run(self, rows):
+        """Import an iterable of dicts (e.g. csv.DictReader) and return the report"""
+        self.load_lookups()
+        self.kpi_deltas = defaultdict(lambda: [Decimal('0'), 0])
+
+        with transaction.atomic():
+            chunk = []
+            for line, row in enumerate(rows, start=2):
+                parsed = self.parse_row(line, row)
+                if parsed is None:
+                    continue
+                chunk.append(parsed)
+                if len(chunk) >= self.chunk_size:
+                    self.flush(chunk)
+                    chunk = []
+            if chunk:
+                self.flush(chunk)
+
+            if not self.dry_run:
+                # bulk operations skip the save() signals, so apply the KPI deltas here:
+                # products feed the global counter and stock levels their warehouse's
+                for warehouse_id, (inventory_value, low_stock_count) in self.kpi_deltas.items():
+                    if inventory_value or low_stock_count:
+                        KpiCounter.apply_delta(
+                            warehouse_id, inventory_value=inventory_value, low_stock_count=low_stock_count,
+                            include_global=warehouse_id is None,
+                        )
+
+        if not self.dry_run and (self.report.created or self.report.updated):
+            product_index.invalidate()
+        return self.report
+
+    def parse_row(self, line, row):
+        """Validate one CSV row; returns (line, key, values) or None after recording an error"""
+        row = {(key or '').strip().lower(): (value or '').strip() for key, value in row.items()}
+
+        sku = row.get('sku', '')
+        if not sku:
+            self.report.errors.append((line, 'SKU is required'))
+            return None
+
+        warehouse_id = None
+        warehouse_name = row.get('warehouse', '')
+        if warehouse_name:
+            warehouse_id = self.warehouses.get(warehouse_name.lower())
+            if warehouse_id is None:
+                self.report.errors.append((line, f'Unknown warehouse "{warehouse_name}"'))
+                return None
+
+        if sku in self.seen:
+            self.report.errors.append((line, f'SKU "{sku}" appears more than once'))
+            return None
+        self.seen.add(sku)
+        key = (sku, warehouse_id)
+
+        # Only non-blank cells are applied, so partial spreadsheets leave other fields alone
+        values = {}
+        for column in ('name', 'description', 'unit_of_measure', 'shipment_number', 'location'):
+            if row.get(column):
+                values[column] = row[column]
+
+        for column, lookup, field in (('category', self.categories, 'category_id'), ('supplier', self.suppliers, 'supplier_id')):
+            if row.get(column):
+                related_id = lookup.get(row[column].lower())
+                if related_id is None:
+                    self.report.errors.append((line, f'Unknown {column} "{row[column]}"'))
+                    return None
+                values[field] = related_id
+
+        for column in DECIMAL_COLUMNS:
+            if row.get(column):
+                try:
+                    values[column] = Decimal(row[column].replace(',', ''))
+                except InvalidOperation:
+                    self.report.errors.append((line, f'Invalid {column.replace("_", " ")} "{row[column]}"'))
+                    return None
+
+        if row.get('expiry_date'):
+            try:
+                values['expiry_date'] = datetime.strptime(row['expiry_date'], '%Y-%m-%d').date()
+            except ValueError:
+                self.report.errors.append((line, f'Invalid expiry date "{row["expiry_date"]}", expected YYYY-MM-DD'))
+                return None
+
+        if sku not in self.existing:
+            missing = [column for column in REQUIRED_COLUMNS if not row.get(column)]
+            if missing:
+                self.report.errors.append((line, f'New product is missing: {", ".join(missing)}'))
+                return None
+
+        return line, key, values
+
+    def flush(self, chunk):
+        """Write one chunk: a single in_bulk() for existing rows, then bulk_create/bulk_update"""
+        existing_ids = [self.existing[sku] for _, (sku, _), _ in chunk if sku in self.existing]
+        stored = Product.objects.in_bulk(existing_ids)
+        now = timezone.now()
+        to_create = []
+        to_update = []
+        price_changes = []  # (product, previous buying price, previous selling price)
+        revalued = {}  # product id -> (product, previous buying price, previous reorder level)
+
+        for line, (sku, warehouse_id), values in chunk:
+            product_id = self.existing.get(sku)
+            product = stored.get(product_id) if product_id else None
+
+            if product is None:
+                product = Product(sku=sku, warehouse_id=warehouse_id, **values)
+                product.is_low_stock = product.quantity <= product.reorder_level
+                to_create.append(product)
+                self.report.created += 1
+                self.report.changes.append((line, 'create', sku, warehouse_id, {}))
+                self._add_kpi(product.kpi_contribution(), 1)
+                if warehouse_id:
+                    self._add_stock_kpi(warehouse_id, ProductStock.kpi_values(product.quantity, product.buying_price, product.reorder_level), 1)
+                continue
+
+            old_kpi = product.kpi_contribution()
+            old_prices = (product.buying_price, product.selling_price)
+            old_reorder_level = product.reorder_level
+            diff = {}
+            for field in UPDATE_FIELDS:
+                if field in values and getattr(product, field) != values[field]:
+                    column = field[:-3] if field.endswith('_id') else field
+                    diff[column] = (self._display(field, getattr(product, field)), self._display(field, values[field]))
+                    setattr(product, field, values[field])
+
+            if not diff:
+                self.report.unchanged += 1
+                continue
+
+            self._add_kpi(old_kpi, -1)
+            product.is_low_stock = product.quantity <= product.reorder_level
+            product.updated_at = now
+            self._add_kpi(product.kpi_contribution(), 1)
+            to_update.append(product)
+            if 'buying_price' in diff or 'selling_price' in diff:
+                price_changes.append((product, old_prices[0], old_prices[1]))
+            if 'buying_price' in diff or 'reorder_level' in diff:
+                revalued[product.pk] = (product, old_prices[0], old_reorder_level)
+            self.report.updated += 1
+            self.report.changes.append((line, 'update', sku, warehouse_id, diff))
+
+        if self.dry_run:
+            return
+        if to_create:
+            Product.objects.bulk_create(to_create, batch_size=self.chunk_size)
+            # Opening stock of new products goes to the warehouse named in their row
+            ProductStock.objects.bulk_create(
+                [
+                    ProductStock(product=product, warehouse_id=product.warehouse_id, quantity=product.quantity)
+                    for product in to_create if product.pk and product.warehouse_id
+                ],
+                batch_size=self.chunk_size,
+            )
+            # ...as an opening lot carrying the row's shipment number and expiry
+            StockLot.objects.bulk_create(
+                [
+                    StockLot(
+                        product=product, warehouse_id=product.warehouse_id, lot_number=product.shipment_number or '',
+                        expiry_date=product.expiry_date, quantity=product.quantity, received_quantity=product.quantity, received_at=now,
+                    )
+                    for product in to_create if product.pk and product.warehouse_id and product.quantity > 0
+                ],
+                batch_size=self.chunk_size,
+            )
+            # ...and as an opening cost layer at its buying price
+            CostLayer.objects.bulk_create(
+                [
+                    CostLayer(
+                        product=product, unit_cost=product.buying_price, quantity=product.quantity,
+                        received_quantity=product.quantity, received_at=now,
+                    )
+                    for product in to_create if product.pk and product.quantity > 0
+                ],
+                batch_size=self.chunk_size,
+            )
+        if to_update:
+            Product.objects.bulk_update(to_update, UPDATE_FIELDS + ['is_low_stock', 'updated_at'], batch_size=self.chunk_size)
+        if revalued:
+            # A new buying price or reorder level changes every warehouse holding the product
+            levels = ProductStock.objects.filter(product_id__in=revalued).values_list('product_id', 'warehouse_id', 'quantity')
+            for product_id, warehouse_id, quantity in levels:
+                product, old_buying_price, old_reorder_level = revalued[product_id]
+                self._add_stock_kpi(warehouse_id, ProductStock.kpi_values(quantity, old_buying_price, old_reorder_level), -1)
+                self._add_stock_kpi(warehouse_id, ProductStock.kpi_values(quantity, product.buying_price, product.reorder_level), 1)
+
+        # bulk_create/bulk_update skip the price history signal as well
+        history = [
+            ProductPriceHistory(
+                product=product, buying_price=product.buying_price, selling_price=product.selling_price,
+                source='initial', changed_by=self.user, changed_at=now,
+            )
+            for product in to_create if product.pk
+        ] + [
+            ProductPriceHistory(
+                product=product, buying_price=product.buying_price, selling_price=product.selling_price,
+                previous_buying_price=old_buying, previous_selling_price=old_selling,
+                source='import', changed_by=self.user, changed_at=now,
+            )
+            for product, old_buying, old_selling in price_changes
+        ]
+        if history:
+            ProductPriceHistory.objects.bulk_create(history, batch_size=self.chunk_size)
+
+    def _add_kpi(self, contribution, sign):
+        warehouse_id, value, low_stock = contribution
+        delta = self.kpi_deltas[warehouse_id]
+        delta[0] += sign * value
+        delta[1] += sign * low_stock
+
+    def _add_stock_kpi(self, warehouse_id, values, sign):
+        self._add_kpi((warehouse_id, values[0], values[1]), sign)
+
+    def _display(self, field, value):
+        if field == 'category_id':
+            return self.category_names.get(value, '')
+        if field == 'supplier_id':
+            return self.supplier_names.get(value, '')
+        return '' if value is None else str(value)
+
+
+class Echo:
+    """File-like object whose write() just returns the value, for streaming csv.writer output"""
+
+    def write(self, value):
+        return value
+
+
+def catalog_rows(queryset):
+    """Yield catalog CSV rows (header first) using a single joined values_list() query"""
+    yield CATALOG_COLUMNS
+    rows = queryset.order_by('id').values_list(
+        'sku', 'name', 'category__name', 'supplier__name', 'warehouse__name', 'description',
+        'unit_of_measure', 'buying_price', 'selling_price', 'reorder_level', 'quantity',
+        'shipment_number', 'location', 'expiry_date',
+    )
+    for row in rows.iterator(chunk_size=2000):
+        yield ['' if value is None else value for value in row]
+
+
+def stream_catalog_csv(queryset):
+    """Yield CSV text for a product queryset, one line at a time"""
+    writer = csv.writer(Echo())
+    for row in catalog_rows(queryset):
+        yield writer.writerow(row)
+
+
+def catalog_stamp():
+    """
+    Cheap change marker for the product and stock level tables. Every save
+    bumps the latest updated_at (indexed) and deletes change the row count.
+    Transfers only touch stock levels, hence the second aggregate.
+    """
+    stamp = Product.objects.aggregate(latest=Max('updated_at'), count=Count('id'))
+    stock = ProductStock.objects.aggregate(latest=Max('updated_at'), count=Count('id'))
+    latest = stamp['latest'].timestamp() if stamp['latest'] else 0
+    stock_latest = stock['latest'].timestamp() if stock['latest'] else 0
+    return f"{latest}:{stamp['count']}:{stock_latest}:{stock['count']}"
+
+
+# Compact catalog bundle for client-side product pickers: rows are positional
+# arrays in BUNDLE_FIELDS order to keep the payload small and gzip-friendly.
+BUNDLE_FIELDS = [
+    'id', 'sku', 'name', 'category_id', 'warehouse_id', 'unit_of_measure',
+    'buying_price', 'selling_price', 'quantity', 'warehouse_ids',
+]
+BUNDLE_TIMEOUT = 60 * 60 * 24
+
+# Bundle versions are kept in a cache shared by all web workers, so a delta
+# request can be answered by any of them; a version that has been culled or
+# has expired gets the full bundle instead
+BUNDLE_CACHE = 'catalog'
+
+
+def catalog_bundle():
+    """
+    Return (version, rows) for the current catalog. The version is a hash of
+    the rows, so saves that don't touch bundle fields keep the same version.
+    Rows are also kept in the cache under their version so later requests can
+    be answered with a delta against it.
+    """
+    bundle_cache = caches[BUNDLE_CACHE]
+    stamp_key = f'catalog_bundle:{catalog_stamp()}'
+    version = bundle_cache.get(stamp_key)
+    rows = bundle_cache.get(f'catalog_bundle_version:{version}') if version else None
+    if rows is None:
+        # warehouse_ids lists the warehouses holding a stock level, for the pickers' warehouse filter
+        stocked = defaultdict(list)
+        for product_id, warehouse_id in ProductStock.objects.order_by('warehouse_id').values_list('product_id', 'warehouse_id'):
+            stocked[product_id].append(warehouse_id)
+        rows = [
+            [pk, sku, name, category_id, warehouse_id, uom, float(buying), float(selling), float(quantity), stocked.get(pk, [])]
+            for pk, sku, name, category_id, warehouse_id, uom, buying, selling, quantity
+            in Product.objects.order_by('id').values_list(*BUNDLE_FIELDS[:-1]).iterator(chunk_size=5000)
+        ]
+        version = hashlib.sha1(json.dumps(rows, separators=(',', ':')).encode()).hexdigest()[:16]
+        bundle_cache.set(f'catalog_bundle_version:{version}', rows, BUNDLE_TIMEOUT)
+        bundle_cache.set(stamp_key, version, BUNDLE_TIMEOUT)
+    return version, rows
+
+
+def catalog_delta(since_version, rows):
+    """
+    Return (upserts, deleted_ids) to bring a client holding since_version up
+    to date, or None when that version is no longer cached
+    """
+    old_rows = caches[BUNDLE_CACHE].get(f'catalog_bundle_version:{since_version}')
+    if old_rows is None:
+        return None
+    old = {row[0]: row for row in old_rows}
+    upserts = [row for row in rows if old.pop(row[0], None) != row]
+    return upserts, list(old)
@@ -0,0 +1,113 @@
+"""
+Demand forecasting and reorder level suggestions.
+
+Sales are read as one grouped query of (product, day, quantity) rows. Each
+product's sparse series is folded in a single pass: days without sales are
+zero demand, and their effect on the exponentially smoothed value is applied
+in closed form (decay ** gap), so the work is proportional to the number of
+days a product actually sold rather than products x days of history.
+"""
+from datetime import datetime, time
+from decimal import Decimal, ROUND_HALF_UP
+from itertools import groupby
+from math import sqrt
+from operator import itemgetter
+from statistics import NormalDist
+
+from django.db.models import Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import StockTransaction
+
+QUANTITY = Decimal('0.001')
+
+
+def daily_sales(start):
+    """(product_id, day, quantity sold) rows from start onwards, ordered by product and day"""
+    # A range on the raw column rather than __date, so the filter can use an index
+    start_at = timezone.make_aware(datetime.combine(start, time.min))
+    return (
+        StockTransaction.objects.filter(transaction_type='out', transaction_date__gte=start_at)
+        .annotate(day=TruncDate('transaction_date'))
+        .values('product_id', 'day')
+        .annotate(total=Sum('quantity'))
+        .order_by('product_id', 'day')
+        .values_list('product_id', 'day', 'total')
+    )
+
+
+def forecast_series(sales, history_days, window_days, alpha):
+    """
+    Forecast daily demand from (day, quantity) pairs in day order, where day
+    0 is the first day of the history and history_days - 1 is today. The
+    history of a product starts at its first sale. Returns (moving_average,
+    smoothed, std_dev) per day, or None if there were no sales.
+    """
+    decay = 1 - alpha
+    smoothed = first_day = last_day = None
+    total = total_squares = recent = 0.0
+    window_start = history_days - window_days
+
+    for day, quantity in sales:
+        quantity = float(quantity)
+        if smoothed is None:
+            smoothed = quantity
+            first_day = day
+        else:
+            smoothed = alpha * quantity + decay ** (day - last_day) * smoothed
+        last_day = day
+        total += quantity
+        total_squares += quantity * quantity
+        if day >= window_start:
+            recent += quantity
+
+    if smoothed is None:
+        return None
+    # Days without sales up to today
+    smoothed *= decay ** (history_days - 1 - last_day)
+    observed_days = history_days - first_day
+    mean = total / observed_days
+    variance = max(total_squares / observed_days - mean * mean, 0.0)
+    moving_average = recent / min(window_days, observed_days)
+    return moving_average, smoothed, sqrt(variance)
+
+
+def reorder_level(daily_demand, std_dev, lead_time_days, service_level):
+    """
+    Reorder point: demand over the lead time plus safety stock for the
+    service level, assuming normally distributed daily demand.
+    Returns (safety_stock, reorder_level).
+    """
+    z = NormalDist().inv_cdf(service_level)
+    safety_stock = z * std_dev * sqrt(lead_time_days)
+    return safety_stock, daily_demand * lead_time_days + safety_stock
+
+
+def forecast_catalog(start, history_days, window_days, alpha, lead_time_days, service_level):
+    """
+    Yield (product_id, values) for every product that sold since start, values
+    being the ReorderSuggestion fields. Rows are streamed, so memory does not
+    grow with the size of the catalog.
+    """
+    rows = daily_sales(start).iterator(chunk_size=5000)
+    for product_id, product_rows in groupby(rows, key=itemgetter(0)):
+        forecast = forecast_series(
+            (((day - start).days, quantity) for _, day, quantity in product_rows),
+            history_days, window_days, alpha,
+        )
+        if forecast is None:
+            continue
+        moving_average, smoothed, std_dev = forecast
+        safety_stock, suggested = reorder_level(smoothed, std_dev, lead_time_days, service_level)
+        yield product_id, {
+            'average_daily_demand': _quantity(moving_average),
+            'smoothed_daily_demand': _quantity(smoothed),
+            'demand_std_dev': _quantity(std_dev),
+            'safety_stock': _quantity(safety_stock),
+            'suggested_reorder_level': _quantity(suggested),
+        }
+
+
+def _quantity(value):
+    return Decimal(repr(value)).quantize(QUANTITY, rounding=ROUND_HALF_UP)
@@ -1,6 +1,10 @@
 from django import forms
-from .models import Product, Category, Supplier, Client, StockTransaction, Invoice, InvoiceItem, Warehouse, Payment
+from .models import Product, ProductStock, Category, Supplier, Client, StockTransaction, Invoice, InvoiceItem, InvoiceSequence, Warehouse, Payment
 from django.utils import timezone
+from decimal import Decimal, InvalidOperation
+from .payment_allocation import ALLOCATION_MODES, AllocationError, open_transactions
+from .pricing import REPRICE_MODES
+from .search import search_products
 
 class ProductForm(forms.ModelForm):
     class Meta:
@@ -27,19 +31,59 @@ class ProductForm(forms.ModelForm):
     def clean(self):
         cleaned_data = super().clean()
         sku = cleaned_data.get('sku')
-        warehouse = cleaned_data.get('warehouse')
         
-        # Check if a product with the same SKU exists in the same warehouse
-        if sku and warehouse:
+        # A SKU is a single product; its stock per warehouse is tracked separately
+        if sku:
             # Exclude current instance when editing
             instance_id = self.instance.id if self.instance and self.instance.pk else None
             
-            existing_product = Product.objects.filter(sku=sku, warehouse=warehouse).exclude(id=instance_id).first()
+            existing_product = Product.objects.filter(sku=sku).exclude(id=instance_id).first()
             if existing_product:
-                self.add_error('sku', f'A product with SKU "{sku}" already exists in the selected warehouse.')
+                self.add_error('sku', f'A product with SKU "{sku}" already exists.')
         
         return cleaned_data
 
+class RepriceForm(forms.Form):
+    """Filters and rule for bulk repricing"""
+    category = forms.ModelChoiceField(queryset=Category.objects.all(), required=False, empty_label='All Categories',
+                                      widget=forms.Select(attrs={'class': 'form-select'}))
+    supplier = forms.ModelChoiceField(queryset=Supplier.objects.all(), required=False, empty_label='All Suppliers',
+                                      widget=forms.Select(attrs={'class': 'form-select'}))
+    warehouse = forms.ModelChoiceField(queryset=Warehouse.objects.all(), required=False, empty_label='All Warehouses',
+                                       widget=forms.Select(attrs={'class': 'form-select'}))
+    search = forms.CharField(required=False,
+                             widget=forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'SKU, name or description'}))
+    mode = forms.ChoiceField(choices=REPRICE_MODES, widget=forms.Select(attrs={'class': 'form-select'}))
+    value = forms.DecimalField(max_digits=10, decimal_places=2,
+                               widget=forms.NumberInput(attrs={'class': 'form-control', 'step': '0.01'}))
+    note = forms.CharField(required=False, max_length=255,
+                           widget=forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Reason for the price change'}))
+    
+    def clean(self):
+        cleaned_data = super().clean()
+        mode = cleaned_data.get('mode')
+        value = cleaned_data.get('value')
+        
+        if mode == 'percent' and value is not None and value <= -100:
+            self.add_error('value', 'A percentage change must be greater than -100%.')
+        if mode == 'margin' and value is not None and value < 0:
+            self.add_error('value', 'Margin must not be negative.')
+        
+        return cleaned_data
+    
+    def filtered_products(self):
+        """Products matched by the filter fields"""
+        products = Product.objects.all()
+        if self.cleaned_data.get('category'):
+            products = products.filter(category=self.cleaned_data['category'])
+        if self.cleaned_data.get('supplier'):
+            products = products.filter(supplier=self.cleaned_data['supplier'])
+        if self.cleaned_data.get('warehouse'):
+            products = products.filter(stock_levels__warehouse=self.cleaned_data['warehouse'])
+        if self.cleaned_data.get('search'):
+            products = search_products(products, self.cleaned_data['search'])
+        return products
+
 class WarehouseForm(forms.ModelForm):
     class Meta:
         model = Warehouse
@@ -96,7 +140,7 @@ class StockTransactionForm(forms.ModelForm):
         fields = ['product', 'transaction_type', 'quantity', 'buying_price', 
                   'selling_price', 'wastage_amount', 'supplier', 'client', 
                   'source_warehouse', 'destination_warehouse', 'reference_number', 
-                  'notes', 'transaction_date', 'apply_taxes', 'vat_rate', 'ait_rate', 'final_price',
+                  'lot_number', 'expiry_date', 'notes', 'transaction_date', 'apply_taxes', 'vat_rate', 'ait_rate', 'final_price',
                   'payment_status', 'payment_due_date', 'amount_paid']
         widgets = {
             'product': forms.Select(attrs={'class': 'form-select'}),
@@ -110,6 +154,8 @@ class StockTransactionForm(forms.ModelForm):
             'source_warehouse': forms.Select(attrs={'class': 'form-select warehouse-field'}),
             'destination_warehouse': forms.Select(attrs={'class': 'form-select warehouse-field'}),
             'reference_number': forms.TextInput(attrs={'class': 'form-control'}),
+            'lot_number': forms.TextInput(attrs={'class': 'form-control'}),
+            'expiry_date': forms.DateInput(attrs={'class': 'form-control', 'type': 'date'}),
             'notes': forms.Textarea(attrs={'class': 'form-control', 'rows': 3}),
             'transaction_date': forms.DateTimeInput(attrs={'class': 'form-control', 'type': 'datetime-local'}),
             'apply_taxes': forms.HiddenInput(),
@@ -186,13 +232,11 @@ class StockTransactionForm(forms.ModelForm):
             if quantity <= 0:
                 self.add_error('quantity', 'Transfer quantity must be greater than zero')
                 
-            # Check if product is in source warehouse
-            if product and source and product.warehouse != source:
-                self.add_error('source_warehouse', f'Product is not in the source warehouse. Current warehouse: {product.warehouse}')
-                
-            # Check if there's enough quantity
-            if product and quantity > product.quantity:
-                self.add_error('quantity', f'Not enough quantity in source warehouse. Available: {product.quantity}, Requested: {quantity}')
+            # Check there's enough quantity in the source warehouse
+            if product and source:
+                available = ProductStock.available(product, source.id)
+                if quantity > available:
+                    self.add_error('quantity', f'Not enough quantity in source warehouse. Available: {available}, Requested: {quantity}')
         
         # For stock in, destination warehouse is required
         if transaction_type == 'in' and not cleaned_data.get('destination_warehouse'):
@@ -296,6 +340,11 @@ class InvoiceForm(forms.ModelForm):
         super().__init__(*args, **kwargs)
         # Make calculated fields not required in the form
         self.fields['subtotal'].required = False
+        
+        # New invoices left without a number get the next one from the sequence when saved
+        if not self.instance.pk:
+            self.fields['invoice_number'].required = False
+            self.fields['invoice_number'].widget.attrs['placeholder'] = f'Next: {InvoiceSequence.peek()} (leave blank)'
 
 class InvoiceItemForm(forms.ModelForm):
     class Meta:
@@ -309,4 +358,101 @@ class InvoiceItemForm(forms.ModelForm):
 
 InvoiceItemFormSet = forms.inlineformset_factory(
     Invoice, InvoiceItem, form=InvoiceItemForm, extra=1, can_delete=True
-) 
\ No newline at end of file
+) 
+
+class InvoiceExportForm(forms.Form):
+    """Filters for a bulk invoice PDF export"""
+    start_date = forms.DateField(required=False, widget=forms.DateInput(attrs={'class': 'form-control', 'type': 'date'}))
+    end_date = forms.DateField(required=False, widget=forms.DateInput(attrs={'class': 'form-control', 'type': 'date'}))
+    client = forms.ModelChoiceField(queryset=Client.objects.all(), required=False, empty_label='All Clients',
+                                    widget=forms.Select(attrs={'class': 'form-select'}))
+    status = forms.ChoiceField(choices=(('', 'All Statuses'),) + Invoice.STATUS_CHOICES, required=False,
+                               widget=forms.Select(attrs={'class': 'form-select'}))
+    
+    def clean(self):
+        cleaned_data = super().clean()
+        start_date = cleaned_data.get('start_date')
+        end_date = cleaned_data.get('end_date')
+        
+        if start_date and end_date and start_date > end_date:
+            self.add_error('end_date', 'End date must not be before the start date.')
+        
+        return cleaned_data
+    
+    def filtered_invoices(self):
+        """Invoices matched by the filter fields, by issue date"""
+        invoices = Invoice.objects.select_related('client').order_by('issue_date', 'id')
+        if self.cleaned_data.get('start_date'):
+            invoices = invoices.filter(issue_date__gte=self.cleaned_data['start_date'])
+        if self.cleaned_data.get('end_date'):
+            invoices = invoices.filter(issue_date__lte=self.cleaned_data['end_date'])
+        if self.cleaned_data.get('client'):
+            invoices = invoices.filter(client=self.cleaned_data['client'])
+        if self.cleaned_data.get('status'):
+            invoices = invoices.filter(status=self.cleaned_data['status'])
+        return invoices
+    
+    def filters(self):
+        """The filters as JSON-friendly values, for the export job record"""
+        return {
+            'start_date': self.cleaned_data['start_date'].isoformat() if self.cleaned_data.get('start_date') else None,
+            'end_date': self.cleaned_data['end_date'].isoformat() if self.cleaned_data.get('end_date') else None,
+            'client': self.cleaned_data['client'].pk if self.cleaned_data.get('client') else None,
+            'status': self.cleaned_data.get('status') or None,
+        }
+
+class PaymentAllocationForm(forms.Form):
+    """One receipt from a client, or remittance to a supplier, spread over their open transactions"""
+    client = forms.ModelChoiceField(queryset=Client.objects.all(), required=False, empty_label='Select Client',
+                                    widget=forms.Select(attrs={'class': 'form-select'}))
+    supplier = forms.ModelChoiceField(queryset=Supplier.objects.all(), required=False, empty_label='Select Supplier',
+                                      widget=forms.Select(attrs={'class': 'form-select'}))
+    amount = forms.DecimalField(max_digits=12, decimal_places=2,
+                                widget=forms.NumberInput(attrs={'class': 'form-control', 'step': '0.01'}))
+    payment_date = forms.DateField(initial=timezone.localdate,
+                                   widget=forms.DateInput(attrs={'class': 'form-control', 'type': 'date'}))
+    payment_method = forms.ChoiceField(choices=Payment.PAYMENT_METHODS, initial='bank',
+                                       widget=forms.Select(attrs={'class': 'form-select'}))
+    reference = forms.CharField(required=False, max_length=100,
+                                widget=forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Bank reference, check number, etc.'}))
+    notes = forms.CharField(required=False, widget=forms.TextInput(attrs={'class': 'form-control'}))
+    mode = forms.ChoiceField(choices=ALLOCATION_MODES, widget=forms.Select(attrs={'class': 'form-select'}))
+    
+    def clean(self):
+        cleaned_data = super().clean()
+        client = cleaned_data.get('client')
+        supplier = cleaned_data.get('supplier')
+        amount = cleaned_data.get('amount')
+        
+        if bool(client) == bool(supplier):
+            raise forms.ValidationError('Select either a client or a supplier.')
+        if amount is not None and amount <= 0:
+            self.add_error('amount', 'Payment amount must be greater than zero')
+        
+        return cleaned_data
+    
+    def open_transactions(self):
+        """The open transactions of the selected client or supplier, oldest due date first"""
+        return open_transactions(client=self.cleaned_data.get('client'), supplier=self.cleaned_data.get('supplier'))
+    
+    def split(self, transactions):
+        """
+        Amounts entered per transaction (allocate_<id> fields) in split mode,
+        as {transaction id: amount}. None in FIFO mode, or before any amounts
+        were entered, so the FIFO plan is the starting point. Raises
+        AllocationError for an amount that is not a number.
+        """
+        if self.cleaned_data['mode'] != 'split' or not any(key.startswith('allocate_') for key in self.data):
+            return None
+        split = {}
+        for transaction in transactions:
+            value = (self.data.get(f'allocate_{transaction.id}') or '').strip()
+            try:
+                amount = Decimal(value).quantize(Decimal('0.01')) if value else Decimal('0')
+            except InvalidOperation:
+                amount = None
+            # NaN quantizes without an error but cannot be compared
+            if amount is None or not amount.is_finite():
+                raise AllocationError(f'{transaction.transaction_id}: "{value}" is not a valid amount.')
+            split[transaction.id] = amount
+        return split
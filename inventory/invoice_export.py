@@ -0,0 +1,134 @@
+"""
+Bulk export of invoice PDFs as one ZIP.
+
+Invoice templates render in the calling process, where the database is, and
+the xhtml2pdf layout runs in a process pool sized to the available cores.
+The ZIP is written to an unseekable stream, so each PDF can be sent to the
+client as soon as it completes instead of after the whole batch. PDFs
+already in the on-disk invoice cache are not rendered again, and newly
+rendered ones are added to it.
+"""
+import os
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from django.conf import settings
+from django.template.loader import get_template
+from django.utils.text import slugify
+
+from . import pdf_cache
+from .utils import html_to_pdf_bytes
+
+DEFAULT_PDF_CUSTOMIZATION = {
+    'company_name': 'QBITX IMS',
+    'company_tagline': 'Transform Suppliers',
+    'company_details': '123 Business Street, Business City, Country',
+    'terms_conditions': '',
+}
+
+
+def invoice_pdf_context(invoice, customization):
+    return {
+        'invoice': invoice,
+        'company_name': customization.get('company_name'),
+        'company_tagline': customization.get('company_tagline'),
+        'company_details': customization.get('company_details'),
+        'terms_conditions': customization.get('terms_conditions'),
+    }
+
+
+def export_workers():
+    workers = getattr(settings, 'INVOICE_EXPORT_WORKERS', None)
+    if workers:
+        return workers
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def render_invoice_pdfs(invoices, customization, workers):
+    """
+    Yield (invoice, PDF bytes or None) for each invoice, in the order the
+    renders complete. Only a couple of renders per worker are queued at once.
+    """
+    template = get_template(pdf_cache.INVOICE_PDF_TEMPLATE)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        for invoice in invoices:
+            key = pdf_cache.invoice_pdf_key(invoice, customization)
+            path = pdf_cache.read(key)
+            if path:
+                try:
+                    with open(path, 'rb') as cached:
+                        yield invoice, cached.read()
+                    continue
+                except FileNotFoundError:
+                    pass
+            html = template.render(invoice_pdf_context(invoice, customization))
+            pending[pool.submit(html_to_pdf_bytes, html)] = (invoice, key)
+            if len(pending) >= 2 * workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                yield from _collect(done, pending)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            yield from _collect(done, pending)
+
+
+def _collect(done, pending):
+    for future in done:
+        invoice, key = pending.pop(future)
+        pdf = future.result()
+        if pdf:
+            pdf_cache.write(key, pdf)
+        yield invoice, pdf
+
+
+class _ZipStream:
+    """Write-only file object whose written bytes are handed out in pieces"""
+
+    def __init__(self):
+        self.pieces = []
+
+    def write(self, data):
+        self.pieces.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.pieces)
+        self.pieces = []
+        return data
+
+
+def export_invoices_zip(job, invoices, customization=None, workers=None):
+    """
+    Yield the bytes of a ZIP holding a PDF per invoice, filed in a folder
+    per client, and keep the job's progress up to date.
+    """
+    customization = customization or DEFAULT_PDF_CUSTOMIZATION
+    workers = workers or export_workers()
+    job.start(invoices.count())
+    stream = _ZipStream()
+    try:
+        # PDFs are compressed already, so they are stored rather than deflated
+        with zipfile.ZipFile(stream, mode='w', compression=zipfile.ZIP_STORED) as archive:
+            for invoice, pdf in render_invoice_pdfs(
+                pdf_cache.with_pdf_items(invoices).iterator(chunk_size=200), customization, workers,
+            ):
+                job.record(pdf is not None)
+                if pdf is None:
+                    continue
+                folder = slugify(invoice.client.name) or f'client-{invoice.client_id}'
+                archive.writestr(f'{folder}/Invoice_{invoice.invoice_number}.pdf', pdf)
+                yield stream.drain()
+        yield stream.drain()
+    except GeneratorExit:
+        job.finish(error='The download was cancelled.')
+        raise
+    except Exception as exc:
+        job.finish(error=str(exc))
+        raise
+    job.finish()
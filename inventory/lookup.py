@@ -0,0 +1,133 @@
+"""
+In-memory product lookup index for typeahead and exact SKU lookups.
+
+The index keeps sorted arrays of normalized SKU and name keys so a prefix
+lookup is a binary search plus a short scan, without touching the database.
+It only holds the fields needed for matching; the endpoints fetch the live
+product rows (quantity, prices, ...) by id afterwards.
+
+The index is rebuilt after a Product save or delete in this process changes
+a searchable field, or a product is first stocked in a warehouse (see
+signals.py). Other worker processes pick up changes
+when their copy is older than INDEX_MAX_AGE seconds. Rebuilds run in a
+background thread so lookups keep being served from the previous arrays.
+"""
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+INDEX_MAX_AGE = 60
+
+
+def normalize(value):
+    """Lower-case and collapse whitespace so keys compare consistently"""
+    return ' '.join((value or '').lower().split())
+
+
+class ProductLookupIndex:
+    """Sorted SKU and name keys mapped to product ids"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._built_at = None
+        self._stale = False
+        self._rebuilding = False
+        # (sku_keys, sku_ids, name_keys, name_ids, stocked), swapped in as one tuple;
+        # stocked holds the (product_id, warehouse_id) pairs that have a stock level
+        self._snapshot = ([], array('q'), [], array('q'), set())
+
+    def invalidate(self):
+        self._stale = True
+
+    def _ensure_built(self):
+        if self._built_at is None:
+            # First use in this process: nothing to serve yet, so build inline
+            with self._lock:
+                if self._built_at is None:
+                    self._build()
+            return
+        if self._stale or time.monotonic() - self._built_at >= INDEX_MAX_AGE:
+            # Keep answering from the current arrays while a fresh copy is built
+            with self._lock:
+                if self._rebuilding:
+                    return
+                self._rebuilding = True
+                self._stale = False
+            threading.Thread(target=self._rebuild_in_background, daemon=True).start()
+
+    def _rebuild_in_background(self):
+        from django.db import connection
+
+        try:
+            self._build()
+        finally:
+            self._rebuilding = False
+            connection.close()
+
+    def _build(self):
+        from .models import Product, ProductStock
+
+        sku_entries = []
+        name_entries = []
+        rows = Product.objects.values_list('id', 'sku', 'name').order_by()
+        for product_id, sku, name in rows.iterator(chunk_size=5000):
+            sku_entries.append((normalize(sku), product_id))
+            name = normalize(name)
+            name_entries.append((name, product_id))
+            # Also index every later word so "pepper" finds "black pepper"
+            words = name.split(' ')
+            for position in range(1, len(words)):
+                name_entries.append((' '.join(words[position:]), product_id))
+
+        stocked = set(ProductStock.objects.values_list('product_id', 'warehouse_id').order_by().iterator(chunk_size=5000))
+
+        sku_entries.sort()
+        name_entries.sort()
+        self._snapshot = (
+            [key for key, _ in sku_entries],
+            array('q', (product_id for _, product_id in sku_entries)),
+            [key for key, _ in name_entries],
+            array('q', (product_id for _, product_id in name_entries)),
+            stocked,
+        )
+        self._built_at = time.monotonic()
+
+    def _scan(self, keys, ids, stocked, prefix, warehouse_id, limit, found):
+        position = bisect_left(keys, prefix)
+        while position < len(keys) and len(found) < limit and keys[position].startswith(prefix):
+            product_id = ids[position]
+            if warehouse_id is None or (product_id, warehouse_id) in stocked:
+                found.setdefault(product_id, None)
+            position += 1
+
+    def prefix(self, query, limit=10, warehouse_id=None):
+        """Return up to `limit` product ids whose SKU or name starts with query, SKU matches first"""
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        self._ensure_built()
+        sku_keys, sku_ids, name_keys, name_ids, stocked = self._snapshot
+        found = {}
+        self._scan(sku_keys, sku_ids, stocked, prefix, warehouse_id, limit, found)
+        self._scan(name_keys, name_ids, stocked, prefix, warehouse_id, limit, found)
+        return list(found)
+
+    def by_sku(self, sku, warehouse_id=None):
+        """Return the ids of products whose SKU matches exactly (case-insensitive)"""
+        key = normalize(sku)
+        if not key:
+            return []
+        self._ensure_built()
+        sku_keys, sku_ids, _, _, stocked = self._snapshot
+        found = []
+        position = bisect_left(sku_keys, key)
+        while position < len(sku_keys) and sku_keys[position] == key:
+            product_id = sku_ids[position]
+            if warehouse_id is None or (product_id, warehouse_id) in stocked:
+                found.append(product_id)
+            position += 1
+        return found
+
+
+product_index = ProductLookupIndex()
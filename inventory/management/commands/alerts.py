@@ -0,0 +1,154 @@
+import os
+from collections import defaultdict
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from inventory.models import Product, ProductStock, StockLot, StockAlertDigest
+
+
+class Command(BaseCommand):
+    help = 'Build per-warehouse low stock and expiry alert digests.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=30,
+            help='Products expiring within this many days are reported (default: 30).',
+        )
+        parser.add_argument(
+            '--output-dir',
+            help='Also write one text digest per warehouse into this directory.',
+        )
+
+    def handle(self, *args, **options):
+        window_days = options['days']
+        output_dir = options.get('output_dir')
+        today = timezone.now().date()
+        expiry_limit = today + timedelta(days=window_days)
+
+        digests = defaultdict(lambda: {
+            'warehouse_name': 'Unassigned',
+            'low_stock': [],
+            'expiring_soon': [],
+            'expired': [],
+        })
+
+        # Stock is kept per warehouse, so a product is low in each warehouse
+        # whose stock level is at or below its reorder level
+        low_stock_levels = ProductStock.objects.filter(
+            quantity__lte=F('product__reorder_level'),
+        ).select_related('product', 'warehouse').order_by('warehouse_id', 'product__name')
+
+        for level in low_stock_levels.iterator(chunk_size=2000):
+            digest = digests[level.warehouse_id]
+            digest['warehouse_name'] = level.warehouse.name
+            digest['low_stock'].append(self.low_stock_item(level.product, level.quantity))
+
+        # Low stock products not stocked in any warehouse, served by the is_low_stock index
+        unstocked = Product.objects.filter(is_low_stock=True, stock_levels__isnull=True).order_by('name')
+        for product in unstocked.iterator(chunk_size=2000):
+            digests[None]['low_stock'].append(self.low_stock_item(product, product.quantity))
+
+        # Expiry is tracked per lot, read off the open lot expiry index
+        expiring_lots = StockLot.open_lots().filter(expiry_date__lte=expiry_limit).select_related(
+            'product', 'warehouse'
+        ).order_by('warehouse_id', 'expiry_date', 'product__name')
+
+        for lot in expiring_lots.iterator(chunk_size=2000):
+            digest = digests[lot.warehouse_id]
+            digest['warehouse_name'] = lot.warehouse.name
+
+            item = {
+                'id': lot.product_id,
+                'sku': lot.product.sku,
+                'name': lot.product.name,
+                'lot_number': lot.lot_number,
+                'quantity': str(lot.quantity),
+                'reorder_level': str(lot.product.reorder_level),
+                'unit_of_measure': lot.product.unit_of_measure,
+                'expiry_date': lot.expiry_date.isoformat(),
+            }
+            if lot.expiry_date < today:
+                digest['expired'].append(item)
+            else:
+                digest['expiring_soon'].append(item)
+
+        with transaction.atomic():
+            # Re-running the command on the same day replaces that day's digests
+            StockAlertDigest.objects.filter(generated_on=today, window_days=window_days).delete()
+            StockAlertDigest.objects.bulk_create([
+                StockAlertDigest(
+                    warehouse_id=warehouse_id,
+                    generated_on=today,
+                    window_days=window_days,
+                    low_stock_count=len(digest['low_stock']),
+                    # Counted in products, a product can have several lots expiring
+                    expiring_soon_count=len({item['id'] for item in digest['expiring_soon']}),
+                    expired_count=len({item['id'] for item in digest['expired']}),
+                    items={
+                        'low_stock': digest['low_stock'],
+                        'expiring_soon': digest['expiring_soon'],
+                        'expired': digest['expired'],
+                    },
+                )
+                for warehouse_id, digest in digests.items()
+            ])
+
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+            for warehouse_id, digest in digests.items():
+                filename = f"alerts_{today.strftime('%Y%m%d')}_{warehouse_id or 'unassigned'}.txt"
+                with open(os.path.join(output_dir, filename), 'w', encoding='utf-8') as f:
+                    f.write(self.format_digest(digest, today, window_days))
+
+        for warehouse_id, digest in digests.items():
+            self.stdout.write(
+                f"{digest['warehouse_name']}: {len(digest['low_stock'])} low stock, "
+                f"{len(digest['expiring_soon'])} expiring soon, {len(digest['expired'])} expired"
+            )
+
+        self.stdout.write(self.style.SUCCESS(f'Alert digests generated for {len(digests)} warehouse(s).'))
+
+    def low_stock_item(self, product, quantity):
+        return {
+            'id': product.id,
+            'sku': product.sku,
+            'name': product.name,
+            'quantity': str(quantity),
+            'reorder_level': str(product.reorder_level),
+            'unit_of_measure': product.unit_of_measure,
+            'expiry_date': product.expiry_date.isoformat() if product.expiry_date else None,
+        }
+
+    def format_digest(self, digest, today, window_days):
+        """Render a plain text digest for one warehouse"""
+        lines = [
+            f"Stock alerts for {digest['warehouse_name']} - {today.strftime('%B %d, %Y')}",
+            '',
+        ]
+
+        sections = (
+            ('Low stock', 'low_stock'),
+            (f'Expiring within {window_days} days', 'expiring_soon'),
+            ('Expired', 'expired'),
+        )
+        for title, key in sections:
+            items = digest[key]
+            lines.append(f'{title} ({len(items)})')
+            for item in items:
+                line = f"  {item['sku']} - {item['name']}: {item['quantity']} {item['unit_of_measure']}"
+                if key == 'low_stock':
+                    line += f" (reorder level {item['reorder_level']})"
+                elif item['expiry_date']:
+                    if item.get('lot_number'):
+                        line += f" lot {item['lot_number']}"
+                    line += f" (expires {item['expiry_date']})"
+                lines.append(line)
+            lines.append('')
+
+        return '\n'.join(lines)
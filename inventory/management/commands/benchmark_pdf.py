@@ -0,0 +1,95 @@
+import statistics
+import time
+
+from django.contrib.staticfiles import finders
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.models import Invoice
+from inventory.utils import render_pdf_bytes, resolve_static, warm_pdf_resources
+
+
+class Command(BaseCommand):
+    help = 'Time invoice PDF rendering with and without the per-process PDF resource cache.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--invoice',
+            type=int,
+            help='ID of the invoice to render (default: the latest invoice).',
+        )
+        parser.add_argument(
+            '--renders',
+            type=int,
+            default=20,
+            help='Number of timed renders (default: 20).',
+        )
+        parser.add_argument(
+            '--uri',
+            default='img/access-denied.png',
+            help='Static URI used to time path resolution (default: img/access-denied.png).',
+        )
+        parser.add_argument(
+            '--cold',
+            action='store_true',
+            help='Skip the worker warm-up, to time the first render of a fresh process.',
+        )
+
+    def handle(self, *args, **options):
+        renders = options['renders']
+        if renders < 1:
+            raise CommandError('--renders must be positive.')
+
+        invoices = Invoice.objects.select_related('client')
+        if options['invoice']:
+            invoice = invoices.filter(pk=options['invoice']).first()
+        else:
+            invoice = invoices.order_by('-id').first()
+        if invoice is None:
+            raise CommandError('No invoice to render.')
+
+        context = {
+            'invoice': invoice,
+            'company_name': 'QBITX IMS',
+            'company_tagline': 'Transform Suppliers',
+            'company_details': '123 Business Street, Business City, Country',
+            'terms_conditions': '',
+        }
+
+        if options['cold']:
+            self.stdout.write('Warm-up: skipped')
+        else:
+            started = time.perf_counter()
+            warm_pdf_resources()
+            self.stdout.write(f'Warm-up: {self._ms(time.perf_counter() - started)} (once per worker)')
+
+        started = time.perf_counter()
+        render_pdf_bytes('inventory/pdf/invoice_pdf.html', context)
+        self.stdout.write(f'First render: {self._ms(time.perf_counter() - started)}')
+
+        timings = []
+        for _ in range(renders):
+            started = time.perf_counter()
+            render_pdf_bytes('inventory/pdf/invoice_pdf.html', context)
+            timings.append(time.perf_counter() - started)
+        self.stdout.write(
+            f'Later renders: median {self._ms(statistics.median(timings))}, '
+            f'min {self._ms(min(timings))} over {renders}'
+        )
+
+        uri = options['uri']
+        lookups = 1000
+        started = time.perf_counter()
+        for _ in range(lookups):
+            finders.find(uri)
+        uncached = (time.perf_counter() - started) / lookups
+        resolve_static(uri)
+        started = time.perf_counter()
+        for _ in range(lookups):
+            resolve_static(uri)
+        cached = (time.perf_counter() - started) / lookups
+        self.stdout.write(
+            f'Resolving {uri}: {uncached * 1e6:.1f} us uncached, {cached * 1e6:.2f} us cached per lookup'
+        )
+
+    def _ms(self, seconds):
+        return f'{seconds * 1000:.1f} ms'
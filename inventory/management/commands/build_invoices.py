@@ -0,0 +1,53 @@
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.billing import BILLING_PERIODS, BillingConflict, build_consolidated_invoices
+from inventory.models import per_transaction_invoicing
+
+
+class Command(BaseCommand):
+    help = 'Bill uninvoiced sales on one consolidated invoice per client and period.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--period',
+            choices=BILLING_PERIODS,
+            help='Billing period (default: INVOICE_BILLING_PERIOD).',
+        )
+        parser.add_argument(
+            '--until',
+            help='Bill the periods that have ended by this date, YYYY-MM-DD (default: yesterday).',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only count the invoices that would be created.',
+        )
+
+    def handle(self, *args, **options):
+        period = options['period'] or getattr(settings, 'INVOICE_BILLING_PERIOD', 'month')
+        if period not in BILLING_PERIODS:
+            raise CommandError(f'Unknown billing period "{period}".')
+        until = None
+        if options['until']:
+            try:
+                until = datetime.strptime(options['until'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('--until must be a date in YYYY-MM-DD format.')
+
+        if per_transaction_invoicing():
+            self.stdout.write(self.style.WARNING(
+                'INVOICE_BILLING_MODE is per_transaction; only sales that have no invoice yet will be billed.'
+            ))
+
+        try:
+            invoices, sales = build_consolidated_invoices(period, until, dry_run=options['dry_run'])
+        except BillingConflict as exc:
+            raise CommandError(str(exc))
+
+        if options['dry_run']:
+            self.stdout.write(f'Would create {invoices} invoice(s) for {sales} sale(s).')
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Created {invoices} invoice(s) for {sales} sale(s).'))
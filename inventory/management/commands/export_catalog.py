@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.catalog import stream_catalog_csv
+from inventory.models import Product, Warehouse
+
+
+class Command(BaseCommand):
+    help = 'Export the product catalog as CSV in the format import_catalog reads.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output',
+            help='File to write to (default: standard output).',
+        )
+        parser.add_argument(
+            '--warehouse',
+            help='Only export products stocked in the warehouse with this name.',
+        )
+
+    def handle(self, *args, **options):
+        products = Product.objects.all()
+        if options.get('warehouse'):
+            warehouse = Warehouse.objects.filter(name__iexact=options['warehouse']).first()
+            if warehouse is None:
+                raise CommandError(f'Unknown warehouse "{options["warehouse"]}"')
+            products = products.filter(stock_levels__warehouse=warehouse)
+
+        output = options.get('output')
+        if not output:
+            for line in stream_catalog_csv(products):
+                self.stdout.write(line, ending='')
+            return
+
+        count = -1  # Don't count the header row
+        with open(output, 'w', newline='', encoding='utf-8') as f:
+            for line in stream_catalog_csv(products):
+                f.write(line)
+                count += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Exported {count} product(s) to {output}.'))
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.forms import InvoiceExportForm
+from inventory.invoice_export import export_invoices_zip
+from inventory.models import InvoiceExportJob
+
+
+class Command(BaseCommand):
+    help = 'Render the PDFs of a filtered set of invoices into one ZIP file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Path of the ZIP file to write.')
+        parser.add_argument('--start-date', help='Only invoices issued on or after this date (YYYY-MM-DD).')
+        parser.add_argument('--end-date', help='Only invoices issued on or before this date (YYYY-MM-DD).')
+        parser.add_argument('--client', type=int, help='Only invoices of the client with this ID.')
+        parser.add_argument('--status', help='Only invoices with this status (pending, paid or cancelled).')
+        parser.add_argument(
+            '--workers',
+            type=int,
+            help='Worker processes for rendering (default: INVOICE_EXPORT_WORKERS or the available cores).',
+        )
+
+    def handle(self, *args, **options):
+        form = InvoiceExportForm({
+            'start_date': options['start_date'],
+            'end_date': options['end_date'],
+            'client': options['client'],
+            'status': options['status'],
+        })
+        if not form.is_valid():
+            errors = '; '.join(f'{field}: {" ".join(messages)}' for field, messages in form.errors.items())
+            raise CommandError(f'Invalid filters: {errors}')
+        if options['workers'] is not None and options['workers'] < 1:
+            raise CommandError('--workers must be positive.')
+
+        invoices = form.filtered_invoices()
+        if not invoices.exists():
+            raise CommandError('No invoices match these filters.')
+
+        job = InvoiceExportJob.objects.create(filters=form.filters())
+        with open(options['output'], 'wb') as output:
+            for data in export_invoices_zip(job, invoices, workers=options['workers']):
+                output.write(data)
+                if job.total_invoices and options['verbosity'] > 1:
+                    self.stdout.write(f'{job.completed_invoices + job.failed_invoices}/{job.total_invoices}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {job.completed_invoices} invoice PDF(s) to {options["output"]} (export #{job.pk}).'
+        ))
+        if job.failed_invoices:
+            self.stdout.write(self.style.WARNING(f'{job.failed_invoices} invoice(s) could not be rendered.'))
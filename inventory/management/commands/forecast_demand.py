@@ -0,0 +1,98 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from inventory.forecasting import forecast_catalog
+from inventory.models import ReorderSuggestion
+
+
+class Command(BaseCommand):
+    help = 'Forecast daily demand per product from its sales and suggest reorder levels.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=365,
+            help='Days of sales history to use (default: 365).',
+        )
+        parser.add_argument(
+            '--window',
+            type=int,
+            default=28,
+            help='Moving average window in days (default: 28).',
+        )
+        parser.add_argument(
+            '--alpha',
+            type=float,
+            default=0.2,
+            help='Exponential smoothing factor between 0 and 1 (default: 0.2).',
+        )
+        parser.add_argument(
+            '--lead-time',
+            type=int,
+            default=7,
+            help='Supplier lead time in days (default: 7).',
+        )
+        parser.add_argument(
+            '--service-level',
+            type=float,
+            default=0.95,
+            help='Chance of not running out during the lead time, used for safety stock (default: 0.95).',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Compute the suggestions without saving them.',
+        )
+
+    def handle(self, *args, **options):
+        history_days = options['days']
+        window_days = options['window']
+        alpha = options['alpha']
+        lead_time_days = options['lead_time']
+        service_level = options['service_level']
+
+        if history_days < 1 or window_days < 1 or lead_time_days < 0:
+            raise CommandError('--days and --window must be positive and --lead-time not negative.')
+        if not 0 < alpha <= 1:
+            raise CommandError('--alpha must be between 0 and 1.')
+        if not 0 < service_level < 1:
+            raise CommandError('--service-level must be between 0 and 1.')
+
+        today = timezone.now().date()
+        start = today - timedelta(days=history_days - 1)
+
+        suggestions = [
+            ReorderSuggestion(
+                product_id=product_id,
+                generated_on=today,
+                history_days=history_days,
+                lead_time_days=lead_time_days,
+                service_level=round(service_level, 3),
+                **values,
+            )
+            for product_id, values in forecast_catalog(
+                start, history_days, min(window_days, history_days), alpha, lead_time_days, service_level
+            )
+        ]
+
+        if options['dry_run']:
+            for suggestion in suggestions[:20]:
+                self.stdout.write(
+                    f'Product {suggestion.product_id}: {suggestion.smoothed_daily_demand}/day, '
+                    f'reorder at {suggestion.suggested_reorder_level}'
+                )
+            self.stdout.write(f'Dry run: {len(suggestions)} suggestion(s) computed, nothing saved.')
+            return
+
+        with transaction.atomic():
+            # Products that stopped selling lose their old suggestion
+            ReorderSuggestion.objects.all().delete()
+            ReorderSuggestion.objects.bulk_create(suggestions, batch_size=2000)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Reorder levels suggested for {len(suggestions)} product(s) from {history_days} days of sales.'
+        ))
@@ -0,0 +1,48 @@
+import csv
+
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.catalog import CatalogImporter
+
+
+class Command(BaseCommand):
+    help = (
+        'Create or update products from a catalog CSV keyed by SKU. '
+        'Blank cells leave existing values alone; quantity only applies to new products.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file', help='Path to the catalog CSV (see export_catalog for the columns).')
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report what would change without writing anything.',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='Rows written per bulk_create/bulk_update batch (default: 1000).',
+        )
+
+    def handle(self, *args, **options):
+        importer = CatalogImporter(dry_run=options['dry_run'], chunk_size=options['chunk_size'])
+
+        try:
+            with open(options['csv_file'], newline='', encoding='utf-8-sig') as f:
+                report = importer.run(csv.DictReader(f))
+        except OSError as e:
+            raise CommandError(f'Could not read {options["csv_file"]}: {e}')
+
+        if options['verbosity'] > 1 or options['dry_run']:
+            for line, action, sku, warehouse_id, diff in report.changes:
+                if action == 'create':
+                    self.stdout.write(f'line {line}: create {sku}')
+                else:
+                    changes = ', '.join(f'{column}: {old!r} -> {new!r}' for column, (old, new) in diff.items())
+                    self.stdout.write(f'line {line}: update {sku} ({changes})')
+
+        for line, message in report.errors:
+            self.stdout.write(self.style.WARNING(f'line {line}: {message}'))
+
+        self.stdout.write(self.style.SUCCESS(report.summary()))
@@ -0,0 +1,88 @@
+import os
+import socketserver
+import stat
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.invoice_export import export_workers
+from inventory.pdf_service import recv_message, send_message, socket_path
+from inventory.utils import html_to_pdf_bytes, warm_pdf_resources
+
+
+class Command(BaseCommand):
+    help = 'Serve PDF layout for the web workers over a Unix socket (see PDF_RENDER_SOCKET).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--socket',
+            help='Path of the Unix socket to listen on (default: PDF_RENDER_SOCKET).',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            help='Layout processes (default: the available cores).',
+        )
+
+    def handle(self, *args, **options):
+        path = options['socket'] or socket_path()
+        if not path:
+            raise CommandError('Set PDF_RENDER_SOCKET or pass --socket.')
+        workers = options['workers'] or export_workers()
+        if workers < 1:
+            raise CommandError('--workers must be positive.')
+
+        # A socket left behind by a previous run would make the bind fail
+        if os.path.exists(path):
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise CommandError(f'{path} exists and is not a socket.')
+            os.unlink(path)
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=warm_pdf_resources) as pool:
+            # Start and warm every worker before accepting connections
+            list(pool.map(_worker_pid, range(workers)))
+
+            class Handler(socketserver.BaseRequestHandler):
+                def handle(self):
+                    try:
+                        html = recv_message(self.request).decode('utf-8')
+                    except (ConnectionError, UnicodeDecodeError):
+                        return
+                    try:
+                        pdf = pool.submit(html_to_pdf_bytes, html).result()
+                    except BrokenProcessPool:
+                        # A layout process died, so the pool takes no more work. Close
+                        # without a reply (the web worker lays the PDF out itself) and
+                        # stop, for the service manager to start a fresh server.
+                        self.server.pool_broken = True
+                        self.server.shutdown()
+                        return
+                    except Exception:
+                        pdf = None
+                    try:
+                        send_message(self.request, pdf or b'')
+                    except OSError:
+                        # The web worker gave up waiting
+                        pass
+
+            server = socketserver.ThreadingUnixStreamServer(path, Handler)
+            server.daemon_threads = True
+            server.pool_broken = False
+            os.chmod(path, 0o660)
+            self.stdout.write(f'Rendering PDFs on {path} with {workers} worker(s)')
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
+                if os.path.exists(path):
+                    os.unlink(path)
+            if server.pool_broken:
+                raise CommandError('A PDF layout process died; exiting so the server can be restarted.')
+
+
+def _worker_pid(_index):
+    # The pool initializer does the warming; this only makes each worker start
+    return os.getpid()
@@ -0,0 +1,84 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from inventory.models import KpiCounter, Product, Warehouse
+
+
+KPI_FIELDS = ('inventory_value', 'due_receivables', 'due_payables', 'low_stock_count')
+
+
+class Command(BaseCommand):
+    help = 'Compare the KPI counters against the source tables and repair any drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report drift, do not write the corrected values.',
+        )
+        parser.add_argument(
+            '--tolerance',
+            type=Decimal,
+            default=Decimal('0.01'),
+            help='Differences smaller than this are not reported as drift.',
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        tolerance = options['tolerance']
+
+        # The low stock flag is maintained in Product.save, so queryset updates can leave it stale
+        stale_flagged = Product.objects.filter(is_low_stock=False, quantity__lte=F('reorder_level'))
+        stale_cleared = Product.objects.filter(is_low_stock=True, quantity__gt=F('reorder_level'))
+        stale_flags = stale_flagged.count() + stale_cleared.count()
+        if stale_flags:
+            self.stdout.write(self.style.WARNING(f'{stale_flags} product(s) have a stale low stock flag.'))
+            if not dry_run:
+                stale_flagged.update(is_low_stock=True)
+                stale_cleared.update(is_low_stock=False)
+
+        actual = KpiCounter.compute_actual()
+        warehouse_names = dict(Warehouse.objects.values_list('id', 'name'))
+        stored = {counter.warehouse_id: counter for counter in KpiCounter.objects.all()}
+
+        # Warehouses without any counted data still need their rows zeroed
+        scopes = set(actual) | set(stored)
+        drifted = 0
+
+        with transaction.atomic():
+            for warehouse_id in sorted(scopes, key=lambda x: (x is not None, x or 0)):
+                if warehouse_id is not None and warehouse_id not in warehouse_names:
+                    continue
+
+                expected = actual.get(warehouse_id, {field: 0 for field in KPI_FIELDS})
+                counter = stored.get(warehouse_id)
+                label = warehouse_names.get(warehouse_id, 'Global')
+
+                differences = []
+                for field in KPI_FIELDS:
+                    current = getattr(counter, field) if counter else 0
+                    if abs(current - expected[field]) >= tolerance:
+                        differences.append(f'{field}: {current} -> {expected[field]}')
+
+                if not differences:
+                    continue
+
+                drifted += 1
+                self.stdout.write(self.style.WARNING(f'{label}: ' + ', '.join(differences)))
+
+                if not dry_run:
+                    KpiCounter.objects.update_or_create(
+                        warehouse_id=warehouse_id,
+                        defaults=dict(expected, updated_at=timezone.now()),
+                    )
+
+        if not drifted and not stale_flags:
+            self.stdout.write(self.style.SUCCESS('KPI counters are in sync.'))
+        elif dry_run:
+            self.stdout.write(self.style.WARNING(f'{drifted} KPI counter row(s) drifted. Run without --dry-run to repair.'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Repaired {drifted} KPI counter row(s).'))
@@ -0,0 +1,75 @@
+# Generated by Django 5.2.4 on 2026-10-19 02:04
+
+import django.db.models.deletion
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import F, Sum, ExpressionWrapper
+
+
+def seed_kpi_counters(apps, schema_editor):
+    """
+    Fill the KPI counters from the current product and transaction data so the
+    signal handlers start from correct totals.
+    """
+    Product = apps.get_model('inventory', 'Product')
+    StockTransaction = apps.get_model('inventory', 'StockTransaction')
+    KpiCounter = apps.get_model('inventory', 'KpiCounter')
+    
+    totals = defaultdict(lambda: {
+        'inventory_value': Decimal('0'),
+        'due_receivables': Decimal('0'),
+        'due_payables': Decimal('0'),
+    })
+    totals[None]
+    
+    value_rows = Product.objects.values('warehouse_id').annotate(
+        total=Sum(ExpressionWrapper(F('quantity') * F('buying_price'), output_field=models.DecimalField()))
+    ).order_by()
+    for row in value_rows:
+        total = row['total'] or Decimal('0')
+        totals[None]['inventory_value'] += total
+        if row['warehouse_id']:
+            totals[row['warehouse_id']]['inventory_value'] += total
+    
+    for transaction_type, field, warehouse_field in (
+        ('out', 'due_receivables', 'source_warehouse_id'),
+        ('in', 'due_payables', 'destination_warehouse_id'),
+    ):
+        due_rows = StockTransaction.objects.filter(
+            transaction_type=transaction_type,
+            payment_status__in=['due', 'partial']
+        ).values(warehouse_field).annotate(total=Sum('amount_due')).order_by()
+        for row in due_rows:
+            total = row['total'] or Decimal('0')
+            totals[None][field] += total
+            if row[warehouse_field]:
+                totals[row[warehouse_field]][field] += total
+    
+    KpiCounter.objects.bulk_create([
+        KpiCounter(warehouse_id=warehouse_id, **values)
+        for warehouse_id, values in totals.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0016_set_vat_rate_to_10'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KpiCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('inventory_value', models.DecimalField(decimal_places=5, default=0, max_digits=20)),
+                ('due_receivables', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('due_payables', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('warehouse', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='kpi_counter', to='inventory.warehouse')),
+            ],
+        ),
+        migrations.RunPython(seed_kpi_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 5.2.4 on 2026-10-19 02:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, F, Q
+
+
+def backfill_low_stock(apps, schema_editor):
+    """Set the low stock flag on existing products and seed the KPI low stock counts"""
+    Product = apps.get_model('inventory', 'Product')
+    KpiCounter = apps.get_model('inventory', 'KpiCounter')
+    
+    Product.objects.filter(quantity__lte=F('reorder_level')).update(is_low_stock=True)
+    
+    total = 0
+    rows = Product.objects.values('warehouse_id').annotate(
+        low_stock=Count('id', filter=Q(is_low_stock=True))
+    ).order_by()
+    for row in rows:
+        total += row['low_stock']
+        if row['warehouse_id']:
+            KpiCounter.objects.update_or_create(
+                warehouse_id=row['warehouse_id'],
+                defaults={'low_stock_count': row['low_stock']},
+            )
+    KpiCounter.objects.filter(warehouse__isnull=True).update(low_stock_count=total)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0017_kpicounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockAlertDigest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generated_on', models.DateField()),
+                ('window_days', models.PositiveIntegerField(default=30)),
+                ('low_stock_count', models.IntegerField(default=0)),
+                ('expiring_soon_count', models.IntegerField(default=0)),
+                ('expired_count', models.IntegerField(default=0)),
+                ('items', models.JSONField(blank=True, default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['-generated_on'],
+            },
+        ),
+        migrations.AddField(
+            model_name='kpicounter',
+            name='low_stock_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='is_low_stock',
+            field=models.BooleanField(db_index=True, default=False, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['expiry_date'], name='product_expiry_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['warehouse', 'is_low_stock'], name='product_wh_low_stock_idx'),
+        ),
+        migrations.AddField(
+            model_name='stockalertdigest',
+            name='warehouse',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='alert_digests', to='inventory.warehouse'),
+        ),
+        migrations.AddIndex(
+            model_name='stockalertdigest',
+            index=models.Index(fields=['generated_on', 'window_days'], name='alert_digest_date_idx'),
+        ),
+        migrations.RunPython(backfill_low_stock, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,113 @@
+from django.db import migrations
+
+# Each FTS row mirrors one product (rowid = product id) with the category and
+# supplier names copied in, so a single MATCH covers every searchable column.
+CREATE_SQL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS inventory_product_fts USING fts5(
+        name, sku, description, category, supplier,
+        tokenize = "unicode61 tokenchars '-_./'"
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS inventory_product_fts_ai
+    AFTER INSERT ON inventory_product BEGIN
+        INSERT INTO inventory_product_fts (rowid, name, sku, description, category, supplier)
+        VALUES (
+            new.id, new.name, new.sku, COALESCE(new.description, ''),
+            COALESCE((SELECT name FROM inventory_category WHERE id = new.category_id), ''),
+            COALESCE((SELECT name FROM inventory_supplier WHERE id = new.supplier_id), '')
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS inventory_product_fts_au
+    AFTER UPDATE OF name, sku, description, category_id, supplier_id ON inventory_product BEGIN
+        DELETE FROM inventory_product_fts WHERE rowid = old.id;
+        INSERT INTO inventory_product_fts (rowid, name, sku, description, category, supplier)
+        VALUES (
+            new.id, new.name, new.sku, COALESCE(new.description, ''),
+            COALESCE((SELECT name FROM inventory_category WHERE id = new.category_id), ''),
+            COALESCE((SELECT name FROM inventory_supplier WHERE id = new.supplier_id), '')
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS inventory_product_fts_ad
+    AFTER DELETE ON inventory_product BEGIN
+        DELETE FROM inventory_product_fts WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS inventory_category_fts_au
+    AFTER UPDATE OF name ON inventory_category BEGIN
+        UPDATE inventory_product_fts SET category = new.name
+        WHERE rowid IN (SELECT id FROM inventory_product WHERE category_id = new.id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS inventory_supplier_fts_au
+    AFTER UPDATE OF name ON inventory_supplier BEGIN
+        UPDATE inventory_product_fts SET supplier = new.name
+        WHERE rowid IN (SELECT id FROM inventory_product WHERE supplier_id = new.id);
+    END
+    """,
+    """
+    INSERT INTO inventory_product_fts (rowid, name, sku, description, category, supplier)
+    SELECT p.id, p.name, p.sku, COALESCE(p.description, ''),
+           COALESCE(c.name, ''), COALESCE(s.name, '')
+    FROM inventory_product p
+    LEFT JOIN inventory_category c ON c.id = p.category_id
+    LEFT JOIN inventory_supplier s ON s.id = p.supplier_id
+    """,
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS inventory_supplier_fts_au",
+    "DROP TRIGGER IF EXISTS inventory_category_fts_au",
+    "DROP TRIGGER IF EXISTS inventory_product_fts_ad",
+    "DROP TRIGGER IF EXISTS inventory_product_fts_au",
+    "DROP TRIGGER IF EXISTS inventory_product_fts_ai",
+    "DROP TABLE IF EXISTS inventory_product_fts",
+]
+
+
+def fts5_supported(connection):
+    """Check whether this SQLite build was compiled with FTS5"""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        if cursor.fetchone()[0]:
+            return True
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)")
+            cursor.execute("DROP TABLE temp.fts5_probe")
+        except Exception:
+            return False
+    return True
+
+
+def create_product_fts(apps, schema_editor):
+    """Build the FTS5 product index on SQLite; other backends use the icontains fallback"""
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite' or not fts5_supported(connection):
+        return
+    for statement in DROP_SQL + CREATE_SQL:
+        schema_editor.execute(statement)
+
+
+def drop_product_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in DROP_SQL:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0018_product_alert_flags'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_product_fts, drop_product_fts),
+    ]
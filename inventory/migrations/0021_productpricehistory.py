@@ -0,0 +1,37 @@
+# Generated by Django 5.2.4 on 2026-10-19 02:21
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0020_product_updated_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductPriceHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('buying_price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('selling_price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('previous_buying_price', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('previous_selling_price', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('source', models.CharField(choices=[('manual', 'Manual Edit'), ('reprice', 'Bulk Repricing'), ('import', 'Catalog Import'), ('initial', 'Initial Price')], default='manual', max_length=20)),
+                ('note', models.CharField(blank=True, max_length=255)),
+                ('changed_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('changed_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='price_changes', to=settings.AUTH_USER_MODEL)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='price_history', to='inventory.product')),
+            ],
+            options={
+                'verbose_name_plural': 'Product price history',
+                'ordering': ['-changed_at', '-id'],
+                'indexes': [models.Index(fields=['product', 'changed_at'], name='price_history_product_idx')],
+            },
+        ),
+    ]
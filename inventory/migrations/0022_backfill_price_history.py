@@ -0,0 +1,54 @@
+from django.db import migrations
+
+
+def backfill_initial_prices(apps, schema_editor):
+    """
+    Give every product an 'initial' history row at its creation time so as-of
+    lookups cover the whole life of the product. Products already repriced
+    start from the price before their first recorded change.
+    """
+    Product = apps.get_model('inventory', 'Product')
+    ProductPriceHistory = apps.get_model('inventory', 'ProductPriceHistory')
+    
+    first_change = {}
+    for product_id, buying_price, selling_price, source in ProductPriceHistory.objects.order_by(
+        'product_id', '-changed_at', '-id'
+    ).values_list('product_id', 'previous_buying_price', 'previous_selling_price', 'source'):
+        # Ordered newest first, so the last row seen per product is its earliest change
+        first_change[product_id] = (buying_price, selling_price, source)
+    
+    history = []
+    for product in Product.objects.only('id', 'buying_price', 'selling_price', 'created_at').iterator(chunk_size=2000):
+        buying_price, selling_price = product.buying_price, product.selling_price
+        earliest = first_change.get(product.id)
+        if earliest:
+            if earliest[2] == 'initial':
+                continue
+            if earliest[0] is not None:
+                buying_price, selling_price = earliest[0], earliest[1]
+        history.append(ProductPriceHistory(
+            product_id=product.id,
+            buying_price=buying_price,
+            selling_price=selling_price,
+            source='initial',
+            note='Backfilled',
+            changed_at=product.created_at,
+        ))
+    
+    ProductPriceHistory.objects.bulk_create(history, batch_size=1000)
+
+
+def remove_backfilled_prices(apps, schema_editor):
+    ProductPriceHistory = apps.get_model('inventory', 'ProductPriceHistory')
+    ProductPriceHistory.objects.filter(source='initial', note='Backfilled').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0021_productpricehistory'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_initial_prices, remove_backfilled_prices),
+    ]
@@ -0,0 +1,226 @@
+from collections import defaultdict
+from decimal import Decimal
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, F, Q, Sum, ExpressionWrapper
+
+# Each FTS row mirrors one product (rowid = product id) with the category and
+# supplier names copied in, so a single MATCH covers every searchable column.
+CREATE_SQL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS inventory_product_fts USING fts5(
+        name, sku, description, category, supplier,
+        tokenize = "unicode61 tokenchars '-_./'"
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS inventory_product_fts_ai
+    AFTER INSERT ON inventory_product BEGIN
+        INSERT INTO inventory_product_fts (rowid, name, sku, description, category, supplier)
+        VALUES (
+            new.id, new.name, new.sku, COALESCE(new.description, ''),
+            COALESCE((SELECT name FROM inventory_category WHERE id = new.category_id), ''),
+            COALESCE((SELECT name FROM inventory_supplier WHERE id = new.supplier_id), '')
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS inventory_product_fts_au
+    AFTER UPDATE OF name, sku, description, category_id, supplier_id ON inventory_product BEGIN
+        DELETE FROM inventory_product_fts WHERE rowid = old.id;
+        INSERT INTO inventory_product_fts (rowid, name, sku, description, category, supplier)
+        VALUES (
+            new.id, new.name, new.sku, COALESCE(new.description, ''),
+            COALESCE((SELECT name FROM inventory_category WHERE id = new.category_id), ''),
+            COALESCE((SELECT name FROM inventory_supplier WHERE id = new.supplier_id), '')
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS inventory_product_fts_ad
+    AFTER DELETE ON inventory_product BEGIN
+        DELETE FROM inventory_product_fts WHERE rowid = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS inventory_category_fts_au
+    AFTER UPDATE OF name ON inventory_category BEGIN
+        UPDATE inventory_product_fts SET category = new.name
+        WHERE rowid IN (SELECT id FROM inventory_product WHERE category_id = new.id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS inventory_supplier_fts_au
+    AFTER UPDATE OF name ON inventory_supplier BEGIN
+        UPDATE inventory_product_fts SET supplier = new.name
+        WHERE rowid IN (SELECT id FROM inventory_product WHERE supplier_id = new.id);
+    END
+    """,
+    """
+    INSERT INTO inventory_product_fts (rowid, name, sku, description, category, supplier)
+    SELECT p.id, p.name, p.sku, COALESCE(p.description, ''),
+           COALESCE(c.name, ''), COALESCE(s.name, '')
+    FROM inventory_product p
+    LEFT JOIN inventory_category c ON c.id = p.category_id
+    LEFT JOIN inventory_supplier s ON s.id = p.supplier_id
+    """,
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS inventory_supplier_fts_au",
+    "DROP TRIGGER IF EXISTS inventory_category_fts_au",
+    "DROP TRIGGER IF EXISTS inventory_product_fts_ad",
+    "DROP TRIGGER IF EXISTS inventory_product_fts_au",
+    "DROP TRIGGER IF EXISTS inventory_product_fts_ai",
+    "DROP TABLE IF EXISTS inventory_product_fts",
+]
+
+
+def fts5_supported(connection):
+    """Check whether this SQLite build was compiled with FTS5"""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        if cursor.fetchone()[0]:
+            return True
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)")
+            cursor.execute("DROP TABLE temp.fts5_probe")
+        except Exception:
+            return False
+    return True
+
+
+def merge_duplicate_skus(apps, schema_editor):
+    """
+    Fold the per-warehouse copies of each SKU into its oldest product row.
+    Every copy's quantity becomes a ProductStock row for its warehouse, and
+    transactions and invoice lines are pointed at the surviving product.
+    """
+    Product = apps.get_model('inventory', 'Product')
+    ProductStock = apps.get_model('inventory', 'ProductStock')
+    StockTransaction = apps.get_model('inventory', 'StockTransaction')
+    InvoiceItem = apps.get_model('inventory', 'InvoiceItem')
+    ProductPriceHistory = apps.get_model('inventory', 'ProductPriceHistory')
+
+    survivors = {}
+    duplicates = defaultdict(list)
+    totals = defaultdict(Decimal)
+    levels = defaultdict(Decimal)
+
+    rows = Product.objects.order_by('sku', 'id').values_list('id', 'sku', 'warehouse_id', 'quantity')
+    for product_id, sku, warehouse_id, quantity in rows.iterator(chunk_size=2000):
+        survivor_id = survivors.setdefault(sku, product_id)
+        totals[survivor_id] += quantity
+        if warehouse_id:
+            levels[(survivor_id, warehouse_id)] += quantity
+        if product_id != survivor_id:
+            duplicates[survivor_id].append(product_id)
+
+    for survivor_id, duplicate_ids in duplicates.items():
+        StockTransaction.objects.filter(product_id__in=duplicate_ids).update(product_id=survivor_id)
+        InvoiceItem.objects.filter(product_id__in=duplicate_ids).update(product_id=survivor_id)
+        # The surviving row's price history describes the merged product
+        ProductPriceHistory.objects.filter(product_id__in=duplicate_ids).delete()
+        Product.objects.filter(id__in=duplicate_ids).delete()
+
+        survivor = Product.objects.get(id=survivor_id)
+        survivor.quantity = totals[survivor_id]
+        survivor.is_low_stock = survivor.quantity <= survivor.reorder_level
+        survivor.save(update_fields=['quantity', 'is_low_stock'])
+
+    ProductStock.objects.bulk_create(
+        [
+            ProductStock(product_id=product_id, warehouse_id=warehouse_id, quantity=quantity)
+            for (product_id, warehouse_id), quantity in levels.items()
+        ],
+        batch_size=1000,
+    )
+
+
+def reseed_inventory_kpis(apps, schema_editor):
+    """Warehouse inventory value and low stock counts now come from the stock levels"""
+    Product = apps.get_model('inventory', 'Product')
+    ProductStock = apps.get_model('inventory', 'ProductStock')
+    KpiCounter = apps.get_model('inventory', 'KpiCounter')
+
+    totals = defaultdict(lambda: {'inventory_value': Decimal('0'), 'low_stock_count': 0})
+    product_totals = Product.objects.aggregate(
+        total=Sum(ExpressionWrapper(F('quantity') * F('buying_price'), output_field=models.DecimalField())),
+        low_stock=Count('id', filter=Q(quantity__lte=F('reorder_level'))),
+    )
+    totals[None] = {'inventory_value': product_totals['total'] or Decimal('0'), 'low_stock_count': product_totals['low_stock']}
+
+    stock_rows = ProductStock.objects.values('warehouse_id').annotate(
+        total=Sum(ExpressionWrapper(F('quantity') * F('product__buying_price'), output_field=models.DecimalField())),
+        low_stock=Count('id', filter=Q(quantity__lte=F('product__reorder_level'))),
+    ).order_by()
+    for row in stock_rows:
+        totals[row['warehouse_id']] = {'inventory_value': row['total'] or Decimal('0'), 'low_stock_count': row['low_stock']}
+
+    KpiCounter.objects.update(inventory_value=0, low_stock_count=0)
+    for warehouse_id, values in totals.items():
+        if not KpiCounter.objects.filter(warehouse_id=warehouse_id).update(**values):
+            KpiCounter.objects.create(warehouse_id=warehouse_id, **values)
+
+
+def drop_product_fts(apps, schema_editor):
+    # SQLite rebuilds the product table for the constraint changes below, and
+    # the category/supplier FTS triggers would block its rename
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in DROP_SQL:
+        schema_editor.execute(statement)
+
+
+def reinstall_product_fts(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite' or not fts5_supported(connection):
+        return
+    for statement in DROP_SQL + CREATE_SQL:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0022_backfill_price_history'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_product_fts, reinstall_product_fts),
+        migrations.CreateModel(
+            name='ProductStock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.DecimalField(decimal_places=3, default=0, max_digits=10)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_levels', to='inventory.product')),
+                ('warehouse', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='stock_levels', to='inventory.warehouse')),
+            ],
+            options={
+                'indexes': [
+                    models.Index(fields=['warehouse', 'product'], name='product_stock_wh_idx'),
+                    models.Index(fields=['updated_at'], name='product_stock_updated_idx'),
+                ],
+                'unique_together': {('product', 'warehouse')},
+            },
+        ),
+        migrations.RunPython(merge_duplicate_skus, migrations.RunPython.noop),
+        migrations.RunPython(reseed_inventory_kpis, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='product',
+            unique_together=set(),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='sku',
+            field=models.CharField(max_length=50, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='warehouse',
+            field=models.ForeignKey(blank=True, help_text='Home warehouse: receives stock when no other warehouse is given', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='products', to='inventory.warehouse'),
+        ),
+        migrations.RunPython(reinstall_product_fts, drop_product_fts),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 5.2.4 on 2026-10-19 02:40
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def open_lots_from_stock_levels(apps, schema_editor):
+    """Each existing stock level becomes one opening lot with the product's shipment number and expiry"""
+    ProductStock = apps.get_model('inventory', 'ProductStock')
+    StockLot = apps.get_model('inventory', 'StockLot')
+
+    levels = ProductStock.objects.filter(quantity__gt=0).values_list(
+        'product_id', 'warehouse_id', 'quantity', 'product__shipment_number', 'product__expiry_date', 'product__created_at'
+    )
+    lots = []
+    for product_id, warehouse_id, quantity, shipment_number, expiry_date, created_at in levels.iterator(chunk_size=2000):
+        lots.append(StockLot(
+            product_id=product_id, warehouse_id=warehouse_id, lot_number=shipment_number or '', expiry_date=expiry_date,
+            quantity=quantity, received_quantity=quantity, received_at=created_at,
+        ))
+        if len(lots) >= 1000:
+            StockLot.objects.bulk_create(lots)
+            lots = []
+    StockLot.objects.bulk_create(lots)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0023_productstock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stocktransaction',
+            name='expiry_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stocktransaction',
+            name='lot_number',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.CreateModel(
+            name='StockLot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lot_number', models.CharField(blank=True, max_length=100)),
+                ('expiry_date', models.DateField(blank=True, null=True)),
+                ('quantity', models.DecimalField(decimal_places=3, default=0, max_digits=10)),
+                ('received_quantity', models.DecimalField(decimal_places=3, default=0, max_digits=10)),
+                ('received_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lots', to='inventory.product')),
+                ('stock_transaction', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='received_lots', to='inventory.stocktransaction')),
+                ('warehouse', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='lots', to='inventory.warehouse')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StockLotAllocation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.DecimalField(decimal_places=3, max_digits=10)),
+                ('lot', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='allocations', to='inventory.stocklot')),
+                ('stock_transaction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lot_allocations', to='inventory.stocktransaction')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='stocklot',
+            index=models.Index(fields=['product', 'expiry_date'], name='stock_lot_product_expiry_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stocklot',
+            index=models.Index(condition=models.Q(('quantity__gt', 0)), fields=['expiry_date'], name='stock_lot_open_expiry_idx'),
+        ),
+        migrations.RunPython(open_lots_from_stock_levels, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 5.2.4 on 2026-10-19 02:44
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F, ExpressionWrapper
+
+
+def open_cost_layers(apps, schema_editor):
+    """
+    Stock on hand becomes one opening layer per product at its buying price,
+    and past issues keep the cost their profit was worked out with.
+    """
+    Product = apps.get_model('inventory', 'Product')
+    CostLayer = apps.get_model('inventory', 'CostLayer')
+    StockTransaction = apps.get_model('inventory', 'StockTransaction')
+
+    products = Product.objects.filter(quantity__gt=0).values_list('id', 'quantity', 'buying_price', 'created_at')
+    layers = []
+    for product_id, quantity, buying_price, created_at in products.iterator(chunk_size=2000):
+        layers.append(CostLayer(
+            product_id=product_id, unit_cost=buying_price, quantity=quantity, received_quantity=quantity, received_at=created_at,
+        ))
+        if len(layers) >= 1000:
+            CostLayer.objects.bulk_create(layers)
+            layers = []
+    CostLayer.objects.bulk_create(layers)
+
+    StockTransaction.objects.filter(transaction_type='out').update(
+        cost_of_goods=ExpressionWrapper(F('quantity') * F('buying_price'), output_field=models.DecimalField())
+    )
+    StockTransaction.objects.filter(transaction_type='wastage').update(cost_of_goods=F('total_price'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0024_stock_lots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stocktransaction',
+            name='cost_of_goods',
+            field=models.DecimalField(decimal_places=2, default=0, help_text="Cost of the stock issued, from the product's cost layers (stock out and wastage)", max_digits=10),
+        ),
+        migrations.CreateModel(
+            name='CostLayer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.DecimalField(decimal_places=3, default=0, max_digits=10)),
+                ('received_quantity', models.DecimalField(decimal_places=3, default=0, max_digits=10)),
+                ('received_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('unit_cost', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cost_layers', to='inventory.product')),
+                ('stock_transaction', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='cost_layers', to='inventory.stocktransaction')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CostLayerAllocation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.DecimalField(decimal_places=3, max_digits=10)),
+                ('layer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='allocations', to='inventory.costlayer')),
+                ('stock_transaction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cost_allocations', to='inventory.stocktransaction')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='costlayer',
+            index=models.Index(condition=models.Q(('quantity__gt', 0)), fields=['product', 'received_at', 'id'], name='cost_layer_open_idx'),
+        ),
+        migrations.RunPython(open_cost_layers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.4 on 2026-10-19 02:52
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0025_cost_layers'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReorderSuggestion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generated_on', models.DateField()),
+                ('history_days', models.PositiveIntegerField()),
+                ('lead_time_days', models.PositiveIntegerField()),
+                ('service_level', models.DecimalField(decimal_places=3, max_digits=4)),
+                ('average_daily_demand', models.DecimalField(decimal_places=3, help_text='Moving average over the recent window', max_digits=12)),
+                ('smoothed_daily_demand', models.DecimalField(decimal_places=3, help_text='Exponentially smoothed over the whole history', max_digits=12)),
+                ('demand_std_dev', models.DecimalField(decimal_places=3, max_digits=12)),
+                ('safety_stock', models.DecimalField(decimal_places=3, max_digits=12)),
+                ('suggested_reorder_level', models.DecimalField(decimal_places=3, max_digits=12)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='stocktransaction',
+            index=models.Index(fields=['transaction_type', 'transaction_date'], name='stock_txn_type_date_idx'),
+        ),
+        migrations.AddField(
+            model_name='reordersuggestion',
+            name='product',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='reorder_suggestion', to='inventory.product'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.4 on 2026-10-19 03:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0027_invoice_export_jobs'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PdfRenderTiming',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('report_type', models.CharField(max_length=30)),
+                ('backend', models.CharField(max_length=20)),
+                ('total_ms', models.FloatField(default=0)),
+                ('db_ms', models.FloatField(default=0)),
+                ('template_ms', models.FloatField(default=0)),
+                ('layout_ms', models.FloatField(default=0)),
+                ('merge_ms', models.FloatField(default=0)),
+                ('queries', models.PositiveIntegerField(default=0)),
+                ('size_bytes', models.PositiveIntegerField(default=0)),
+                ('pages', models.PositiveIntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['created_at', 'report_type'], name='pdf_timing_created_idx')],
+            },
+        ),
+    ]
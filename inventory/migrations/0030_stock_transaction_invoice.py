@@ -0,0 +1,39 @@
+# Generated by Django 5.2.4 on 2026-10-19 03:32
+
+import re
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+REFERENCE = re.compile(r'^TRANS-(\d+)\b')
+
+
+def link_invoiced_transactions(apps, schema_editor):
+    """
+    Point sales at the invoices generated for them so far, which refer to
+    their transaction only as "TRANS-<id>" at the start of the notes.
+    """
+    Invoice = apps.get_model('inventory', 'Invoice')
+    StockTransaction = apps.get_model('inventory', 'StockTransaction')
+    
+    invoices = Invoice.objects.filter(notes__startswith='TRANS-').order_by('id').values_list('id', 'notes')
+    for invoice_id, notes in invoices.iterator(chunk_size=2000):
+        match = REFERENCE.match(notes)
+        if match:
+            StockTransaction.objects.filter(pk=int(match.group(1)), invoice__isnull=True).update(invoice_id=invoice_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0029_invoice_sequences'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stocktransaction',
+            name='invoice',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stock_transactions', to='inventory.invoice'),
+        ),
+        migrations.RunPython(link_invoiced_transactions, migrations.RunPython.noop),
+    ]
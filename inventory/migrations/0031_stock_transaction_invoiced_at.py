@@ -0,0 +1,30 @@
+# Generated by Django 5.2.4 on 2026-10-19 03:45
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_invoiced_at(apps, schema_editor):
+    """Sales already on an invoice were invoiced when that invoice was created"""
+    Invoice = apps.get_model('inventory', 'Invoice')
+    StockTransaction = apps.get_model('inventory', 'StockTransaction')
+
+    StockTransaction.objects.filter(invoice__isnull=False).update(
+        invoiced_at=Subquery(Invoice.objects.filter(pk=OuterRef('invoice_id')).values('created_at')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0030_stock_transaction_invoice'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stocktransaction',
+            name='invoiced_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_invoiced_at, migrations.RunPython.noop),
+    ]
@@ -1,11 +1,15 @@
-from django.db import models
+from django.db import models, transaction as db_transaction
+from django.db.models import F, Q, Sum, Count, ExpressionWrapper, OuterRef, Subquery, Case, When, Value
 from django.contrib.auth.models import User, Permission
 from django.contrib.contenttypes.models import ContentType
 from django.db.models.signals import post_migrate
 from django.dispatch import receiver
-from decimal import Decimal
+from decimal import Decimal, ROUND_HALF_UP
+from django.conf import settings
 from django.utils import timezone
 from django.core.exceptions import ValidationError
+from collections import defaultdict
+import statistics
 
 class Category(models.Model):
     name = models.CharField(max_length=100)
@@ -61,38 +65,498 @@ class Client(models.Model):
 
 class Product(models.Model):
     name = models.CharField(max_length=200)
-    sku = models.CharField(max_length=50)  # Removed unique=True
+    sku = models.CharField(max_length=50, unique=True)
     category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, related_name='products')
     description = models.TextField(blank=True, null=True)
     buying_price = models.DecimalField(max_digits=10, decimal_places=2)
     selling_price = models.DecimalField(max_digits=10, decimal_places=2)
     unit_of_measure = models.CharField(max_length=50)  # UOM
+    # Total across all warehouses; the per-warehouse split lives in ProductStock
     quantity = models.DecimalField(max_digits=10, decimal_places=3, default=0)
     reorder_level = models.DecimalField(max_digits=10, decimal_places=3, default=10)
     shipment_number = models.CharField(max_length=100, blank=True, null=True)
     location = models.CharField(max_length=100, blank=True, null=True)
-    warehouse = models.ForeignKey(Warehouse, on_delete=models.SET_NULL, null=True, blank=True, related_name='products')
+    warehouse = models.ForeignKey(Warehouse, on_delete=models.SET_NULL, null=True, blank=True, related_name='products',
+                                  help_text="Home warehouse: receives stock when no other warehouse is given")
     expiry_date = models.DateField(blank=True, null=True)
     supplier = models.ForeignKey(Supplier, on_delete=models.SET_NULL, null=True, related_name='products')
+    # Maintained in save() so low stock lookups can use an index instead of comparing two columns
+    is_low_stock = models.BooleanField(default=False, db_index=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
-        # Same SKU can exist in different warehouses
-        unique_together = [['sku', 'warehouse']]
+        indexes = [
+            models.Index(fields=['expiry_date'], name='product_expiry_idx'),
+            models.Index(fields=['warehouse', 'is_low_stock'], name='product_wh_low_stock_idx'),
+            models.Index(fields=['updated_at'], name='product_updated_idx'),
+        ]
     
     def __str__(self):
         return self.name
     
+    def save(self, *args, **kwargs):
+        # Keep the low stock flag in sync with quantity and reorder level
+        self.is_low_stock = Decimal(str(self.quantity or 0)) <= Decimal(str(self.reorder_level or 0))
+        
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'quantity', 'reorder_level'} & set(update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'is_low_stock'}
+        
+        super().save(*args, **kwargs)
+    
     @property
     def profit_margin(self):
         if self.buying_price > 0:
             return ((self.selling_price - self.buying_price) / self.buying_price) * 100
         return 0
     
-    @property
-    def is_low_stock(self):
-        return self.quantity <= self.reorder_level
+    def kpi_contribution(self):
+        """
+        Return (warehouse_id, inventory_value, low_stock_count) this product
+        adds to the KPI counters. Products only count towards the global
+        totals; the warehouse counters are fed by their ProductStock rows.
+        """
+        return (
+            None,
+            Decimal(str(self.quantity or 0)) * Decimal(str(self.buying_price or 0)),
+            1 if self.is_low_stock else 0,
+        )
+
+class ProductStock(models.Model):
+    """
+    On-hand quantity of a product in one warehouse. Product.quantity is the
+    total across these rows (plus any stock that has no warehouse).
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_levels')
+    warehouse = models.ForeignKey(Warehouse, on_delete=models.PROTECT, related_name='stock_levels')
+    quantity = models.DecimalField(max_digits=10, decimal_places=3, default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        unique_together = [['product', 'warehouse']]
+        indexes = [
+            models.Index(fields=['warehouse', 'product'], name='product_stock_wh_idx'),
+            models.Index(fields=['updated_at'], name='product_stock_updated_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.product} @ {self.warehouse}: {self.quantity}"
+    
+    @staticmethod
+    def kpi_values(quantity, buying_price, reorder_level):
+        """Return (inventory_value, low_stock_count) a stock level adds to its warehouse's counter"""
+        quantity = Decimal(str(quantity or 0))
+        return (
+            quantity * Decimal(str(buying_price or 0)),
+            1 if quantity <= Decimal(str(reorder_level or 0)) else 0,
+        )
+    
+    @classmethod
+    def _apply_kpi_change(cls, product, warehouse_id, old_quantity, new_quantity):
+        old_value, old_low = cls.kpi_values(old_quantity, product.buying_price, product.reorder_level) if old_quantity is not None else (0, 0)
+        new_value, new_low = cls.kpi_values(new_quantity, product.buying_price, product.reorder_level)
+        KpiCounter.apply_delta(
+            warehouse_id, inventory_value=new_value - old_value, low_stock_count=new_low - old_low, include_global=False
+        )
+    
+    @classmethod
+    def adjust(cls, product, warehouse_id, delta):
+        """Add delta to a product's quantity in a warehouse, creating the row on first use"""
+        delta = Decimal(str(delta))
+        with db_transaction.atomic():
+            levels = cls.objects.select_for_update().filter(product=product, warehouse_id=warehouse_id)
+            old_quantity = levels.values_list('quantity', flat=True).first()
+            if old_quantity is None:
+                cls.objects.create(product=product, warehouse_id=warehouse_id, quantity=delta)
+            else:
+                cls.objects.filter(product=product, warehouse_id=warehouse_id).update(
+                    quantity=F('quantity') + delta, updated_at=timezone.now()
+                )
+            cls._apply_kpi_change(product, warehouse_id, old_quantity, (old_quantity or 0) + delta)
+    
+    @classmethod
+    def transfer(cls, product, source_id, destination_id, quantity):
+        """
+        Move stock between warehouses: a guarded decrement of the source row
+        and an increment (or insert) of the destination row. The product's
+        total does not change, so its row is left alone.
+        """
+        quantity = Decimal(str(quantity))
+        now = timezone.now()
+        with db_transaction.atomic():
+            levels = dict(
+                cls.objects.select_for_update()
+                .filter(product=product, warehouse_id__in=[source_id, destination_id])
+                .values_list('warehouse_id', 'quantity')
+            )
+            moved = cls.objects.filter(
+                product=product, warehouse_id=source_id, quantity__gte=quantity
+            ).update(quantity=F('quantity') - quantity, updated_at=now)
+            if not moved:
+                available = levels.get(source_id, Decimal('0'))
+                raise ValidationError(f"Not enough quantity in source warehouse. Available: {available}, Requested: {quantity}")
+            
+            if destination_id in levels:
+                cls.objects.filter(product=product, warehouse_id=destination_id).update(
+                    quantity=F('quantity') + quantity, updated_at=now
+                )
+            else:
+                cls.objects.create(product=product, warehouse_id=destination_id, quantity=quantity)
+            
+            cls._apply_kpi_change(product, source_id, levels[source_id], levels[source_id] - quantity)
+            cls._apply_kpi_change(product, destination_id, levels.get(destination_id), levels.get(destination_id, 0) + quantity)
+    
+    @classmethod
+    def available(cls, product, warehouse_id):
+        """Quantity of a product on hand in one warehouse"""
+        quantity = cls.objects.filter(product=product, warehouse_id=warehouse_id).values_list('quantity', flat=True).first()
+        return quantity or Decimal('0')
+    
+    @classmethod
+    def revalue(cls, product, old_buying_price, old_reorder_level):
+        """Update the warehouse counters after a product's buying price or reorder level changed"""
+        for warehouse_id, quantity in cls.objects.filter(product=product).values_list('warehouse_id', 'quantity'):
+            old_value, old_low = cls.kpi_values(quantity, old_buying_price, old_reorder_level)
+            new_value, new_low = cls.kpi_values(quantity, product.buying_price, product.reorder_level)
+            KpiCounter.apply_delta(
+                warehouse_id, inventory_value=new_value - old_value, low_stock_count=new_low - old_low, include_global=False
+            )
+    
+    @classmethod
+    def totals_by_warehouse(cls, products=None):
+        """Return {warehouse_id: total quantity} with a single grouped query"""
+        levels = cls.objects.all() if products is None else cls.objects.filter(product__in=products)
+        return dict(levels.values('warehouse_id').annotate(total=Sum('quantity')).values_list('warehouse_id', 'total').order_by())
+
+class ReceivedStock(models.Model):
+    """
+    Stock received in one go that later issues are taken from in a fixed
+    order: the common part of stock lots (FEFO) and cost layers (FIFO).
+    quantity is what is left; subclasses have an allocation model (reverse
+    name 'allocations') recording what each transaction took.
+    """
+    # Open rows are read this many at a time when allocating an issue
+    ALLOCATION_BATCH = 20
+    
+    quantity = models.DecimalField(max_digits=10, decimal_places=3, default=0)
+    received_quantity = models.DecimalField(max_digits=10, decimal_places=3, default=0)
+    received_at = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        abstract = True
+    
+    @classmethod
+    def _allocation_field(cls):
+        """The allocation model's foreign key to this model"""
+        return cls._meta.get_field('allocations').field
+    
+    @classmethod
+    def _take(cls, batches, quantity, stock_transaction=None):
+        """
+        Take quantity from the given rows in their queryset order. Rows are
+        locked and read a batch at a time, so an issue only touches the few
+        rows it needs; fully used rows are zeroed in one UPDATE and the last,
+        partly used row in another. Returns [(row, taken)] and the quantity
+        the rows could not cover.
+        """
+        remaining = Decimal(str(quantity))
+        taken = []
+        batches = batches.select_for_update()
+        offset = 0
+        while remaining > 0:
+            batch = list(batches[offset:offset + cls.ALLOCATION_BATCH])
+            for row in batch:
+                used = min(row.quantity, remaining)
+                taken.append((row, used))
+                remaining -= used
+                if remaining <= 0:
+                    break
+            if len(batch) < cls.ALLOCATION_BATCH:
+                break
+            offset += cls.ALLOCATION_BATCH
+        
+        emptied = [row.pk for row, used in taken if used == row.quantity]
+        if emptied:
+            cls.objects.filter(pk__in=emptied).update(quantity=0)
+        for row, used in taken:
+            if used != row.quantity:
+                cls.objects.filter(pk=row.pk).update(quantity=F('quantity') - used)
+        if stock_transaction is not None and taken:
+            field = cls._allocation_field()
+            field.model.objects.bulk_create([
+                field.model(**{field.name: row, 'stock_transaction': stock_transaction, 'quantity': used})
+                for row, used in taken
+            ])
+        return taken, remaining
+    
+    @classmethod
+    def release(cls, stock_transaction):
+        """Put the quantities a transaction took back where they came from"""
+        field = cls._allocation_field()
+        allocations = field.model.objects.filter(stock_transaction=stock_transaction)
+        taken = list(allocations.values_list(field.attname, 'quantity'))
+        if not taken:
+            return
+        with db_transaction.atomic():
+            cls.objects.filter(pk__in=[pk for pk, _ in taken]).update(
+                quantity=F('quantity') + Case(
+                    *[When(pk=pk, then=Value(quantity)) for pk, quantity in taken],
+                    output_field=models.DecimalField(max_digits=10, decimal_places=3),
+                )
+            )
+            allocations.delete()
+
+class StockLot(ReceivedStock):
+    """
+    A batch of a product received into a warehouse with its own lot number
+    and expiry. Stock leaving the warehouse is taken from the open lots
+    first-expiry-first-out (FEFO).
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='lots')
+    warehouse = models.ForeignKey(Warehouse, on_delete=models.PROTECT, related_name='lots')
+    lot_number = models.CharField(max_length=100, blank=True)
+    expiry_date = models.DateField(null=True, blank=True)
+    stock_transaction = models.ForeignKey('StockTransaction', on_delete=models.SET_NULL, null=True, blank=True, related_name='received_lots')
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'expiry_date'], name='stock_lot_product_expiry_idx'),
+            # Expiry reports only look at lots with stock left
+            models.Index(fields=['expiry_date'], name='stock_lot_open_expiry_idx', condition=Q(quantity__gt=0)),
+        ]
+    
+    def __str__(self):
+        return f"{self.product} lot {self.lot_number or self.pk} @ {self.warehouse}: {self.quantity}"
+    
+    @classmethod
+    def open_lots(cls):
+        return cls.objects.filter(quantity__gt=0)
+    
+    @classmethod
+    def expiring_between(cls, start, end, warehouse_id=None):
+        """Open lots expiring in [start, end], read off the expiry index"""
+        lots = cls.open_lots().filter(expiry_date__gte=start, expiry_date__lte=end)
+        if warehouse_id is not None:
+            lots = lots.filter(warehouse_id=warehouse_id)
+        return lots
+    
+    @classmethod
+    def receive(cls, product, warehouse_id, quantity, lot_number='', expiry_date=None, stock_transaction=None):
+        """Open a new lot for stock received into a warehouse"""
+        quantity = Decimal(str(quantity))
+        return cls.objects.create(
+            product=product,
+            warehouse_id=warehouse_id,
+            lot_number=lot_number or '',
+            expiry_date=expiry_date,
+            quantity=quantity,
+            received_quantity=quantity,
+            received_at=stock_transaction.transaction_date if stock_transaction else timezone.now(),
+            stock_transaction=stock_transaction,
+        )
+    
+    @classmethod
+    def consume(cls, product, warehouse_id, quantity, stock_transaction=None):
+        """
+        Issue stock from a warehouse first-expiry-first-out: lots without an
+        expiry go last, ties go to the oldest receipt. Stock beyond the open
+        lots (e.g. received before lots were tracked) is issued unlotted.
+        """
+        lots = cls.open_lots().filter(product=product, warehouse_id=warehouse_id).order_by(
+            F('expiry_date').asc(nulls_last=True), 'received_at', 'id'
+        )
+        with db_transaction.atomic():
+            taken, _ = cls._take(lots, quantity, stock_transaction)
+        return taken
+    
+    @classmethod
+    def book(cls, product, warehouse_id, delta, source=None):
+        """
+        Book a change of a product's stock in a warehouse against its lots
+        (called from the stock level signal). source is the stock transaction
+        behind the change, if any: a receipt opens a lot with its lot number
+        and expiry, an issue is allocated FEFO, and reverting a transaction
+        undoes exactly what it did to the lots.
+        """
+        delta = Decimal(str(delta))
+        source_type = source.transaction_type if source is not None else None
+        if delta > 0:
+            if source_type in ('out', 'wastage'):
+                # Deleting an issue puts the stock back into the lots it came from
+                cls.release(source)
+                return
+            cls.receive(
+                product,
+                warehouse_id,
+                delta,
+                lot_number=(source.lot_number or source.transaction_id) if source else product.shipment_number,
+                expiry_date=(source.expiry_date if source else None) or product.expiry_date,
+                stock_transaction=source,
+            )
+        elif delta < 0:
+            with db_transaction.atomic():
+                if source_type in ('in', 'return'):
+                    # Deleting a receipt takes back what is left of its own lots first
+                    received = cls.open_lots().filter(stock_transaction=source, warehouse_id=warehouse_id).order_by('id')
+                    _, remaining = cls._take(received, -delta)
+                    if remaining > 0:
+                        cls.consume(product, warehouse_id, remaining)
+                else:
+                    cls.consume(product, warehouse_id, -delta, stock_transaction=source)
+    
+    @classmethod
+    def transfer(cls, product, source_id, destination_id, quantity, stock_transaction=None):
+        """Move lots FEFO to another warehouse, keeping their lot numbers and expiries"""
+        with db_transaction.atomic():
+            taken = cls.consume(product, source_id, quantity, stock_transaction=stock_transaction)
+            cls.objects.bulk_create([
+                cls(
+                    product=product,
+                    warehouse_id=destination_id,
+                    lot_number=lot.lot_number,
+                    expiry_date=lot.expiry_date,
+                    quantity=used,
+                    received_quantity=used,
+                    received_at=lot.received_at,
+                    stock_transaction=stock_transaction,
+                )
+                for lot, used in taken
+            ])
+    
+    @classmethod
+    def revert_transfer(cls, stock_transaction):
+        """Undo transfer(): take the moved lots back out of the destination and restore the source lots"""
+        with db_transaction.atomic():
+            received = cls.open_lots().filter(
+                stock_transaction=stock_transaction, warehouse_id=stock_transaction.destination_warehouse_id
+            ).order_by('id')
+            moved = stock_transaction.lot_allocations.aggregate(total=Sum('quantity'))['total'] or Decimal('0')
+            _, remaining = cls._take(received, moved)
+            if remaining > 0:
+                cls.consume(stock_transaction.product, stock_transaction.destination_warehouse_id, remaining)
+            cls.release(stock_transaction)
+
+class StockLotAllocation(models.Model):
+    """Quantity a stock transaction took out of a lot, so deleting the transaction can put it back"""
+    lot = models.ForeignKey(StockLot, on_delete=models.CASCADE, related_name='allocations')
+    stock_transaction = models.ForeignKey('StockTransaction', on_delete=models.CASCADE, related_name='lot_allocations')
+    quantity = models.DecimalField(max_digits=10, decimal_places=3)
+    
+    def __str__(self):
+        return f"{self.stock_transaction_id} took {self.quantity} from lot {self.lot_id}"
+
+def costing_method():
+    """'fifo' or 'average', see INVENTORY_COSTING_METHOD in settings"""
+    return getattr(settings, 'INVENTORY_COSTING_METHOD', 'fifo')
+
+class CostLayer(ReceivedStock):
+    """
+    Stock of a product received at one unit cost, one layer per stock in or
+    return. Issues take from the open layers oldest first and store what
+    the stock cost on the transaction (cost_of_goods), so profit reports
+    sum a stored column instead of replaying purchase history.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='cost_layers')
+    unit_cost = models.DecimalField(max_digits=10, decimal_places=2)
+    stock_transaction = models.ForeignKey('StockTransaction', on_delete=models.SET_NULL, null=True, blank=True, related_name='cost_layers')
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'received_at', 'id'], name='cost_layer_open_idx', condition=Q(quantity__gt=0)),
+        ]
+    
+    def __str__(self):
+        return f"{self.product}: {self.quantity} @ {self.unit_cost}"
+    
+    @classmethod
+    def open_layers(cls):
+        return cls.objects.filter(quantity__gt=0)
+    
+    @classmethod
+    def receive(cls, product, quantity, unit_cost, stock_transaction=None):
+        """Open a layer for stock received at unit_cost"""
+        quantity = Decimal(str(quantity))
+        return cls.objects.create(
+            product=product,
+            unit_cost=unit_cost,
+            quantity=quantity,
+            received_quantity=quantity,
+            received_at=stock_transaction.transaction_date if stock_transaction else timezone.now(),
+            stock_transaction=stock_transaction,
+        )
+    
+    @classmethod
+    def consume(cls, product, quantity, fallback_unit_cost, stock_transaction=None):
+        """
+        Issue stock from the oldest layers and return what it cost. With the
+        'average' costing method the quantity still leaves the layers oldest
+        first but is costed at the weighted average of the open layers.
+        Stock beyond the open layers is costed at fallback_unit_cost.
+        """
+        quantity = Decimal(str(quantity))
+        layers = cls.open_layers().filter(product=product).order_by('received_at', 'id')
+        with db_transaction.atomic():
+            if costing_method() == 'average':
+                totals = layers.aggregate(
+                    on_hand=Sum('quantity'),
+                    value=Sum(ExpressionWrapper(F('quantity') * F('unit_cost'), output_field=models.DecimalField())),
+                )
+            taken, uncovered = cls._take(layers, quantity, stock_transaction)
+        
+        if costing_method() == 'average' and totals['on_hand']:
+            cost = (quantity - uncovered) * Decimal(str(totals['value'])) / Decimal(str(totals['on_hand']))
+        else:
+            cost = sum((used * layer.unit_cost for layer, used in taken), Decimal('0'))
+        cost += uncovered * Decimal(str(fallback_unit_cost or 0))
+        return cost.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+    
+    @classmethod
+    def book(cls, product, delta, source=None):
+        """
+        Book a change of a product's total stock against its cost layers
+        (called from the stock level signal). A receipt opens a layer at its
+        buying price; an issue is costed from the layers and the cost is left
+        on source.cost_of_goods; reverting a transaction undoes what it did.
+        """
+        delta = Decimal(str(delta))
+        source_type = source.transaction_type if source is not None else None
+        if delta > 0:
+            if source_type in ('out', 'wastage'):
+                # Deleting an issue puts the stock back into the layers it came from
+                cls.release(source)
+                return
+            cls.receive(product, delta, source.buying_price if source else product.buying_price, stock_transaction=source)
+        elif delta < 0:
+            with db_transaction.atomic():
+                if source_type in ('in', 'return'):
+                    # Deleting a receipt takes back what is left of its own layer first
+                    received = cls.open_layers().filter(stock_transaction=source).order_by('id')
+                    _, remaining = cls._take(received, -delta)
+                    if remaining > 0:
+                        cls.consume(product, remaining, product.buying_price)
+                else:
+                    cost = cls.consume(
+                        product, -delta, source.buying_price if source else product.buying_price, stock_transaction=source
+                    )
+                    if source is not None:
+                        source.cost_of_goods = cost
+
+class CostLayerAllocation(models.Model):
+    """Quantity a stock transaction took out of a cost layer, so deleting the transaction can put it back"""
+    layer = models.ForeignKey(CostLayer, on_delete=models.CASCADE, related_name='allocations')
+    stock_transaction = models.ForeignKey('StockTransaction', on_delete=models.CASCADE, related_name='cost_allocations')
+    quantity = models.DecimalField(max_digits=10, decimal_places=3)
+    
+    def __str__(self):
+        return f"{self.stock_transaction_id} took {self.quantity} from cost layer {self.layer_id}"
+
+def per_transaction_invoicing():
+    """
+    Whether each sale to a client gets its own invoice when it is saved,
+    rather than a line on a consolidated invoice from the billing run
+    """
+    return getattr(settings, 'INVOICE_BILLING_MODE', 'per_transaction') == 'per_transaction'
 
 class StockTransaction(models.Model):
     TRANSACTION_TYPES = (
@@ -111,6 +575,9 @@ class StockTransaction(models.Model):
         ('na', 'Not Applicable'),
     )
     
+    # Payment statuses that still count towards receivables/payables
+    OPEN_PAYMENT_STATUSES = ('due', 'partial')
+    
     transaction_id = models.CharField(max_length=20, unique=True, blank=True, null=True, help_text="Unique transaction identifier")
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_transactions')
     transaction_type = models.CharField(max_length=10, choices=TRANSACTION_TYPES)
@@ -121,11 +588,15 @@ class StockTransaction(models.Model):
     wastage_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0, help_text="Additional wastage cost beyond the item value (e.g., disposal fees)")
     total_price = models.DecimalField(max_digits=10, decimal_places=2)
     profit_loss = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    cost_of_goods = models.DecimalField(max_digits=10, decimal_places=2, default=0, help_text="Cost of the stock issued, from the product's cost layers (stock out and wastage)")
     supplier = models.ForeignKey(Supplier, on_delete=models.SET_NULL, null=True, blank=True, related_name='stock_transactions')
     client = models.ForeignKey(Client, on_delete=models.SET_NULL, null=True, blank=True, related_name='stock_transactions')
     source_warehouse = models.ForeignKey(Warehouse, on_delete=models.SET_NULL, null=True, blank=True, related_name='source_transactions')
     destination_warehouse = models.ForeignKey(Warehouse, on_delete=models.SET_NULL, null=True, blank=True, related_name='destination_transactions')
     reference_number = models.CharField(max_length=100, blank=True, null=True)
+    # Lot received by stock in/return transactions (defaults: transaction ID, product expiry)
+    lot_number = models.CharField(max_length=100, blank=True, null=True)
+    expiry_date = models.DateField(blank=True, null=True)
     notes = models.TextField(blank=True, null=True)
     transaction_date = models.DateTimeField()
     created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
@@ -143,6 +614,17 @@ class StockTransaction(models.Model):
     amount_paid = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     amount_due = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     
+    # Invoice that bills this sale: its own invoice, or a consolidated one from the billing run
+    invoice = models.ForeignKey('Invoice', on_delete=models.SET_NULL, null=True, blank=True, related_name='stock_transactions')
+    # When the sale was first invoiced; kept if that invoice is deleted, so the billing run does not bill it again
+    invoiced_at = models.DateTimeField(null=True, blank=True, editable=False)
+    
+    class Meta:
+        indexes = [
+            # Reports and the demand forecast read one transaction type over a date range
+            models.Index(fields=['transaction_type', 'transaction_date'], name='stock_txn_type_date_idx'),
+        ]
+    
     def __str__(self):
         if self.transaction_id:
             return f"{self.transaction_id} - {self.transaction_type} - {self.product.name}"
@@ -194,6 +676,33 @@ class StockTransaction(models.Model):
         final_price = (gross_price_inc_vat + ait).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
         return final_price
     
+    def kpi_contribution(self):
+        """
+        Return (warehouse_id, due_receivables, due_payables) this transaction
+        adds to the KPI counters. Sales are attributed to their source warehouse
+        and purchases to their destination warehouse.
+        """
+        amount_due = Decimal(str(self.amount_due or 0))
+        if self.payment_status not in self.OPEN_PAYMENT_STATUSES:
+            return None, Decimal('0'), Decimal('0')
+        if self.transaction_type == 'out':
+            return self.source_warehouse_id, amount_due, Decimal('0')
+        if self.transaction_type == 'in':
+            return self.destination_warehouse_id, Decimal('0'), amount_due
+        return None, Decimal('0'), Decimal('0')
+    
+    def payment_state(self, paid):
+        """
+        (payment_status, amount_paid, amount_due) once `paid` has been paid in
+        total; amount_paid is capped at the total price
+        """
+        paid = Decimal(str(paid or 0))
+        if paid >= self.total_price:
+            return 'paid', self.total_price, Decimal('0')
+        if paid > 0:
+            return 'partial', paid, self.total_price - paid
+        return 'due', Decimal('0'), self.total_price
+    
     @property
     def payment_percentage(self):
         """Calculate the percentage of payment made"""
@@ -220,11 +729,17 @@ class StockTransaction(models.Model):
             self.vat_rate = 0
             self.ait_rate = 0
             self.final_price = 0
-            # Unit price is the buying price for wastage
-            self.unit_price = self.buying_price
+            # Unit price is the cost of the wasted stock (the buying price until it is costed)
+            if self.cost_of_goods and self.quantity:
+                self.unit_price = (self.cost_of_goods / self.quantity).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+            else:
+                self.unit_price = self.buying_price
         
         # Calculate total price
-        if self.transaction_type == 'out' and self.apply_taxes:
+        if self.transaction_type == 'wastage' and self.cost_of_goods:
+            # Costed wastage is worth exactly the cost of the stock
+            self.total_price = self.cost_of_goods
+        elif self.transaction_type == 'out' and self.apply_taxes:
             # For outgoing transactions with taxes, ensure final_price is set
             if self.final_price is None or self.final_price == 0:
                 self.final_price = self.calculate_final_price()
@@ -235,8 +750,8 @@ class StockTransaction(models.Model):
         
         # Calculate profit/loss accounting for wastage and taxes
         if self.transaction_type == 'out':
-            # For sales: profit = selling price - buying price - wastage
-            cost = self.quantity * self.buying_price
+            # For sales: profit = revenue - cost of the stock sold - wastage
+            cost = self.cost_of_goods or self.quantity * self.buying_price
             
             # If taxes are applied, use final_price for revenue calculation
             if self.apply_taxes and self.final_price:
@@ -284,161 +799,130 @@ class StockTransaction(models.Model):
             except StockTransaction.DoesNotExist:
                 pass
         
-        # Save the transaction first without updating product quantities
-        super().save(*args, **kwargs)
-        
-        # Now update product quantity and warehouse based on transaction type
-        if is_new:  # Only update quantities for new transactions
-            if self.transaction_type == 'in' or self.transaction_type == 'return':
-                # For incoming transactions, increase product quantity
-                self.product.quantity += self.quantity
-                # Update warehouse if specified
-                if self.destination_warehouse:
-                    self.product.warehouse = self.destination_warehouse
-                self.product.save()
-            elif self.transaction_type == 'out' or self.transaction_type == 'wastage':
-                # For outgoing transactions, ensure source_warehouse is set to product's warehouse if not specified
-                if not self.source_warehouse and self.product.warehouse:
-                    self.source_warehouse = self.product.warehouse
-                    # Need to save again to update the source_warehouse
-                    super().save(update_fields=['source_warehouse'])
-                
-                # Decrease product quantity
-                self.product.quantity -= self.quantity
-                self.product.save()
-            elif self.transaction_type == 'transfer':
-                # For warehouse transfers, handle quantity and warehouse updates correctly
-                try:
-                    # 1. First check if source and destination warehouses are specified
-                    if not self.source_warehouse:
-                        raise ValidationError("Source warehouse must be specified for transfers")
-                    
-                    if not self.destination_warehouse:
-                        raise ValidationError("Destination warehouse must be specified for transfers")
-                    
-                    # 2. Check if source and destination are different
-                    if self.source_warehouse == self.destination_warehouse:
-                        raise ValidationError("Source and destination warehouses cannot be the same")
-                    
-                    # 3. Check if the product is in the source warehouse
-                    if self.product.warehouse != self.source_warehouse:
-                        raise ValidationError(f"Product is not in the source warehouse. Current warehouse: {self.product.warehouse}")
-                    
-                    # 4. Check if there's enough quantity in the source warehouse
-                    if self.product.quantity < self.quantity:
-                        raise ValidationError(f"Not enough quantity in source warehouse. Available: {self.product.quantity}, Requested: {self.quantity}")
-                    
-                    # 5. Check if quantity is positive
-                    if self.quantity <= 0:
-                        raise ValidationError("Transfer quantity must be greater than zero")
-                    
-                    # 6. Reduce quantity from source warehouse
-                    self.product.quantity -= self.quantity
-                    if self.product.quantity < 0:
-                        raise ValidationError("Transfer would result in negative inventory in source warehouse")
-                    
-                    self.product.save()
-                    
-                    # 7. Check if product with same SKU exists in destination warehouse
-                    try:
-                        destination_product = Product.objects.filter(
-                            sku=self.product.sku,
-                            warehouse=self.destination_warehouse
-                        ).first()
-                        
-                        if destination_product:
-                            # If product exists in destination warehouse, increase its quantity
-                            destination_product.quantity += self.quantity
-                            destination_product.save()
-                        else:
-                            # Create a new product entry for the destination warehouse
-                            try:
-                                new_product = Product.objects.create(
-                                    name=self.product.name,
-                                    sku=self.product.sku,
-                                    category=self.product.category,
-                                    description=self.product.description,
-                                    buying_price=self.product.buying_price,
-                                    selling_price=self.product.selling_price,
-                                    unit_of_measure=self.product.unit_of_measure,
-                                    quantity=self.quantity,
-                                    reorder_level=self.product.reorder_level,
-                                    shipment_number=self.product.shipment_number,
-                                    location=self.product.location,
-                                    warehouse=self.destination_warehouse,
-                                    expiry_date=self.product.expiry_date,
-                                    supplier=self.product.supplier
-                                )
-                            except Exception as e:
-                                # Rollback the quantity reduction in source warehouse if destination creation fails
-                                self.product.quantity += self.quantity
-                                self.product.save()
-                                raise ValidationError(f"Failed to create product in destination warehouse: {str(e)}")
-                    except Exception as e:
-                        # Rollback the quantity reduction in source warehouse if any error occurs
-                        self.product.quantity += self.quantity
-                        self.product.save()
-                        raise ValidationError(f"Error during warehouse transfer: {str(e)}")
-                
-                except ValidationError as e:
-                    # Re-raise ValidationError with the specific error message
-                    raise ValidationError(f"Warehouse transfer failed: {str(e)}")
-                except Exception as e:
-                    # Catch any other exceptions and provide a meaningful error message
-                    raise ValidationError(f"Unexpected error during warehouse transfer: {str(e)}")
+        with db_transaction.atomic():
+            # Save the transaction first without updating product quantities
+            super().save(*args, **kwargs)
+            
+            # Now update the product total and the per-warehouse stock levels
+            if is_new:  # Only update quantities for new transactions
+                self.apply_stock_movement()
         
-        # Auto-generate invoice for new outgoing transactions with clients
-        if is_new and self.transaction_type == 'out' and self.client:
+        # Auto-generate invoice for new outgoing transactions with clients,
+        # unless sales are billed by the consolidated billing run
+        if is_new and self.transaction_type == 'out' and self.client and per_transaction_invoicing():
             self.generate_invoice()
     
+    def apply_stock_movement(self):
+        """
+        Apply a new transaction to the stock. Stock in, out and wastage change
+        the product total, and the product's save() books the difference
+        against the given warehouse, its lots and the cost layers (see
+        signals.py). Transfers only move quantity and lots between two
+        warehouses.
+        """
+        self.product._stock_source = self
+        if self.transaction_type == 'in' or self.transaction_type == 'return':
+            # For incoming transactions, increase product quantity
+            self.product.quantity += self.quantity
+            if self.destination_warehouse_id:
+                self.product._stock_warehouse_id = self.destination_warehouse_id
+                # Products without a home warehouse adopt the first one they are received into
+                if not self.product.warehouse_id:
+                    self.product.warehouse_id = self.destination_warehouse_id
+            self.product.save()
+        elif self.transaction_type == 'out' or self.transaction_type == 'wastage':
+            # For outgoing transactions, ensure source_warehouse is set to product's warehouse if not specified
+            if not self.source_warehouse_id and self.product.warehouse_id:
+                self.source_warehouse_id = self.product.warehouse_id
+                # Need to save again to update the source_warehouse
+                super().save(update_fields=['source_warehouse'])
+            
+            # Decrease product quantity
+            self.product.quantity -= self.quantity
+            self.product._stock_warehouse_id = self.source_warehouse_id
+            self.product.save()
+            self.record_cost_of_goods()
+        elif self.transaction_type == 'transfer':
+            try:
+                if not self.source_warehouse_id:
+                    raise ValidationError("Source warehouse must be specified for transfers")
+                if not self.destination_warehouse_id:
+                    raise ValidationError("Destination warehouse must be specified for transfers")
+                if self.source_warehouse_id == self.destination_warehouse_id:
+                    raise ValidationError("Source and destination warehouses cannot be the same")
+                if self.quantity <= 0:
+                    raise ValidationError("Transfer quantity must be greater than zero")
+                
+                ProductStock.transfer(self.product, self.source_warehouse_id, self.destination_warehouse_id, self.quantity)
+                StockLot.transfer(self.product, self.source_warehouse_id, self.destination_warehouse_id, self.quantity, stock_transaction=self)
+            except ValidationError as e:
+                raise ValidationError(f"Warehouse transfer failed: {' '.join(e.messages)}")
+    
+    def record_cost_of_goods(self):
+        """
+        Store the cost of an issue, worked out from the cost layers while the
+        product was saved (see CostLayer.book), and base the profit/loss on
+        it instead of the current buying price.
+        """
+        if self.transaction_type == 'wastage':
+            if self.cost_of_goods and self.quantity:
+                self.unit_price = (self.cost_of_goods / Decimal(str(self.quantity))).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+            self.total_price = self.cost_of_goods
+            self.profit_loss = -self.total_price
+        else:
+            # save() costed the sale at the buying price
+            self.profit_loss = Decimal(str(self.profit_loss)) + Decimal(str(self.quantity)) * Decimal(str(self.buying_price)) - self.cost_of_goods
+        StockTransaction.objects.filter(pk=self.pk).update(
+            cost_of_goods=self.cost_of_goods,
+            unit_price=self.unit_price,
+            total_price=self.total_price,
+            profit_loss=self.profit_loss,
+        )
+    
     def generate_invoice(self):
         """Generate an invoice for this transaction"""
         # Check if an invoice already exists for this transaction
         reference_number = f"TRANS-{self.id}"
         
-        # Import here to avoid circular import
-        from django.db.models import Max
-        
         # Get the Invoice model without importing it directly
         Invoice = type(self)._meta.model._meta.apps.get_model('inventory', 'Invoice')
         InvoiceItem = type(self)._meta.model._meta.apps.get_model('inventory', 'InvoiceItem')
+        InvoiceSequence = type(self)._meta.model._meta.apps.get_model('inventory', 'InvoiceSequence')
         
-        existing_invoice = Invoice.objects.filter(notes__contains=reference_number).first()
+        existing_invoice = Invoice.objects.filter(pk=self.invoice_id).first() if self.invoice_id else None
         
         if not existing_invoice:
-            # Generate next invoice number
-            last_invoice = Invoice.objects.aggregate(Max('invoice_number'))['invoice_number__max']
-            next_number = 1
-            if last_invoice:
-                try:
-                    next_number = int(last_invoice) + 1
-                except ValueError:
-                    next_number = 1
+            issue_date = self.transaction_date.date()
             
-            # Create the invoice
-            invoice = Invoice.objects.create(
-                invoice_number=f'{next_number:06d}',
-                client=self.client,
-                issue_date=self.transaction_date.date(),
-                due_date=self.transaction_date.date() + timezone.timedelta(days=30),
-                status='pending' if self.payment_status in ['due', 'partial', 'credit'] else 'paid',
-                subtotal=self.total_price,
-                tax_rate=self.vat_rate + self.ait_rate if self.apply_taxes else 0,
-                tax_amount=self.total_price - (self.quantity * self.final_price) if self.apply_taxes and self.final_price else 0,
-                discount=0,
-                total=self.total_price,
-                notes=f"{reference_number} - Auto-generated from transaction #{self.id} on {timezone.now().strftime('%Y-%m-%d')}",
-                created_by=self.created_by
-            )
-            
-            # Create invoice item
-            InvoiceItem.objects.create(
-                invoice=invoice,
-                product=self.product,
-                quantity=self.quantity,
-                unit_price=self.unit_price,
-                total_price=self.total_price
-            )
+            # The number is only taken if the invoice is created
+            with db_transaction.atomic():
+                invoice = Invoice.objects.create(
+                    invoice_number=InvoiceSequence.next_number(issue_date=issue_date),
+                    client=self.client,
+                    issue_date=issue_date,
+                    due_date=issue_date + timezone.timedelta(days=30),
+                    status='pending' if self.payment_status in ['due', 'partial', 'credit'] else 'paid',
+                    subtotal=self.total_price,
+                    tax_rate=self.vat_rate + self.ait_rate if self.apply_taxes else 0,
+                    tax_amount=self.total_price - (self.quantity * self.final_price) if self.apply_taxes and self.final_price else 0,
+                    discount=0,
+                    total=self.total_price,
+                    notes=f"{reference_number} - Auto-generated from transaction #{self.id} on {timezone.now().strftime('%Y-%m-%d')}",
+                    created_by=self.created_by
+                )
+                
+                # Create invoice item
+                InvoiceItem.objects.create(
+                    invoice=invoice,
+                    product=self.product,
+                    quantity=self.quantity,
+                    unit_price=self.unit_price,
+                    total_price=self.total_price
+                )
+                
+                self.invoice = invoice
+                self.invoiced_at = timezone.now()
+                StockTransaction.objects.filter(pk=self.pk).update(invoice=invoice, invoiced_at=self.invoiced_at)
             
             return invoice
         
@@ -469,35 +953,40 @@ class Payment(models.Model):
         return f"Payment of {self.amount} for {self.transaction}"
     
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        
-        # Update the related transaction's payment status
-        transaction = self.transaction
-        total_payments = Payment.objects.filter(transaction=transaction).aggregate(
-            total=models.Sum('amount')
-        )['total'] or 0
-        
-        # Update transaction payment details
-        transaction.amount_paid = total_payments
-        
-        # Determine payment status based on the amount paid
-        if total_payments >= transaction.total_price:
-            transaction.payment_status = 'paid'
-            transaction.amount_paid = transaction.total_price  # Cap at total price
-            transaction.amount_due = 0
-        elif total_payments > 0:
-            transaction.payment_status = 'partial'
-            transaction.amount_due = transaction.total_price - total_payments
-        else:
-            transaction.payment_status = 'due'
-            transaction.amount_due = transaction.total_price
-        
-        # Save the transaction without triggering its save method recursively
-        StockTransaction.objects.filter(id=transaction.id).update(
-            payment_status=transaction.payment_status,
-            amount_paid=transaction.amount_paid,
-            amount_due=transaction.amount_due
-        )
+        with db_transaction.atomic():
+            # Update the related transaction's payment status from its locked row
+            transaction = self.transaction
+            current = StockTransaction.objects.select_for_update().only(
+                'total_price', 'amount_paid', 'amount_due', 'payment_status',
+                'transaction_type', 'source_warehouse', 'destination_warehouse',
+            ).get(pk=transaction.pk)
+            old_kpi = current.kpi_contribution()
+            
+            # A new payment adds to what was already paid, an edited one by the change
+            # in its amount; amount_paid may include an opening amount with no Payment row
+            previous_amount = Decimal('0')
+            if not self._state.adding:
+                previous_amount = Payment.objects.filter(pk=self.pk).values_list('amount', flat=True).first() or Decimal('0')
+            super().save(*args, **kwargs)
+            total_payments = current.amount_paid + Decimal(str(self.amount)) - previous_amount
+            
+            status, amount_paid, amount_due = current.payment_state(total_payments)
+            transaction.payment_status = current.payment_status = status
+            transaction.amount_paid = current.amount_paid = amount_paid
+            transaction.amount_due = current.amount_due = amount_due
+            
+            # Save the transaction without triggering its save method recursively
+            StockTransaction.objects.filter(id=transaction.id).update(
+                payment_status=status,
+                amount_paid=amount_paid,
+                amount_due=amount_due
+            )
+            
+            # The queryset update above bypasses the post_save signal, so move the
+            # KPI counters here
+            new_kpi = current.kpi_contribution()
+            KpiCounter.apply_delta(old_kpi[0], due_receivables=-old_kpi[1], due_payables=-old_kpi[2])
+            KpiCounter.apply_delta(new_kpi[0], due_receivables=new_kpi[1], due_payables=new_kpi[2])
 
 class Invoice(models.Model):
     STATUS_CHOICES = (
@@ -523,6 +1012,12 @@ class Invoice(models.Model):
     
     def __str__(self):
         return self.invoice_number
+    
+    def save(self, *args, **kwargs):
+        with db_transaction.atomic():
+            super().save(*args, **kwargs)
+            # A number typed in by hand must not be handed out by the sequence later
+            InvoiceSequence.claim(self.invoice_number, issue_date=self.issue_date)
 
 class InvoiceItem(models.Model):
     invoice = models.ForeignKey(Invoice, on_delete=models.CASCADE, related_name='items')
@@ -537,3 +1032,454 @@ class InvoiceItem(models.Model):
     def save(self, *args, **kwargs):
         self.total_price = self.quantity * self.unit_price
         super().save(*args, **kwargs)
+
+class InvoiceSequence(models.Model):
+    """
+    Last invoice number issued in a numbering series (per year for yearly
+    series). Numbers are taken with reserve(), which increments the row
+    inside the caller's database transaction: concurrent workers never get
+    the same number, and an invoice that is rolled back gives its number
+    back, so the sequence has no gaps. Series are set in
+    INVOICE_NUMBER_SERIES.
+    """
+    series = models.CharField(max_length=30)
+    year = models.PositiveIntegerField(default=0)  # 0 for series that do not restart each year
+    last_number = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['series', 'year'], name='invoice_sequence_series_year'),
+        ]
+    
+    def __str__(self):
+        if self.year:
+            return f"{self.series} {self.year}: {self.last_number}"
+        return f"{self.series}: {self.last_number}"
+    
+    @staticmethod
+    def series_config(series):
+        config = getattr(settings, 'INVOICE_NUMBER_SERIES', {}).get(series)
+        if config is None:
+            raise ValueError(f'Unknown invoice number series "{series}"')
+        return {'prefix': '', 'padding': 6, 'yearly': False, **config}
+    
+    @classmethod
+    def format_number(cls, series, year, number):
+        config = cls.series_config(series)
+        return f"{config['prefix'].format(year=year)}{number:0{config['padding']}d}"
+    
+    @classmethod
+    def _year(cls, series, issue_date):
+        if not cls.series_config(series)['yearly']:
+            return 0
+        return (issue_date or timezone.localdate()).year
+    
+    @classmethod
+    def reserve(cls, count=1, series='default', issue_date=None):
+        """
+        Take the next `count` numbers of a series, in the year of issue_date
+        (default today) for yearly series. Returns the invoice numbers.
+        """
+        year = cls._year(series, issue_date)
+        sequence = cls.objects.filter(series=series, year=year)
+        with db_transaction.atomic():
+            # The UPDATE takes the row lock before the new value is read back
+            changes = {'last_number': F('last_number') + count, 'updated_at': timezone.now()}
+            if not sequence.update(**changes):
+                cls.objects.get_or_create(series=series, year=year, defaults={
+                    'last_number': cls._highest_issued(series, year),
+                })
+                sequence.update(**changes)
+            last_number = sequence.values_list('last_number', flat=True).get()
+        return [cls.format_number(series, year, number) for number in range(last_number - count + 1, last_number + 1)]
+    
+    @classmethod
+    def next_number(cls, series='default', issue_date=None):
+        return cls.reserve(1, series, issue_date)[0]
+    
+    @classmethod
+    def claim(cls, invoice_number, series='default', issue_date=None):
+        """
+        Move the sequence past an invoice number that was not reserved from
+        it, e.g. one typed in by hand. Numbers in another format are ignored.
+        """
+        year = cls._year(series, issue_date)
+        prefix = cls.series_config(series)['prefix'].format(year=year)
+        suffix = invoice_number[len(prefix):] if invoice_number.startswith(prefix) else ''
+        if not suffix.isdigit() or cls.format_number(series, year, int(suffix)) != invoice_number:
+            return
+        # Without a row yet, reserve() starts after the highest number issued, this one included
+        cls.objects.filter(series=series, year=year, last_number__lt=int(suffix)).update(
+            last_number=int(suffix), updated_at=timezone.now(),
+        )
+    
+    @classmethod
+    def peek(cls, series='default', issue_date=None):
+        """The number reserve() would hand out next, without taking it"""
+        year = cls._year(series, issue_date)
+        last_number = cls.objects.filter(series=series, year=year).values_list('last_number', flat=True).first()
+        if last_number is None:
+            last_number = cls._highest_issued(series, year)
+        return cls.format_number(series, year, last_number + 1)
+    
+    @classmethod
+    def _highest_issued(cls, series, year):
+        """Highest number already used in the series, to start a new sequence row after it"""
+        prefix = cls.series_config(series)['prefix'].format(year=year)
+        highest = 0
+        numbers = Invoice.objects.filter(invoice_number__startswith=prefix).values_list('invoice_number', flat=True)
+        for invoice_number in numbers.iterator(chunk_size=5000):
+            suffix = invoice_number[len(prefix):]
+            if suffix.isdigit():
+                highest = max(highest, int(suffix))
+        return highest
+
+class InvoiceExportJob(models.Model):
+    """
+    A bulk export of invoice PDFs into one ZIP, with progress updated as
+    each PDF is rendered.
+    """
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    )
+    
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    filters = models.JSONField(default=dict, blank=True)
+    total_invoices = models.PositiveIntegerField(default=0)
+    completed_invoices = models.PositiveIntegerField(default=0)
+    failed_invoices = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+    
+    def __str__(self):
+        return f"Invoice export #{self.pk} ({self.get_status_display()})"
+    
+    @property
+    def progress(self):
+        """Percentage of invoices processed"""
+        if not self.total_invoices:
+            return 100 if self.status == 'completed' else 0
+        return int(100 * (self.completed_invoices + self.failed_invoices) / self.total_invoices)
+    
+    def start(self, total_invoices):
+        self.status = 'running'
+        self.total_invoices = total_invoices
+        self.save(update_fields=['status', 'total_invoices'])
+    
+    def record(self, succeeded):
+        """Count one processed invoice; a queryset update so pollers see it at once"""
+        field = 'completed_invoices' if succeeded else 'failed_invoices'
+        InvoiceExportJob.objects.filter(pk=self.pk).update(**{field: F(field) + 1})
+        setattr(self, field, getattr(self, field) + 1)
+    
+    def finish(self, error=''):
+        self.status = 'failed' if error else 'completed'
+        self.error = error
+        self.finished_at = timezone.now()
+        self.save(update_fields=['status', 'error', 'finished_at'])
+
+
+class KpiCounter(models.Model):
+    """
+    Running totals for the dashboard KPIs, kept in sync by signal handlers.
+    The row with no warehouse holds the global totals; every other row holds
+    the totals for a single warehouse.
+    """
+    warehouse = models.OneToOneField(Warehouse, on_delete=models.CASCADE, null=True, blank=True, related_name='kpi_counter')
+    inventory_value = models.DecimalField(max_digits=20, decimal_places=5, default=0)
+    due_receivables = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    due_payables = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    low_stock_count = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        if self.warehouse_id:
+            return f"KPIs for {self.warehouse}"
+        return "Global KPIs"
+    
+    @classmethod
+    def get_global(cls):
+        """Return the global counter row, creating it if it does not exist yet"""
+        counter = cls.objects.filter(warehouse__isnull=True).first()
+        if counter is None:
+            counter = cls.objects.create(warehouse=None)
+        return counter
+    
+    @classmethod
+    def for_warehouse(cls, warehouse_id):
+        """Return the counter row for a warehouse, creating it if needed"""
+        counter, created = cls.objects.get_or_create(warehouse_id=warehouse_id)
+        return counter
+    
+    @classmethod
+    def apply_delta(cls, warehouse_id=None, inventory_value=0, due_receivables=0, due_payables=0, low_stock_count=0, include_global=True):
+        """
+        Add the given deltas to the global row and, when a warehouse is given,
+        to that warehouse's row. Runs as a single atomic F() update per row.
+        Stock level changes pass include_global=False, as the global totals
+        follow the products themselves.
+        """
+        if not (inventory_value or due_receivables or due_payables or low_stock_count):
+            return
+        
+        changes = {
+            'inventory_value': F('inventory_value') + Decimal(str(inventory_value)),
+            'due_receivables': F('due_receivables') + Decimal(str(due_receivables)),
+            'due_payables': F('due_payables') + Decimal(str(due_payables)),
+            'low_stock_count': F('low_stock_count') + low_stock_count,
+            'updated_at': timezone.now(),
+        }
+        
+        with db_transaction.atomic():
+            if include_global and not cls.objects.filter(warehouse__isnull=True).update(**changes):
+                cls.get_global()
+                cls.objects.filter(warehouse__isnull=True).update(**changes)
+            
+            if warehouse_id:
+                if not cls.objects.filter(warehouse_id=warehouse_id).update(**changes):
+                    cls.for_warehouse(warehouse_id)
+                    cls.objects.filter(warehouse_id=warehouse_id).update(**changes)
+    
+    @classmethod
+    def compute_actual(cls):
+        """
+        Compute the true KPI values from the source tables.
+        Returns a dict keyed by warehouse id (None for the global totals).
+        """
+        totals = defaultdict(lambda: {
+            'inventory_value': Decimal('0'),
+            'due_receivables': Decimal('0'),
+            'due_payables': Decimal('0'),
+            'low_stock_count': 0,
+        })
+        
+        product_totals = Product.objects.aggregate(
+            total=Sum(ExpressionWrapper(F('quantity') * F('buying_price'), output_field=models.DecimalField())),
+            low_stock=Count('id', filter=Q(quantity__lte=F('reorder_level'))),
+        )
+        totals[None]['inventory_value'] += product_totals['total'] or Decimal('0')
+        totals[None]['low_stock_count'] += product_totals['low_stock']
+        
+        stock_rows = ProductStock.objects.values('warehouse_id').annotate(
+            total=Sum(ExpressionWrapper(F('quantity') * F('product__buying_price'), output_field=models.DecimalField())),
+            low_stock=Count('id', filter=Q(quantity__lte=F('product__reorder_level'))),
+        ).order_by()
+        for row in stock_rows:
+            totals[row['warehouse_id']]['inventory_value'] += row['total'] or Decimal('0')
+            totals[row['warehouse_id']]['low_stock_count'] += row['low_stock']
+        
+        for transaction_type, field, warehouse_field in (
+            ('out', 'due_receivables', 'source_warehouse_id'),
+            ('in', 'due_payables', 'destination_warehouse_id'),
+        ):
+            due_rows = StockTransaction.objects.filter(
+                transaction_type=transaction_type,
+                payment_status__in=StockTransaction.OPEN_PAYMENT_STATUSES
+            ).values(warehouse_field).annotate(total=Sum('amount_due')).order_by()
+            for row in due_rows:
+                total = row['total'] or Decimal('0')
+                totals[None][field] += total
+                if row[warehouse_field]:
+                    totals[row[warehouse_field]][field] += total
+        
+        # Make sure the global row is always present
+        totals[None]
+        return dict(totals)
+
+
+class StockAlertDigest(models.Model):
+    """
+    Daily low stock / expiry digest for a warehouse, written by the alerts
+    management command. Rows without a warehouse cover unassigned products.
+    """
+    warehouse = models.ForeignKey(Warehouse, on_delete=models.CASCADE, null=True, blank=True, related_name='alert_digests')
+    generated_on = models.DateField()
+    window_days = models.PositiveIntegerField(default=30)
+    low_stock_count = models.IntegerField(default=0)
+    expiring_soon_count = models.IntegerField(default=0)
+    expired_count = models.IntegerField(default=0)
+    items = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['-generated_on']
+        indexes = [
+            models.Index(fields=['generated_on', 'window_days'], name='alert_digest_date_idx'),
+        ]
+    
+    def __str__(self):
+        return f"Alerts for {self.warehouse or 'Unassigned'} on {self.generated_on}"
+
+class ReorderSuggestion(models.Model):
+    """
+    Reorder level suggested for a product from its recent sales, written by
+    the forecast_demand management command.
+    """
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, related_name='reorder_suggestion')
+    generated_on = models.DateField()
+    history_days = models.PositiveIntegerField()
+    lead_time_days = models.PositiveIntegerField()
+    service_level = models.DecimalField(max_digits=4, decimal_places=3)
+    average_daily_demand = models.DecimalField(max_digits=12, decimal_places=3, help_text="Moving average over the recent window")
+    smoothed_daily_demand = models.DecimalField(max_digits=12, decimal_places=3, help_text="Exponentially smoothed over the whole history")
+    demand_std_dev = models.DecimalField(max_digits=12, decimal_places=3)
+    safety_stock = models.DecimalField(max_digits=12, decimal_places=3)
+    suggested_reorder_level = models.DecimalField(max_digits=12, decimal_places=3)
+    
+    def __str__(self):
+        return f"{self.product}: reorder at {self.suggested_reorder_level}"
+    
+    @property
+    def differs(self):
+        """Whether the suggestion is different from the product's current reorder level"""
+        return self.suggested_reorder_level != self.product.reorder_level
+
+class PdfRenderTiming(models.Model):
+    """
+    Stage timings of one PDF request, recorded by the timed_pdf view
+    decorator. Stage times exclude the database time spent inside them.
+    """
+    report_type = models.CharField(max_length=30)
+    backend = models.CharField(max_length=20)
+    total_ms = models.FloatField(default=0)
+    db_ms = models.FloatField(default=0)
+    template_ms = models.FloatField(default=0)
+    layout_ms = models.FloatField(default=0)
+    merge_ms = models.FloatField(default=0)
+    queries = models.PositiveIntegerField(default=0)
+    size_bytes = models.PositiveIntegerField(default=0)
+    pages = models.PositiveIntegerField(null=True, blank=True)
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_at', 'report_type'], name='pdf_timing_created_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.report_type} PDF in {self.total_ms:.0f} ms"
+    
+    @classmethod
+    def prune(cls):
+        """Delete timings older than PDF_TIMING_RETENTION_DAYS (None keeps them all); returns the number deleted"""
+        days = getattr(settings, 'PDF_TIMING_RETENTION_DAYS', 30)
+        if days is None:
+            return 0
+        deleted, _ = cls.objects.filter(created_at__lt=timezone.now() - timezone.timedelta(days=days)).delete()
+        return deleted
+    
+    @classmethod
+    def summary(cls, since):
+        """p50/p95 of each stage per report type and backend, for requests since the given time"""
+        rows = defaultdict(list)
+        timings = cls.objects.filter(created_at__gte=since).order_by().values_list(
+            'report_type', 'backend', 'total_ms', 'db_ms', 'template_ms', 'layout_ms', 'size_bytes', 'pages',
+        )
+        for report_type, backend, *values in timings.iterator(chunk_size=5000):
+            rows[(report_type, backend)].append(values)
+        
+        summary = []
+        for (report_type, backend), values in sorted(rows.items()):
+            columns = list(zip(*values))
+            pages = [page for page in columns[5] if page is not None]
+            summary.append({
+                'report_type': report_type,
+                'backend': backend,
+                'count': len(values),
+                'total': _percentiles(columns[0]),
+                'db': _percentiles(columns[1]),
+                'template': _percentiles(columns[2]),
+                'layout': _percentiles(columns[3]),
+                'size_kb': _percentiles([size / 1024 for size in columns[4]]),
+                'pages': _percentiles(pages) if pages else None,
+            })
+        return summary
+
+
+def _percentiles(values):
+    """(p50, p95) of a list of numbers"""
+    if len(values) == 1:
+        return values[0], values[0]
+    cuts = statistics.quantiles(values, n=100, method='inclusive')
+    return cuts[49], cuts[94]
+
+class ProductPriceHistory(models.Model):
+    """A product's buying and selling price from changed_at onwards"""
+    SOURCE_CHOICES = (
+        ('manual', 'Manual Edit'),
+        ('reprice', 'Bulk Repricing'),
+        ('import', 'Catalog Import'),
+        ('initial', 'Initial Price'),
+    )
+    
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='price_history')
+    buying_price = models.DecimalField(max_digits=10, decimal_places=2)
+    selling_price = models.DecimalField(max_digits=10, decimal_places=2)
+    previous_buying_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    previous_selling_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    source = models.CharField(max_length=20, choices=SOURCE_CHOICES, default='manual')
+    note = models.CharField(max_length=255, blank=True)
+    changed_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='price_changes')
+    changed_at = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        ordering = ['-changed_at', '-id']
+        verbose_name_plural = "Product price history"
+        indexes = [
+            models.Index(fields=['product', 'changed_at'], name='price_history_product_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.product} @ {self.selling_price} ({self.changed_at:%Y-%m-%d})"
+    
+    @classmethod
+    def annotate_prices_as_of(cls, products, when, prefix=''):
+        """
+        Annotate a Product queryset with the buying and selling prices in effect
+        at `when`. Each annotation is a correlated subquery served by the
+        (product, changed_at) index, so any product set costs one query.
+        Products created after `when` get None.
+        """
+        history = cls.objects.filter(product=OuterRef('pk'), changed_at__lte=when).order_by('-changed_at', '-id')
+        return products.annotate(**{
+            f'{prefix}buying_price_as_of': Subquery(history.values('buying_price')[:1]),
+            f'{prefix}selling_price_as_of': Subquery(history.values('selling_price')[:1]),
+        })
+    
+    @classmethod
+    def prices_as_of(cls, when, products=None):
+        """Return {product_id: (buying_price, selling_price)} in effect at `when`"""
+        products = Product.objects.all() if products is None else products
+        rows = cls.annotate_prices_as_of(products.order_by(), when).values_list(
+            'id', 'buying_price_as_of', 'selling_price_as_of'
+        )
+        return {
+            product_id: (buying_price, selling_price)
+            for product_id, buying_price, selling_price in rows
+            if buying_price is not None
+        }
+    
+    @classmethod
+    def record(cls, product, previous_buying_price=None, previous_selling_price=None, source='manual', changed_by=None, note=''):
+        """Write a history row for the product's current prices"""
+        return cls.objects.create(
+            product=product,
+            buying_price=product.buying_price,
+            selling_price=product.selling_price,
+            previous_buying_price=previous_buying_price,
+            previous_selling_price=previous_selling_price,
+            source=source,
+            changed_by=changed_by,
+            note=note,
+        )
@@ -0,0 +1,133 @@
+"""
+Bulk allocation of one receipt or remittance across many open transactions.
+
+The receipt is split over a client's open sales or a supplier's open
+purchases, either oldest due date first or by explicit amounts. All the
+Payment rows go in with one bulk_create and the affected transactions are
+updated with a single CASE WHEN UPDATE (bulk_update), instead of a
+Payment.save() and transaction UPDATE per row.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F
+
+from .models import KpiCounter, Payment, StockTransaction
+
+ALLOCATION_MODES = (
+    ('fifo', 'Oldest due date first'),
+    ('split', 'Enter an amount per transaction'),
+)
+
+
+class AllocationError(ValueError):
+    pass
+
+
+def open_transactions(client=None, supplier=None):
+    """A client's open sales or a supplier's open purchases, oldest due date first"""
+    transactions = StockTransaction.objects.filter(
+        payment_status__in=StockTransaction.OPEN_PAYMENT_STATUSES,
+    )
+    if client is not None:
+        transactions = transactions.filter(client=client, transaction_type='out')
+    else:
+        transactions = transactions.filter(supplier=supplier, transaction_type='in')
+    return transactions.order_by(
+        F('payment_due_date').asc(nulls_last=True), 'transaction_date', 'id',
+    )
+
+
+def plan_allocation(transactions, amount, split=None):
+    """
+    Return [(transaction, amount applied)] for the receipt. Without a split
+    the amount goes to the transactions in order, each up to its amount due;
+    a split maps transaction IDs to amounts, which must add up to the
+    receipt. Raises AllocationError if the receipt cannot be allocated.
+    """
+    amount = Decimal(amount)
+    if amount <= 0:
+        raise AllocationError('The amount must be greater than zero.')
+
+    plan = []
+    if split is None:
+        remaining = amount
+        for stock_transaction in transactions:
+            if remaining <= 0:
+                break
+            applied = min(remaining, stock_transaction.amount_due)
+            if applied > 0:
+                plan.append((stock_transaction, applied))
+                remaining -= applied
+        if remaining > 0:
+            raise AllocationError(f'The amount exceeds the open balance by {remaining}.')
+        return plan
+
+    by_id = {stock_transaction.id: stock_transaction for stock_transaction in transactions}
+    unknown = set(split) - set(by_id)
+    if unknown:
+        raise AllocationError('Some transactions are no longer open. Please preview the allocation again.')
+    for transaction_id, applied in split.items():
+        stock_transaction = by_id[transaction_id]
+        if applied < 0:
+            raise AllocationError(f'{stock_transaction.transaction_id}: amounts must not be negative.')
+        if applied > stock_transaction.amount_due:
+            raise AllocationError(
+                f'{stock_transaction.transaction_id}: {applied} is more than the {stock_transaction.amount_due} due.'
+            )
+    plan = [(by_id[transaction_id], applied) for transaction_id, applied in split.items() if applied > 0]
+    allocated = sum((applied for _stock_transaction, applied in plan), Decimal('0'))
+    if allocated != amount:
+        raise AllocationError(f'The split adds up to {allocated}, not the {amount} received.')
+    return plan
+
+
+def apply_allocation(transactions, amount, split=None, *, payment_date, payment_method='cash',
+                     reference='', notes='', user=None):
+    """
+    Allocate a receipt across the open transactions, locking them first.
+    Returns the created Payment rows; raises AllocationError like
+    plan_allocation.
+    """
+    with transaction.atomic():
+        locked = list(transactions.select_for_update().only(
+            'transaction_id', 'total_price', 'amount_paid', 'amount_due', 'payment_status',
+            'transaction_type', 'source_warehouse', 'destination_warehouse',
+        ))
+        plan = plan_allocation(locked, amount, split)
+
+        payments = []
+        kpi_deltas = defaultdict(lambda: [Decimal('0'), Decimal('0')])
+        for stock_transaction, applied in plan:
+            payments.append(Payment(
+                transaction=stock_transaction,
+                amount=applied,
+                payment_date=payment_date,
+                payment_method=payment_method,
+                reference=reference,
+                notes=notes,
+                created_by=user,
+            ))
+
+            old_kpi = stock_transaction.kpi_contribution()
+            (
+                stock_transaction.payment_status,
+                stock_transaction.amount_paid,
+                stock_transaction.amount_due,
+            ) = stock_transaction.payment_state(stock_transaction.amount_paid + applied)
+            new_kpi = stock_transaction.kpi_contribution()
+            for warehouse_id, receivables, payables, sign in ((*old_kpi, -1), (*new_kpi, 1)):
+                kpi_deltas[warehouse_id][0] += sign * receivables
+                kpi_deltas[warehouse_id][1] += sign * payables
+
+        Payment.objects.bulk_create(payments, batch_size=500)
+        StockTransaction.objects.bulk_update(
+            [stock_transaction for stock_transaction, _applied in plan],
+            ['payment_status', 'amount_paid', 'amount_due'],
+        )
+
+        # bulk_update bypasses the post_save signal, so move the KPI counters here
+        for warehouse_id, (receivables, payables) in kpi_deltas.items():
+            KpiCounter.apply_delta(warehouse_id, due_receivables=receivables, due_payables=payables)
+    return payments
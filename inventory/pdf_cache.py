@@ -0,0 +1,174 @@
+"""
+On-disk cache of rendered invoice PDFs.
+
+Files are named by a hash of what the PDF is rendered from (the invoice and
+client updated_at, the item lines with their product names, the template and
+letterhead), so an edited invoice or a renamed product simply misses and
+renders a new file. Nothing is ever invalidated in place; superseded files
+age out through least-recently-used eviction once the cache grows past
+INVOICE_PDF_CACHE_MAX_BYTES.
+
+Each process keeps a running total of the cache size, so a write does not
+walk the cache directory. It is only walked when the total goes over the
+limit, or is more than RESCAN_SECONDS old (other processes write too), and
+an eviction trims the cache to EVICT_TO of the limit.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Prefetch
+from django.template.loader import get_template
+from django.utils import timezone
+
+from .models import InvoiceItem
+
+INVOICE_PDF_TEMPLATE = 'inventory/pdf/invoice_pdf.html'
+
+RESCAN_SECONDS = 300
+
+# Fraction of the size limit an eviction trims the cache down to
+EVICT_TO = 0.9
+
+# Cache size as last walked plus what this process wrote since, and when it was walked
+_tracked_bytes = None
+_walked_at = 0.0
+
+
+def cache_dir():
+    return getattr(settings, 'INVOICE_PDF_CACHE_DIR', os.path.join(settings.MEDIA_ROOT, 'pdf_cache', 'invoices'))
+
+
+def max_bytes():
+    return getattr(settings, 'INVOICE_PDF_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+
+
+def template_mtime(template_name):
+    origin = get_template(template_name).origin.name
+    try:
+        return os.path.getmtime(origin)
+    except (OSError, TypeError):
+        return None
+
+
+def with_pdf_items(invoices):
+    """
+    Invoice queryset with the client and the items and their products
+    loaded, which both invoice_pdf_key and the PDF template read.
+    """
+    return invoices.select_related('client').prefetch_related(
+        Prefetch('items', queryset=InvoiceItem.objects.select_related('product').order_by('id')),
+    )
+
+
+def invoice_pdf_key(invoice, customization, template_name=INVOICE_PDF_TEMPLATE):
+    """
+    Hash of everything the invoice PDF is rendered from. Editing the invoice
+    or client bumps its updated_at; the item lines, product names included,
+    are hashed as loaded, so load invoices through with_pdf_items().
+    """
+    parts = [
+        invoice.pk,
+        invoice.updated_at,
+        invoice.client.updated_at,
+        [
+            (item.id, item.product_id, item.product.name, item.quantity, item.unit_price, item.total_price)
+            for item in invoice.items.all()
+        ],
+        template_mtime(template_name),
+        customization,
+        # The footer prints the current year
+        timezone.localdate().year,
+    ]
+    payload = json.dumps(parts, cls=DjangoJSONEncoder, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def cache_path(key):
+    return os.path.join(cache_dir(), key[:2], f'{key}.pdf')
+
+
+def read(key):
+    """Path of the cached PDF for key, or None. A hit marks the file as recently used."""
+    path = cache_path(key)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return path
+
+
+def write(key, content):
+    """Store content under key and evict least recently used files if the cache is full"""
+    path = cache_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        replaced = os.path.getsize(path)
+    except FileNotFoundError:
+        replaced = 0
+    # Write to a temporary file and rename, so a concurrent reader never sees a partial PDF
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    _track(len(content) - replaced)
+    return path
+
+
+def _track(written):
+    global _tracked_bytes
+    limit = max_bytes()
+    if _tracked_bytes is None or time.monotonic() - _walked_at > RESCAN_SECONDS:
+        evict(limit, int(limit * EVICT_TO))
+        return
+    _tracked_bytes += written
+    if _tracked_bytes > limit:
+        evict(limit, int(limit * EVICT_TO))
+
+
+def evict(limit=None, target=None):
+    """
+    If the cache is larger than limit bytes, delete the least recently used
+    PDFs until it is no larger than target (default limit). Returns the
+    number of files removed.
+    """
+    global _tracked_bytes, _walked_at
+    limit = max_bytes() if limit is None else limit
+    target = limit if target is None else target
+    entries = []
+    total = 0
+    for root, _dirs, files in os.walk(cache_dir()):
+        for name in files:
+            if not name.endswith('.pdf'):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+    removed = 0
+    if total > limit:
+        for _used_at, size, path in sorted(entries):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+            if total <= target:
+                break
+    _tracked_bytes = total
+    _walked_at = time.monotonic()
+    return removed
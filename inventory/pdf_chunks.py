@@ -0,0 +1,135 @@
+"""
+Chunked rendering of large HTML report PDFs.
+
+One xhtml2pdf call over a whole large report holds the full DOM and layout
+in memory and can outlive the request timeout. Instead the report's rows
+are read once and cut into fixed-size chunks; each chunk renders the report
+template on its own (letterhead on the first, totals and terms on the
+last), optionally in worker processes, and the parts are concatenated with
+pypdf and stamped with continuous page numbers.
+"""
+import io
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from math import ceil
+
+from django.conf import settings
+from django.db.models import QuerySet
+from django.template.loader import get_template
+from pypdf import PdfReader, PdfWriter
+from reportlab.pdfgen import canvas
+
+from .pdf_timing import pdf_stage, set_backend
+from .utils import html_to_pdf_bytes
+
+# Context key holding the rows of each report type's main table
+REPORT_ROWS = {
+    'inventory': 'report_data',
+    'sales': 'sales',
+    'purchase': 'purchases',
+    'wastage': 'wastage',
+    'payment': 'payment_transactions',
+}
+
+
+def chunk_settings():
+    """(rows per chunk, row cap or None, worker processes)"""
+    return (
+        getattr(settings, 'REPORT_PDF_CHUNK_ROWS', 500),
+        getattr(settings, 'REPORT_PDF_MAX_ROWS', None),
+        getattr(settings, 'REPORT_PDF_WORKERS', 1),
+    )
+
+
+def row_count(rows):
+    return rows.count() if isinstance(rows, QuerySet) else len(rows)
+
+
+def needs_chunking(report_type, context):
+    """Whether a report is large enough, or capped, to go through render_report_chunks"""
+    rows_key = REPORT_ROWS.get(report_type)
+    if rows_key is None or context.get('grouped_data') or context.get(rows_key) is None:
+        return False
+    chunk_rows, max_rows, _workers = chunk_settings()
+    total = row_count(context[rows_key])
+    return total > chunk_rows or bool(max_rows and total > max_rows)
+
+
+def render_report_chunks(template_src, context, rows_key):
+    """
+    Render the report in chunks of REPORT_PDF_CHUNK_ROWS rows and return the
+    merged PDF bytes, or None if any chunk failed. At most
+    REPORT_PDF_MAX_ROWS rows are rendered; the last chunk then carries a
+    truncation notice.
+    """
+    chunk_rows, max_rows, workers = chunk_settings()
+    rows = context[rows_key]
+    total = row_count(rows)
+    shown = min(total, max_rows) if max_rows else total
+    chunk_count = max(ceil(shown / chunk_rows), 1)
+
+    iterator = rows.iterator(chunk_size=chunk_rows) if isinstance(rows, QuerySet) else iter(rows)
+    iterator = islice(iterator, shown)
+    template = get_template(template_src)
+    truncated = {'shown': shown, 'total': total} if shown < total else None
+
+    def html_parts():
+        for index in range(chunk_count):
+            chunk = list(islice(iterator, chunk_rows))
+            with pdf_stage('template'):
+                html = template.render({
+                    **context,
+                    rows_key: chunk,
+                    'chunk': {'first': index == 0, 'last': index == chunk_count - 1},
+                    'truncated': truncated,
+                })
+            yield html
+
+    set_backend('chunked')
+    if workers > 1 and chunk_count > 1:
+        parts = []
+        with ProcessPoolExecutor(max_workers=min(workers, chunk_count)) as pool:
+            # Templates render here while the pool lays out earlier chunks;
+            # only a couple of chunks per worker are ever waiting
+            pending = deque()
+            for html in html_parts():
+                pending.append(pool.submit(html_to_pdf_bytes, html))
+                if len(pending) >= 2 * workers:
+                    with pdf_stage('layout'):
+                        parts.append(pending.popleft().result())
+            with pdf_stage('layout'):
+                parts.extend(future.result() for future in pending)
+    else:
+        parts = [html_to_pdf_bytes(html) for html in html_parts()]
+
+    if not all(parts):
+        return None
+    with pdf_stage('merge'):
+        return merge_pdfs(parts)
+
+
+def merge_pdfs(parts):
+    """Concatenate PDF parts and number the pages 'Page n of N' across all of them"""
+    writer = PdfWriter()
+    for part in parts:
+        writer.append(PdfReader(io.BytesIO(part)))
+
+    page_count = len(writer.pages)
+    numbers = io.BytesIO()
+    number_canvas = canvas.Canvas(numbers)
+    for page in writer.pages:
+        width, height = float(page.mediabox.width), float(page.mediabox.height)
+        number_canvas.setPageSize((width, height))
+        number_canvas.setFont('Helvetica', 7)
+        number_canvas.setFillColorRGB(0.4, 0.4, 0.4)
+        number_canvas.drawCentredString(width / 2, 20, f'Page {number_canvas.getPageNumber()} of {page_count}')
+        number_canvas.showPage()
+    number_canvas.save()
+
+    for page, number_page in zip(writer.pages, PdfReader(numbers).pages):
+        page.merge_page(number_page)
+
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
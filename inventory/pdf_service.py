@@ -0,0 +1,70 @@
+"""
+Out-of-worker PDF layout over a local Unix socket.
+
+The xhtml2pdf layout is the CPU-heavy part of a PDF request. When
+PDF_RENDER_SOCKET is set, web workers render the template themselves (the
+context holds model instances, which need the database) and send the HTML
+to the pdf_render_server daemon, whose prewarmed process pool lays it out.
+If the daemon is not running, the PDF is laid out in-process as before. Once
+the HTML has been sent it is not laid out again in the worker: a daemon that
+does not answer within PDF_RENDER_TIMEOUT seconds fails the render, so a slow
+layout cannot run twice and outlast the gunicorn worker timeout.
+
+Each message is a 4-byte big-endian length followed by that many bytes: the
+UTF-8 HTML one way and the PDF the other. A zero-length reply means the
+layout failed.
+"""
+import socket
+import struct
+
+from django.conf import settings
+
+HEADER = struct.Struct('!I')
+
+
+class ServiceUnavailable(OSError):
+    """The daemon could not be reached, so no layout was started"""
+
+
+def socket_path():
+    return getattr(settings, 'PDF_RENDER_SOCKET', None)
+
+
+def timeout():
+    return getattr(settings, 'PDF_RENDER_TIMEOUT', 30)
+
+
+def render_remote(html, path, seconds):
+    """
+    Lay out HTML in the daemon listening on path. Returns None if the layout
+    failed. Raises ServiceUnavailable if the daemon cannot be reached, and
+    any other OSError if it times out or drops the connection mid-layout.
+    """
+    payload = html.encode('utf-8')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(seconds)
+        try:
+            sock.connect(path)
+        except OSError as exc:
+            raise ServiceUnavailable(exc) from exc
+        send_message(sock, payload)
+        return recv_message(sock) or None
+
+
+def send_message(sock, payload):
+    sock.sendall(HEADER.pack(len(payload)) + payload)
+
+
+def recv_message(sock):
+    size, = HEADER.unpack(_recv_exact(sock, HEADER.size))
+    return _recv_exact(sock, size)
+
+
+def _recv_exact(sock, size):
+    buffer = bytearray()
+    while len(buffer) < size:
+        data = sock.recv(min(size - len(buffer), 1 << 16))
+        if not data:
+            raise ConnectionError('Connection closed mid-message')
+        buffer.extend(data)
+    return bytes(buffer)
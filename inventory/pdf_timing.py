@@ -0,0 +1,160 @@
+"""
+Stage timing for PDF requests.
+
+A PdfTimer is active for the duration of a decorated PDF view. Database
+time is measured with a connection execute wrapper; the render helpers
+mark their template and layout stages with pdf_stage(), and each stage is
+recorded net of the queries run inside it, so the stages do not overlap.
+Each request's timings go out as a Server-Timing header and a structured
+log line, and are stored as a PdfRenderTiming row for the p50/p95 summary
+in the admin. Rows older than PDF_TIMING_RETENTION_DAYS are deleted by the
+request that records a timing, at most once every PRUNE_SECONDS per process.
+"""
+import json
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.db import connection
+
+from .models import PdfRenderTiming
+
+logger = logging.getLogger('inventory.pdf')
+
+STAGES = ('db', 'template', 'layout', 'merge')
+
+_local = threading.local()
+
+PRUNE_SECONDS = 3600
+
+_pruned_at = None
+
+PAGE_PATTERN = re.compile(rb'/Type\s*/Page(?![a-zA-Z])')
+
+
+class PdfTimer:
+    def __init__(self):
+        self.durations = dict.fromkeys(STAGES, 0.0)
+        self.queries = 0
+        self.backend = 'html'
+
+    def __call__(self, execute, sql, params, many, context):
+        # Connection execute wrapper
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.durations['db'] += time.perf_counter() - started
+            self.queries += 1
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        db_before = self.durations['db']
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started - (self.durations['db'] - db_before)
+            self.durations[name] = self.durations.get(name, 0.0) + elapsed
+
+
+@contextmanager
+def pdf_stage(name):
+    """Time a stage of the current PDF request; a no-op outside timed views"""
+    timer = getattr(_local, 'timer', None)
+    if timer is None:
+        yield
+        return
+    with timer.stage(name):
+        yield
+
+
+def set_backend(backend):
+    timer = getattr(_local, 'timer', None)
+    if timer is not None:
+        timer.backend = backend
+
+
+def page_count(pdf):
+    """Pages in a PDF without parsing it; None if it cannot be counted"""
+    if not pdf:
+        return None
+    return len(PAGE_PATTERN.findall(pdf)) or None
+
+
+def timed_pdf(report_type_kwarg=None, report_type=None):
+    """
+    Decorator for PDF views: records stage timings for the request. The report
+    type is the named URL kwarg, or the fixed report_type.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            timer = PdfTimer()
+            _local.timer = timer
+            started = time.perf_counter()
+            try:
+                with connection.execute_wrapper(timer):
+                    response = view(request, *args, **kwargs)
+            finally:
+                _local.timer = None
+            total = time.perf_counter() - started
+
+            if response.get('Content-Type') != 'application/pdf':
+                return response
+            kind = kwargs.get(report_type_kwarg) if report_type_kwarg else report_type
+            _record(request, response, timer, total, kind)
+            return response
+        return wrapper
+    return decorator
+
+
+def _record(request, response, timer, total, report_type):
+    if getattr(response, 'streaming', False):
+        size, pages = int(response.get('Content-Length') or 0), None
+    else:
+        size, pages = len(response.content), page_count(response.content)
+    cached = not any(timer.durations[name] for name in ('template', 'layout'))
+
+    metrics = [f'{name};dur={timer.durations[name] * 1000:.1f}' for name in STAGES if timer.durations[name]]
+    metrics.append(f'total;dur={total * 1000:.1f}')
+    response['Server-Timing'] = ', '.join(metrics)
+
+    record = {
+        'report_type': report_type,
+        'backend': 'cache' if cached else timer.backend,
+        'status': response.status_code,
+        'total_ms': round(total * 1000, 1),
+        'queries': timer.queries,
+        'size_bytes': size,
+        'pages': pages,
+        **{f'{name}_ms': round(timer.durations[name] * 1000, 1) for name in STAGES},
+    }
+    logger.info('pdf_render %s', json.dumps(record), extra={'pdf_render': record})
+
+    PdfRenderTiming.objects.create(
+        report_type=report_type,
+        backend=record['backend'],
+        total_ms=record['total_ms'],
+        db_ms=record['db_ms'],
+        template_ms=record['template_ms'],
+        layout_ms=record['layout_ms'],
+        merge_ms=record['merge_ms'],
+        queries=timer.queries,
+        size_bytes=size,
+        pages=pages,
+        user=request.user if request.user.is_authenticated else None,
+    )
+    _prune()
+
+
+def _prune():
+    global _pruned_at
+    now = time.monotonic()
+    if _pruned_at is not None and now - _pruned_at < PRUNE_SECONDS:
+        return
+    _pruned_at = now
+    PdfRenderTiming.prune()
@@ -0,0 +1,113 @@
+"""
+Set-based bulk repricing.
+
+A rule is turned into a single SQL expression, so repricing any number of
+products is one UPDATE plus one bulk_create of price history rows, instead of
+a save() per product.
+"""
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import DecimalField, ExpressionWrapper, F, Value
+from django.db.models.functions import Greatest, Round
+from django.utils import timezone
+
+from .models import Product, ProductPriceHistory
+
+REPRICE_MODES = (
+    ('percent', 'Change selling price by a percentage'),
+    ('absolute', 'Change selling price by a fixed amount'),
+    ('margin', 'Set selling price to a margin over buying price'),
+)
+
+PREVIEW_ROWS = 50
+
+CENTS = Decimal('0.01')
+
+
+def reprice_expression(mode, value):
+    """
+    Build the new selling price expression for a rule. Margin follows
+    Product.profit_margin, i.e. a percentage of the buying price.
+    """
+    value = Value(Decimal(value), output_field=DecimalField())
+    hundred = Value(Decimal('100'), output_field=DecimalField())
+
+    if mode == 'percent':
+        expression = F('selling_price') * (hundred + value) / hundred
+    elif mode == 'absolute':
+        expression = F('selling_price') + value
+    elif mode == 'margin':
+        expression = F('buying_price') * (hundred + value) / hundred
+    else:
+        raise ValueError(f'Unknown repricing mode "{mode}"')
+
+    # Never go below zero, and round to the field's two decimal places
+    zero = Value(Decimal('0'), output_field=DecimalField())
+    return Round(
+        Greatest(ExpressionWrapper(expression, output_field=DecimalField()), zero),
+        2,
+        output_field=DecimalField(max_digits=10, decimal_places=2),
+    )
+
+
+def repriced_products(products, mode, value):
+    """Products from the filtered set whose selling price the rule would change"""
+    return Product.objects.filter(id__in=products.values('id')).exclude(
+        selling_price=reprice_expression(mode, value)
+    )
+
+
+def preview_reprice(products, mode, value):
+    """Return (count, sample rows, total selling price change) without writing anything"""
+    repriced = repriced_products(products, mode, value).annotate(
+        new_selling_price=reprice_expression(mode, value)
+    ).order_by('sku', 'id')
+    rows = []
+    count = 0
+    total_change = Decimal('0')
+    for row in repriced.values('id', 'sku', 'name', 'warehouse__name', 'buying_price', 'selling_price', 'new_selling_price').iterator(chunk_size=2000):
+        count += 1
+        new_price = Decimal(str(row['new_selling_price'])).quantize(CENTS)
+        total_change += new_price - row['selling_price']
+        if len(rows) < PREVIEW_ROWS:
+            row['new_selling_price'] = new_price
+            row['change'] = new_price - row['selling_price']
+            rows.append(row)
+    return count, rows, total_change
+
+
+def apply_reprice(products, mode, value, user=None, note=''):
+    """
+    Apply a repricing rule with one UPDATE and record the price history with
+    bulk_create. Returns the number of products repriced.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        repriced = repriced_products(products, mode, value)
+        history = [
+            ProductPriceHistory(
+                product_id=product_id,
+                buying_price=buying_price,
+                selling_price=Decimal(str(new_price)).quantize(CENTS),
+                previous_buying_price=buying_price,
+                previous_selling_price=old_price,
+                source='reprice',
+                note=note,
+                changed_by=user,
+                changed_at=now,
+            )
+            for product_id, buying_price, old_price, new_price in repriced.select_for_update().annotate(
+                new_selling_price=reprice_expression(mode, value)
+            ).values_list('id', 'buying_price', 'selling_price', 'new_selling_price').iterator(chunk_size=2000)
+        ]
+        if not history:
+            return 0
+
+        # Same filter and expression as the rows read above, in the same transaction
+        repriced.update(
+            selling_price=reprice_expression(mode, value),
+            updated_at=now,
+        )
+        ProductPriceHistory.objects.bulk_create(history, batch_size=1000)
+    return len(history)
@@ -0,0 +1,302 @@
+"""
+ReportLab backend for the tabular PDF reports.
+
+The HTML backend (xhtml2pdf) builds a DOM for the whole report and matches
+CSS against every cell, so sales, purchase and wastage reports with tens of
+thousands of rows are slow and memory hungry. Here the report query is read
+with values().iterator() and handed to platypus one page at a time: the
+flowables list given to doc.build() is topped up with a table sized to the
+space left in the current frame whenever it runs empty, so only the current
+page's rows are held as Python objects.
+"""
+import io
+from collections import namedtuple
+from itertools import islice
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.utils import timezone
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4, landscape
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.lib.units import cm
+from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+from .pdf_timing import pdf_stage, set_backend
+
+FONT_SIZE = 7
+ROW_HEIGHT = FONT_SIZE * 1.2 + 6
+MARGIN = 1.5 * cm
+
+Column = namedtuple('Column', 'title width align value')
+
+
+def _date(row):
+    return timezone.localtime(row['transaction_date']).strftime('%Y-%m-%d')
+
+
+def _text(field, default='-'):
+    return lambda row: str(row[field]) if row[field] not in (None, '') else default
+
+
+def _tax_rate(field):
+    return lambda row: str(row[field] or 0) if row['apply_taxes'] else '-'
+
+
+def _final_price(fallback):
+    return lambda row: str(row['final_price'] if row['apply_taxes'] and row['final_price'] else row[fallback])
+
+
+def _loss(row):
+    # Wastage is shown as a positive loss
+    value = row['profit_loss']
+    return f'{-value:.2f}' if value < 0 else str(value)
+
+
+def _notes(row):
+    notes = row['notes'] or ''
+    return (notes[:29] + '…' if len(notes) > 30 else notes) or '-'
+
+
+def _amount(value):
+    return f'{value or 0:.2f}'
+
+
+ReportTable = namedtuple('ReportTable', 'queryset_key fields columns totals')
+
+REPORT_TABLES = {
+    'sales': ReportTable(
+        queryset_key='sales',
+        fields=(
+            'transaction_date', 'product__name', 'quantity', 'product__unit_of_measure', 'buying_price',
+            'selling_price', 'apply_taxes', 'vat_rate', 'ait_rate', 'final_price', 'total_price',
+            'profit_loss', 'client__name', 'reference_number',
+        ),
+        columns=(
+            Column('Date', 9, 'LEFT', _date),
+            Column('Product', 17, 'LEFT', _text('product__name')),
+            Column('Qty', 6, 'RIGHT', _text('quantity')),
+            Column('UOM', 5, 'LEFT', _text('product__unit_of_measure')),
+            Column('Buying', 7, 'RIGHT', _text('buying_price')),
+            Column('Selling', 7, 'RIGHT', _text('selling_price')),
+            Column('VAT (%)', 5, 'RIGHT', _tax_rate('vat_rate')),
+            Column('AIT (%)', 5, 'RIGHT', _tax_rate('ait_rate')),
+            Column('Final', 7, 'RIGHT', _final_price('selling_price')),
+            Column('Total', 8, 'RIGHT', _text('total_price')),
+            Column('Profit/Loss', 7, 'RIGHT', _text('profit_loss')),
+            Column('Client', 10, 'LEFT', _text('client__name')),
+            Column('Reference', 7, 'LEFT', _text('reference_number')),
+        ),
+        totals=lambda context: (
+            ('Total Quantity Sold', str(context['total_quantity_sold'])),
+            ('Total Sales', _amount(context['total_sales'])),
+            ('Cost of Goods Sold', _amount(context['total_cost_of_goods'])),
+            ('Profit', _amount(context['total_profit'])),
+        ),
+    ),
+    'purchase': ReportTable(
+        queryset_key='purchases',
+        fields=(
+            'transaction_date', 'product__name', 'quantity', 'product__unit_of_measure', 'buying_price',
+            'apply_taxes', 'vat_rate', 'ait_rate', 'final_price', 'total_price', 'product__supplier__name',
+            'reference_number',
+        ),
+        columns=(
+            Column('Date', 9, 'LEFT', _date),
+            Column('Product', 20, 'LEFT', _text('product__name')),
+            Column('Qty', 6, 'RIGHT', _text('quantity')),
+            Column('UOM', 5, 'LEFT', _text('product__unit_of_measure')),
+            Column('Buying Price', 8, 'RIGHT', _text('buying_price')),
+            Column('VAT (%)', 6, 'RIGHT', _tax_rate('vat_rate')),
+            Column('AIT (%)', 6, 'RIGHT', _tax_rate('ait_rate')),
+            Column('Final Price', 8, 'RIGHT', _final_price('buying_price')),
+            Column('Total Price', 9, 'RIGHT', _text('total_price')),
+            Column('Supplier', 14, 'LEFT', _text('product__supplier__name')),
+            Column('Reference', 9, 'LEFT', _text('reference_number')),
+        ),
+        totals=lambda context: (
+            ('Total Quantity Purchased', str(context['total_quantity_purchased'])),
+            ('Total Purchases', _amount(context['total_purchases'])),
+        ),
+    ),
+    'wastage': ReportTable(
+        queryset_key='wastage',
+        fields=(
+            'transaction_date', 'product__name', 'quantity', 'buying_price', 'unit_price',
+            'wastage_amount', 'profit_loss', 'total_price', 'notes',
+        ),
+        columns=(
+            Column('Date', 9, 'LEFT', _date),
+            Column('Product', 20, 'LEFT', _text('product__name')),
+            Column('Type', 7, 'LEFT', lambda row: 'Wastage'),
+            Column('Qty', 6, 'RIGHT', _text('quantity')),
+            Column('Buying', 8, 'RIGHT', _text('buying_price')),
+            Column('Unit Price', 8, 'RIGHT', _text('unit_price')),
+            Column('Wastage', 8, 'RIGHT', _text('wastage_amount')),
+            Column('Profit/Loss', 8, 'RIGHT', _loss),
+            Column('Total', 8, 'RIGHT', _text('total_price')),
+            Column('Notes', 18, 'LEFT', _notes),
+        ),
+        totals=lambda context: (
+            ('Total Wastage Value', _amount(context['total_wastage'])),
+        ),
+    ),
+}
+
+
+def use_reportlab(report_type, requested=None):
+    """
+    Whether a report renders with this backend: ?backend= on the request wins,
+    then REPORT_PDF_BACKENDS; types without a table layout always use HTML.
+    """
+    if report_type not in REPORT_TABLES:
+        return False
+    backend = requested or getattr(settings, 'REPORT_PDF_BACKENDS', {}).get(report_type, 'html')
+    return backend == 'reportlab'
+
+
+class _PageFeed(list):
+    """
+    Flowables list for doc.build() that is refilled with the next page of
+    the table whenever the document has consumed everything in it.
+    """
+
+    def __init__(self, head, next_page, tail):
+        super().__init__(head)
+        self.next_page = next_page
+        self.tail = tail
+
+    def __len__(self):
+        if not super().__len__() and self.next_page is not None:
+            page = self.next_page()
+            if page is None:
+                self.next_page = None
+                self.extend(self.tail)
+            else:
+                self.append(page)
+        return super().__len__()
+
+
+def render_report_table(report_type, context):
+    """Render a tabular report straight to PDF bytes"""
+    spec = REPORT_TABLES[report_type]
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(
+        buffer, pagesize=landscape(A4),
+        leftMargin=MARGIN, rightMargin=MARGIN, topMargin=MARGIN, bottomMargin=MARGIN,
+        title=context.get('report_title', ''),
+    )
+
+    total_width = sum(column.width for column in spec.columns)
+    col_widths = [doc.width * column.width / total_width for column in spec.columns]
+    # Plain strings do not wrap, so cut cells to roughly what fits their column
+    max_chars = [max(int(width / (FONT_SIZE * 0.5)) - 1, 4) for width in col_widths]
+    header = [column.title for column in spec.columns]
+    style = TableStyle([
+        ('FONT', (0, 0), (-1, -1), 'Helvetica', FONT_SIZE),
+        ('FONT', (0, 0), (-1, 0), 'Helvetica-Bold', FONT_SIZE),
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#f2f2f2')),
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor('#dddddd')),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('TOPPADDING', (0, 0), (-1, -1), 2),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
+    ] + [
+        ('ALIGN', (index, 0), (index, -1), column.align)
+        for index, column in enumerate(spec.columns) if column.align != 'LEFT'
+    ])
+
+    rows = (
+        [
+            _fit(column.value(row), limit)
+            for column, limit in zip(spec.columns, max_chars)
+        ]
+        for row in context[spec.queryset_key].values(*spec.fields).iterator(chunk_size=2000)
+    )
+
+    def next_page():
+        # Fill what is left of the current frame, or a whole new one
+        frame = doc.frame
+        available = frame._y - frame._y1p - 1
+        if available < 2 * ROW_HEIGHT:
+            available = frame._aH - 1
+        page_rows = list(islice(rows, max(int(available // ROW_HEIGHT) - 1, 1)))
+        if not page_rows:
+            return None
+        return Table(
+            [header] + page_rows, colWidths=col_widths,
+            rowHeights=ROW_HEIGHT, repeatRows=1, style=style,
+        )
+
+    feed = _PageFeed(_letterhead(context), next_page, _closing(spec, context))
+    set_backend('reportlab')
+    with pdf_stage('layout'):
+        doc.build(feed, onFirstPage=_page_number, onLaterPages=_page_number)
+    return buffer.getvalue()
+
+
+def _fit(text, limit):
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+
+def _styles():
+    return {
+        'company': ParagraphStyle('company', fontName='Helvetica-Bold', fontSize=16, leading=19, alignment=1),
+        'centered': ParagraphStyle('centered', fontName='Helvetica', fontSize=10, leading=12, alignment=1),
+        'small': ParagraphStyle('small', fontName='Helvetica', fontSize=8, leading=10, alignment=1),
+        'title': ParagraphStyle('title', fontName='Helvetica-Bold', fontSize=14, leading=17, alignment=1),
+        'body': ParagraphStyle('body', fontName='Helvetica', fontSize=8, leading=10),
+        'heading': ParagraphStyle('heading', fontName='Helvetica-Bold', fontSize=8, leading=10, spaceBefore=10),
+    }
+
+
+def _paragraph(text, style):
+    return Paragraph(escape(str(text or '')).replace('\n', '<br/>'), style)
+
+
+def _letterhead(context):
+    styles = _styles()
+    story = [
+        _paragraph(context.get('company_name') or 'QBITX IMS', styles['company']),
+        _paragraph(context.get('company_tagline') or 'Transform Suppliers', styles['centered']),
+        _paragraph(context.get('company_details') or '', styles['small']),
+        Spacer(1, 10),
+        _paragraph(context.get('report_title', ''), styles['title']),
+        _paragraph(context.get('report_subtitle', ''), styles['centered']),
+        _paragraph(f"Generated on: {context.get('generation_date', '')}", styles['small']),
+        Spacer(1, 8),
+    ]
+    if context.get('applied_filters'):
+        story += [_paragraph(f"Applied Filters: {context['applied_filters']}", styles['body']), Spacer(1, 6)]
+    return story
+
+
+def _closing(spec, context):
+    styles = _styles()
+    totals = Table(
+        [[f'{label}:', value] for label, value in spec.totals(context)],
+        style=TableStyle([
+            ('FONT', (0, 0), (-1, -1), 'Helvetica-Bold', 8),
+            ('ALIGN', (0, 0), (-1, -1), 'RIGHT'),
+        ]),
+        hAlign='RIGHT',
+    )
+    story = [Spacer(1, 8), totals, _paragraph('Notes & Terms', styles['heading'])]
+    if context.get('terms_conditions'):
+        story.append(_paragraph(context['terms_conditions'], styles['body']))
+    else:
+        story += [
+            _paragraph('1. This report is generated from the QBITX Inventory Management System.', styles['body']),
+            _paragraph('2. All values are displayed in the default currency.', styles['body']),
+            _paragraph('3. For any questions regarding this report, please contact the system administrator.', styles['body']),
+        ]
+    story.append(Spacer(1, 10))
+    story.append(_paragraph(f'QBITX Inventory Management System © {timezone.localdate().year}', styles['small']))
+    return story
+
+
+def _page_number(canvas, doc):
+    canvas.saveState()
+    canvas.setFont('Helvetica', 7)
+    canvas.setFillColor(colors.HexColor('#666666'))
+    canvas.drawRightString(doc.pagesize[0] - MARGIN, MARGIN / 2, f'Page {doc.page}')
+    canvas.restoreState()
@@ -0,0 +1,83 @@
+"""
+Product full-text search.
+
+On SQLite the products are indexed in an FTS5 virtual table that is kept up
+to date by triggers (see migration 0019). Other database backends, or SQLite
+builds without FTS5, fall back to a single icontains filter.
+"""
+import re
+
+from django.db import connection
+from django.db.models import Case, F, IntegerField, Q, Value, When
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = 'inventory_product_fts'
+
+# Column weights for bm25(): name, sku, description, category, supplier
+FTS_WEIGHTS = (4.0, 8.0, 1.0, 2.0, 2.0)
+
+_fts_available = None
+
+
+def fts_available():
+    """Return True when the FTS5 product index exists on the default database"""
+    global _fts_available
+    if _fts_available is None:
+        _fts_available = (
+            connection.vendor == 'sqlite'
+            and FTS_TABLE in connection.introspection.table_names()
+        )
+    return _fts_available
+
+
+def build_match_query(search_query):
+    """
+    Turn free text into an FTS5 MATCH expression where every term is a
+    quoted prefix query, e.g. 'black pep' -> '"black"* "pep"*'.
+    """
+    terms = re.findall(r'[^\s"]+', search_query)
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def search_products(queryset, search_query):
+    """
+    Filter a Product queryset by a search string, ordered by relevance.
+    Exact SKU matches always come first.
+    """
+    search_query = search_query.strip()
+    if not search_query:
+        return queryset
+
+    exact_sku_first = Case(
+        When(sku__iexact=search_query, then=Value(0)),
+        default=Value(1),
+        output_field=IntegerField(),
+    )
+
+    match_query = build_match_query(search_query)
+    if match_query and fts_available():
+        weights = ', '.join(str(weight) for weight in FTS_WEIGHTS)
+        matches = RawSQL(
+            f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s',
+            (match_query,),
+        )
+        rank = RawSQL(
+            f'SELECT bm25({FTS_TABLE}, {weights}) FROM {FTS_TABLE} '
+            f'WHERE {FTS_TABLE} MATCH %s AND {FTS_TABLE}.rowid = inventory_product.id',
+            (match_query,),
+        )
+        # FTS terms only match from the start of a token, so SKU fragments
+        # ("123" in "SKU-123") are matched as before, after the ranked hits
+        return queryset.filter(Q(id__in=matches) | Q(sku__icontains=search_query)).annotate(
+            exact_sku=exact_sku_first,
+            search_rank=rank,
+        ).order_by('exact_sku', F('search_rank').asc(nulls_last=True), 'id')
+
+    # Fallback: one query over the same columns, joins are all to-one so no distinct() is needed
+    return queryset.filter(
+        Q(sku__icontains=search_query) |
+        Q(name__icontains=search_query) |
+        Q(description__icontains=search_query) |
+        Q(category__name__icontains=search_query) |
+        Q(supplier__name__icontains=search_query)
+    ).annotate(exact_sku=exact_sku_first).order_by('exact_sku', 'name', 'id')
@@ -0,0 +1,169 @@
+"""
+Signal handlers that keep denormalized inventory data in sync with the
+source tables.
+"""
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+from decimal import Decimal
+
+from .models import Product, ProductStock, StockLot, CostLayer, StockTransaction, KpiCounter, ProductPriceHistory
+from .lookup import product_index
+
+
+def _stored_instance(instance):
+    """Fetch the currently stored copy of an instance, or None if it is new"""
+    if instance.pk is None:
+        return None
+    return type(instance).objects.filter(pk=instance.pk).first()
+
+
+# KPI counters
+
+@receiver(pre_save, sender=Product)
+def remember_product_kpis(sender, instance, raw=False, **kwargs):
+    stored = None if raw else _stored_instance(instance)
+    instance._old_kpi = stored.kpi_contribution() if stored else None
+    instance._old_lookup_key = _lookup_key(stored) if stored else None
+    instance._old_prices = (stored.buying_price, stored.selling_price) if stored else None
+    instance._old_stock_basis = (stored.quantity, stored.buying_price, stored.reorder_level) if stored else None
+
+
+@receiver(post_save, sender=Product)
+def update_product_kpis(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    old = getattr(instance, '_old_kpi', None)
+    new = instance.kpi_contribution()
+    if old and old[0] == new[0]:
+        KpiCounter.apply_delta(new[0], inventory_value=new[1] - old[1], low_stock_count=new[2] - old[2])
+    else:
+        if old:
+            KpiCounter.apply_delta(old[0], inventory_value=-old[1], low_stock_count=-old[2])
+        KpiCounter.apply_delta(new[0], inventory_value=new[1], low_stock_count=new[2])
+    instance._old_kpi = new
+
+
+@receiver(pre_delete, sender=Product)
+def remember_product_stock_levels(sender, instance, **kwargs):
+    # The stock levels are cascaded away before post_delete runs
+    instance._stock_levels = list(instance.stock_levels.values_list('warehouse_id', 'quantity'))
+
+
+@receiver(post_delete, sender=Product)
+def remove_product_kpis(sender, instance, **kwargs):
+    warehouse_id, value, low_stock = instance.kpi_contribution()
+    KpiCounter.apply_delta(warehouse_id, inventory_value=-value, low_stock_count=-low_stock)
+    for warehouse_id, quantity in getattr(instance, '_stock_levels', []):
+        value, low_stock = ProductStock.kpi_values(quantity, instance.buying_price, instance.reorder_level)
+        KpiCounter.apply_delta(warehouse_id, inventory_value=-value, low_stock_count=-low_stock, include_global=False)
+
+
+# Per-warehouse stock levels
+
+@receiver(post_save, sender=Product)
+def sync_product_stock(sender, instance, created=False, raw=False, **kwargs):
+    """
+    Book changes of Product.quantity against the cost layers and against
+    a warehouse's stock level and lots. Stock transactions set
+    _stock_warehouse_id to the warehouse they move stock in or out of and
+    _stock_source to themselves; other saves (e.g. the product form) use
+    the home warehouse. Stock without any warehouse is only kept in the
+    total and the cost layers.
+    """
+    if raw:
+        return
+    old = getattr(instance, '_old_stock_basis', None)
+    if old:
+        old_quantity, old_buying_price, old_reorder_level = old
+        if (old_buying_price, old_reorder_level) != (instance.buying_price, instance.reorder_level):
+            ProductStock.revalue(instance, old_buying_price, old_reorder_level)
+    else:
+        old_quantity = Decimal('0')
+    
+    delta = Decimal(str(instance.quantity or 0)) - Decimal(str(old_quantity or 0))
+    source = getattr(instance, '_stock_source', None)
+    if delta:
+        CostLayer.book(instance, delta, source=source)
+    warehouse_id = getattr(instance, '_stock_warehouse_id', None) or instance.warehouse_id
+    if warehouse_id and (delta or created):
+        ProductStock.adjust(instance, warehouse_id, delta)
+        if delta:
+            StockLot.book(instance, warehouse_id, delta, source=source)
+    instance._stock_warehouse_id = None
+    instance._stock_source = None
+    instance._old_stock_basis = (instance.quantity, instance.buying_price, instance.reorder_level)
+
+
+@receiver(pre_save, sender=StockTransaction)
+def remember_transaction_kpis(sender, instance, raw=False, **kwargs):
+    stored = None if raw else _stored_instance(instance)
+    instance._old_kpi = stored.kpi_contribution() if stored else None
+
+
+@receiver(post_save, sender=StockTransaction)
+def update_transaction_kpis(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    old = getattr(instance, '_old_kpi', None)
+    new = instance.kpi_contribution()
+    if old:
+        KpiCounter.apply_delta(old[0], due_receivables=-old[1], due_payables=-old[2])
+    KpiCounter.apply_delta(new[0], due_receivables=new[1], due_payables=new[2])
+    instance._old_kpi = new
+
+
+@receiver(post_delete, sender=StockTransaction)
+def remove_transaction_kpis(sender, instance, **kwargs):
+    warehouse_id, receivables, payables = instance.kpi_contribution()
+    KpiCounter.apply_delta(warehouse_id, due_receivables=-receivables, due_payables=-payables)
+
+
+# Product lookup index
+
+def _lookup_key(product):
+    """The fields the in-memory lookup index is built from"""
+    return (product.sku, product.name)
+
+
+@receiver(post_save, sender=Product)
+def refresh_product_lookup(sender, instance, **kwargs):
+    # Stock movements only change quantities, so most saves leave the index alone
+    if getattr(instance, '_old_lookup_key', None) != _lookup_key(instance):
+        product_index.invalidate()
+    instance._old_lookup_key = _lookup_key(instance)
+
+
+@receiver(post_delete, sender=Product)
+def drop_product_lookup(sender, instance, **kwargs):
+    product_index.invalidate()
+
+
+@receiver(post_save, sender=ProductStock)
+def add_stock_level_lookup(sender, instance, created=False, **kwargs):
+    # Warehouse filters match on stock levels, so a product reaching a new warehouse changes the index
+    if created:
+        product_index.invalidate()
+
+
+# Price history
+
+@receiver(post_save, sender=Product)
+def record_price_change(sender, instance, created=False, raw=False, update_fields=None, **kwargs):
+    """
+    Views can set _price_change_source / _price_changed_by on the instance
+    before saving to describe where the change came from.
+    """
+    if raw or (update_fields is not None and not {'buying_price', 'selling_price'} & set(update_fields)):
+        return
+    old = getattr(instance, '_old_prices', None)
+    if created or old is None:
+        ProductPriceHistory.record(instance, source='initial', changed_by=getattr(instance, '_price_changed_by', None))
+    elif (Decimal(str(old[0])), Decimal(str(old[1]))) != (Decimal(str(instance.buying_price)), Decimal(str(instance.selling_price))):
+        ProductPriceHistory.record(
+            instance,
+            previous_buying_price=old[0],
+            previous_selling_price=old[1],
+            source=getattr(instance, '_price_change_source', 'manual'),
+            changed_by=getattr(instance, '_price_changed_by', None),
+        )
+    instance._old_prices = (instance.buying_price, instance.selling_price)
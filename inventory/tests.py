@@ -1,3 +1,362 @@
-from django.test import TestCase
+import os
+import socket
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import pdf_cache
+from .catalog import catalog_stamp
+from .models import (
+    Client, Invoice, InvoiceItem, InvoiceSequence, KpiCounter, Payment, PdfRenderTiming, Product, ProductStock,
+    StockAlertDigest, StockLot, StockTransaction, Warehouse,
+)
+from .payment_allocation import AllocationError, apply_allocation, open_transactions
+from .search import search_products
+from .utils import layout_pdf
+
+
+class InvoiceSequenceTests(TestCase):
+    def setUp(self):
+        self.client_record = Client.objects.create(name='Acme')
+
+    def create_invoice(self, invoice_number):
+        return Invoice.objects.create(
+            invoice_number=invoice_number,
+            client=self.client_record,
+            issue_date=timezone.localdate(),
+            subtotal=10,
+            total=10,
+        )
+
+    def test_reserve_skips_number_typed_by_hand(self):
+        self.create_invoice(InvoiceSequence.next_number())
+        self.create_invoice('000002')
+
+        self.assertEqual(InvoiceSequence.peek(), '000003')
+        self.create_invoice(InvoiceSequence.next_number())
+        self.assertEqual(
+            sorted(Invoice.objects.values_list('invoice_number', flat=True)),
+            ['000001', '000002', '000003'],
+        )
+
+    def test_number_in_another_format_leaves_sequence_alone(self):
+        self.create_invoice(InvoiceSequence.next_number())
+        self.create_invoice('INV-000050')
+        self.create_invoice('50')
+
+        self.assertEqual(InvoiceSequence.next_number(), '000002')
+
+
+class StockLotTransferTests(TestCase):
+    def setUp(self):
+        self.source = Warehouse.objects.create(name='Main', location='Dhaka')
+        self.destination = Warehouse.objects.create(name='Branch', location='Chittagong')
+        self.product = Product.objects.create(
+            name='Milk', sku='MILK-1', warehouse=self.source, quantity=0, reorder_level=1,
+            buying_price=2, selling_price=3, unit_of_measure='l',
+        )
+        today = timezone.localdate()
+        self.move(transaction_type='in', quantity=10, destination_warehouse=self.source,
+                  lot_number='LATE', expiry_date=today + timedelta(days=60))
+        self.move(transaction_type='in', quantity=5, destination_warehouse=self.source,
+                  lot_number='SOON', expiry_date=today + timedelta(days=10))
+
+    def move(self, **kwargs):
+        return StockTransaction.objects.create(
+            product=Product.objects.get(pk=self.product.pk), unit_price=2, buying_price=2, selling_price=3,
+            transaction_date=timezone.now(), **kwargs
+        )
+
+    def lots(self, warehouse):
+        return list(
+            StockLot.objects.filter(product=self.product, warehouse=warehouse)
+            .order_by('expiry_date').values_list('lot_number', 'quantity')
+        )
+
+    def test_transfer_moves_first_expiring_lots(self):
+        self.move(transaction_type='transfer', quantity=6, source_warehouse=self.source,
+                  destination_warehouse=self.destination)
+
+        self.assertEqual(self.lots(self.source), [('SOON', 0), ('LATE', 9)])
+        self.assertEqual(self.lots(self.destination), [('SOON', 5), ('LATE', 1)])
+
+    def test_sale_after_transfer_consumes_first_expiring_lot(self):
+        self.move(transaction_type='transfer', quantity=6, source_warehouse=self.source,
+                  destination_warehouse=self.destination)
+        sale = self.move(transaction_type='out', quantity=3, source_warehouse=self.destination)
+
+        self.assertEqual(self.lots(self.destination), [('SOON', 2), ('LATE', 1)])
+        self.assertEqual(list(sale.lot_allocations.values_list('lot__lot_number', 'quantity')), [('SOON', 3)])
+
+
+class PaymentAllocationTests(TestCase):
+    def setUp(self):
+        self.warehouse = Warehouse.objects.create(name='Main', location='Dhaka')
+        self.client_record = Client.objects.create(name='Acme')
+        product = Product.objects.create(
+            name='Rice', sku='RICE-1', warehouse=self.warehouse, quantity=100, reorder_level=5,
+            buying_price=5, selling_price=7, unit_of_measure='kg',
+        )
+        self.sales = [
+            StockTransaction.objects.create(
+                product=product, transaction_type='out', quantity=2, unit_price=7, buying_price=5,
+                selling_price=7, transaction_date=timezone.now() - timedelta(days=days),
+                client=self.client_record, source_warehouse=self.warehouse, payment_status='due',
+            )
+            for days in (3, 2, 1)
+        ]
+
+    def test_allocation_keeps_kpi_counters_in_sync(self):
+        apply_allocation(
+            open_transactions(client=self.client_record), Decimal('20'), payment_date=timezone.localdate(),
+        )
+
+        states = [
+            StockTransaction.objects.values_list('payment_status', 'amount_due').get(pk=sale.pk)
+            for sale in self.sales
+        ]
+        self.assertEqual(states, [('paid', 0), ('partial', Decimal('8')), ('due', Decimal('14'))])
+        self.assertEqual(KpiCounter.for_warehouse(self.warehouse.id).due_receivables, Decimal('22'))
+
+        out = StringIO()
+        call_command('reconcile_kpis', dry_run=True, stdout=out)
+        self.assertIn('KPI counters are in sync.', out.getvalue())
+
+    def test_allocation_over_open_balance_is_rejected(self):
+        with self.assertRaises(AllocationError):
+            apply_allocation(
+                open_transactions(client=self.client_record), Decimal('43'), payment_date=timezone.localdate(),
+            )
+        self.assertFalse(Payment.objects.exists())
+
+    def test_split_amount_that_is_not_a_number_is_rejected(self):
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.force_login(user)
+        response = self.client.post(reverse('payment_allocate'), {
+            'client': self.client_record.id,
+            'amount': '14',
+            'payment_date': timezone.localdate().isoformat(),
+            'payment_method': 'bank',
+            'mode': 'split',
+            'apply': '1',
+            f'allocate_{self.sales[0].id}': 'NaN',
+        })
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('is not a valid amount', ' '.join(str(message) for message in response.context['messages']))
+        self.assertFalse(Payment.objects.exists())
+
+
+@override_settings(INVOICE_BILLING_MODE='consolidated')
+class ConsolidatedBillingTests(TestCase):
+    def setUp(self):
+        warehouse = Warehouse.objects.create(name='Main', location='Dhaka')
+        self.client_record = Client.objects.create(name='Acme')
+        product = Product.objects.create(
+            name='Rice', sku='RICE-1', warehouse=warehouse, quantity=100, reorder_level=5,
+            buying_price=5, selling_price=7, unit_of_measure='kg',
+        )
+        sale_date = timezone.now() - timedelta(days=40)
+        self.sales = [
+            StockTransaction.objects.create(
+                product=product, transaction_type='out', quantity=quantity, unit_price=7, buying_price=5,
+                selling_price=7, transaction_date=sale_date, client=self.client_record,
+                source_warehouse=warehouse, payment_status='paid',
+            )
+            for quantity in (1, 2, 3)
+        ]
+        call_command('build_invoices', period='month', stdout=StringIO())
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.force_login(user)
+
+    def test_build_invoices_bills_each_sale_once(self):
+        invoice = Invoice.objects.get()
+        self.assertEqual(invoice.items.count(), 3)
+        self.assertEqual(invoice.total, Decimal('42'))
+
+        call_command('build_invoices', period='month', stdout=StringIO())
+        self.assertEqual(Invoice.objects.count(), 1)
+
+    def test_deleting_a_sale_removes_its_invoice_line(self):
+        invoice = Invoice.objects.get()
+        self.client.post(reverse('stock_transaction_delete', args=[self.sales[1].pk]))
+
+        invoice.refresh_from_db()
+        self.assertEqual(list(invoice.items.order_by('id').values_list('quantity', flat=True)), [1, 3])
+        self.assertEqual((invoice.subtotal, invoice.total), (Decimal('28'), Decimal('28')))
+
+    def test_failed_delete_leaves_invoice_and_stock_alone(self):
+        sale = self.sales[1]
+        with mock.patch.object(StockTransaction, 'delete', side_effect=ValidationError('Locked.')):
+            self.client.post(reverse('stock_transaction_delete', args=[sale.pk]))
+
+        invoice = Invoice.objects.get()
+        self.assertEqual(invoice.items.count(), 3)
+        self.assertEqual(invoice.total, Decimal('42'))
+        self.assertEqual(Product.objects.get(pk=sale.product_id).quantity, 94)
+
+    def test_deleting_every_sale_deletes_the_invoice(self):
+        for sale in self.sales:
+            self.client.post(reverse('stock_transaction_delete', args=[sale.pk]))
+
+        self.assertFalse(Invoice.objects.exists())
+
+    def test_sales_of_a_deleted_invoice_are_not_billed_again(self):
+        Invoice.objects.all().delete()
+        call_command('build_invoices', period='month', stdout=StringIO())
+
+        self.assertFalse(Invoice.objects.exists())
+
+
+class PaymentTests(TestCase):
+    def test_editing_a_payment_keeps_the_opening_amount_paid(self):
+        warehouse = Warehouse.objects.create(name='Main', location='Dhaka')
+        product = Product.objects.create(
+            name='Rice', sku='RICE-1', warehouse=warehouse, quantity=100, reorder_level=5,
+            buying_price=5, selling_price=7, unit_of_measure='kg',
+        )
+        sale = StockTransaction.objects.create(
+            product=product, transaction_type='out', quantity=2, unit_price=7, buying_price=5,
+            selling_price=7, transaction_date=timezone.now(), client=Client.objects.create(name='Acme'),
+            source_warehouse=warehouse, payment_status='partial', amount_paid=4,
+        )
+        payment = Payment.objects.create(transaction=sale, amount=5, payment_date=timezone.localdate())
+
+        payment.amount = 6
+        payment.save()
+
+        sale.refresh_from_db()
+        self.assertEqual((sale.payment_status, sale.amount_paid, sale.amount_due), ('partial', 10, 4))
+        self.assertEqual(KpiCounter.for_warehouse(warehouse.id).due_receivables, Decimal('4'))
+
+
+class InvoicePdfCacheKeyTests(TestCase):
+    def setUp(self):
+        warehouse = Warehouse.objects.create(name='Main', location='Dhaka')
+        self.product = Product.objects.create(
+            name='Rice', sku='RICE-1', warehouse=warehouse, quantity=100, reorder_level=5,
+            buying_price=5, selling_price=7, unit_of_measure='kg',
+        )
+        self.invoice = Invoice.objects.create(
+            invoice_number='000001', client=Client.objects.create(name='Acme'),
+            issue_date=timezone.localdate(), subtotal=14, total=14,
+        )
+        self.item = InvoiceItem.objects.create(invoice=self.invoice, product=self.product, quantity=2, unit_price=7)
+
+    def key(self):
+        invoice = pdf_cache.with_pdf_items(Invoice.objects.all()).get(pk=self.invoice.pk)
+        return pdf_cache.invoice_pdf_key(invoice, {})
+
+    def test_key_changes_when_a_product_is_renamed(self):
+        key = self.key()
+        Product.objects.filter(pk=self.product.pk).update(name='Basmati Rice')
+
+        self.assertNotEqual(self.key(), key)
+
+    def test_key_changes_when_an_item_row_changes(self):
+        key = self.key()
+        InvoiceItem.objects.filter(pk=self.item.pk).update(quantity=3, total_price=21)
+
+        self.assertNotEqual(self.key(), key)
+
+
+class AlertDigestTests(TestCase):
+    def test_low_stock_is_reported_per_warehouse(self):
+        main = Warehouse.objects.create(name='Main', location='Dhaka')
+        branch = Warehouse.objects.create(name='Branch', location='Chittagong')
+        product = Product.objects.create(
+            name='Rice', sku='RICE-1', warehouse=main, quantity=0, reorder_level=5,
+            buying_price=5, selling_price=7, unit_of_measure='kg',
+        )
+        for warehouse, quantity in ((main, 20), (branch, 2)):
+            StockTransaction.objects.create(
+                product=Product.objects.get(pk=product.pk), transaction_type='in', quantity=quantity,
+                unit_price=5, buying_price=5, selling_price=7, transaction_date=timezone.now(),
+                destination_warehouse=warehouse,
+            )
+
+        call_command('alerts', stdout=StringIO())
+
+        digests = {digest.warehouse_id: digest for digest in StockAlertDigest.objects.all()}
+        self.assertEqual(digests[branch.id].low_stock_count, 1)
+        self.assertEqual(digests[branch.id].items['low_stock'][0]['quantity'], '2.000')
+        self.assertNotIn(main.id, digests)
+
+
+class PdfRenderTimingTests(TestCase):
+    @override_settings(PDF_TIMING_RETENTION_DAYS=30)
+    def test_prune_deletes_timings_past_retention(self):
+        old = PdfRenderTiming.objects.create(report_type='invoice', backend='html')
+        PdfRenderTiming.objects.filter(pk=old.pk).update(created_at=timezone.now() - timedelta(days=31))
+        recent = PdfRenderTiming.objects.create(report_type='invoice', backend='cache')
+
+        self.assertEqual(PdfRenderTiming.prune(), 1)
+        self.assertEqual(list(PdfRenderTiming.objects.values_list('pk', flat=True)), [recent.pk])
+
+
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        warehouse = Warehouse.objects.create(name='Main', location='Dhaka')
+        for name, sku in (('Basmati Rice', 'SKU-123'), ('Rice Flour', 'FL-9'), ('Lentils', 'LN-1230')):
+            Product.objects.create(
+                name=name, sku=sku, warehouse=warehouse, quantity=10, reorder_level=5,
+                buying_price=5, selling_price=7, unit_of_measure='kg',
+            )
+
+    def skus(self, search_query):
+        return list(search_products(Product.objects.all(), search_query).values_list('sku', flat=True))
+
+    def test_sku_fragment_inside_a_token_is_found(self):
+        self.assertEqual(sorted(self.skus('123')), ['LN-1230', 'SKU-123'])
+
+    def test_exact_sku_comes_first(self):
+        self.assertEqual(self.skus('sku-123')[0], 'SKU-123')
+        self.assertEqual(sorted(self.skus('rice')), ['FL-9', 'SKU-123'])
+
+
+class CatalogStampTests(TestCase):
+    def test_stamp_changes_when_a_stock_level_is_deleted(self):
+        main = Warehouse.objects.create(name='Main', location='Dhaka')
+        branch = Warehouse.objects.create(name='Branch', location='Chittagong')
+        product = Product.objects.create(
+            name='Rice', sku='RICE-1', warehouse=main, quantity=10, reorder_level=5,
+            buying_price=5, selling_price=7, unit_of_measure='kg',
+        )
+        ProductStock.objects.create(product=product, warehouse=branch, quantity=0)
+        stamp = catalog_stamp()
+
+        ProductStock.objects.filter(warehouse=main).delete()
+
+        self.assertNotEqual(catalog_stamp(), stamp)
+
+
+class PdfRenderServiceTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'pdf-render.sock')
+
+    def test_unreachable_service_falls_back_to_in_process_layout(self):
+        with override_settings(PDF_RENDER_SOCKET=self.path), \
+                mock.patch('inventory.utils.html_to_pdf_bytes', return_value=b'%PDF') as layout:
+            self.assertEqual(layout_pdf('<p>Invoice</p>'), b'%PDF')
+        layout.assert_called_once()
+
+    def test_timed_out_service_is_not_retried_in_process(self):
+        # Accepts the connection but never answers
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(self.path)
+            server.listen(1)
+            with override_settings(PDF_RENDER_SOCKET=self.path, PDF_RENDER_TIMEOUT=0.1), \
+                    mock.patch('inventory.utils.html_to_pdf_bytes') as layout:
+                self.assertIsNone(layout_pdf('<p>Invoice</p>'))
+        layout.assert_not_called()
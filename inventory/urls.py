@@ -8,6 +8,9 @@ urlpatterns = [
     path('products/<int:pk>/edit/', views.product_edit, name='product_edit'),
     path('products/<int:pk>/delete/', views.product_delete, name='product_delete'),
     path('products/duplicate/<int:pk>/', views.product_duplicate, name='product_duplicate'),
+    path('products/reprice/', views.product_reprice, name='product_reprice'),
+    path('products/import/', views.product_import, name='product_import'),
+    path('products/export/', views.product_export, name='product_export'),
     
     path('suppliers/', views.suppliers, name='suppliers'),
     path('suppliers/create/', views.supplier_create, name='supplier_create'),
@@ -36,12 +39,15 @@ urlpatterns = [
     path('stock/create/', views.stock_create, name='stock_create'),
     path('stock/generate-invoice/<int:transaction_id>/', views.generate_invoice_from_transaction, name='generate_invoice_from_transaction'),
     
+    path('reports/stock-pivot/', views.stock_pivot, name='stock_pivot'),
     path('reports/', views.reports, name='reports'),
     path('reports/pdf/', views.customize_pdf, name='customize_pdf'),
     path('reports/pdf/<str:report_type>/', views.generate_report_pdf, name='generate_report_pdf'),
     
     path('invoices/', views.invoices, name='invoices'),
     path('invoices/create/', views.invoice_create, name='invoice_create'),
+    path('invoices/export/', views.invoice_export, name='invoice_export'),
+    path('invoices/export/<int:job_id>/', views.invoice_export_status, name='invoice_export_status'),
     path('invoices/<int:pk>/', views.invoice_detail, name='invoice_detail'),
     path('invoices/<int:pk>/delete/', views.invoice_delete, name='invoice_delete'),
     path('invoices/<int:invoice_id>/pdf/', views.generate_invoice_pdf, name='generate_invoice_pdf'),
@@ -52,8 +58,14 @@ urlpatterns = [
     # Payment URLs
     path('payments/', views.payments, name='payments'),
     path('payments/create/', views.payment_create, name='payment_create'),
+    path('payments/allocate/', views.payment_allocate, name='payment_allocate'),
     path('payments/transaction/<int:transaction_id>/', views.payment_for_transaction, name='payment_for_transaction'),
     
     # API endpoints
     path('api/transaction/<int:transaction_id>/', views.get_transaction_details, name='get_transaction_details'),
+    path('api/products/prices/', views.product_prices_as_of, name='product_prices_as_of'),
+    path('api/products/bundle/', views.product_bundle, name='product_bundle'),
+    path('api/products/lookup/', views.product_lookup, name='product_lookup'),
+    path('api/products/<int:product_id>/', views.product_detail_api, name='product_detail_api'),
+    path('api/products/sku/<str:sku>/', views.product_sku_api, name='product_sku_api'),
 ] 
\ No newline at end of file
@@ -1,39 +1,143 @@
+import functools
+import io
 import os
+import logging
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.http import HttpResponse
 from django.template.loader import get_template
+from reportlab.pdfbase import pdfmetrics
 from xhtml2pdf import pisa
 from django.contrib.staticfiles import finders
 
+from . import pdf_service
+from .pdf_timing import pdf_stage, set_backend
 
-def link_callback(uri, rel):
+logger = logging.getLogger('inventory.pdf')
+
+
+PDF_TEMPLATES = (
+    'inventory/pdf/invoice_pdf.html',
+    'inventory/pdf/report_pdf.html',
+)
+
+# Arial in the PDF templates maps to the standard Helvetica family
+PDF_FONTS = ('Helvetica', 'Helvetica-Bold', 'Helvetica-Oblique', 'Helvetica-BoldOblique')
+
+
+@functools.lru_cache(maxsize=1024)
+def resolve_static(uri):
     """
-    Convert HTML URIs to absolute system paths so xhtml2pdf can access those resources
+    Absolute path of a static file, or None. Memoized per process, as static
+    files only change on deploy, which restarts the workers.
     """
     result = finders.find(uri)
     if result:
         if not isinstance(result, (list, tuple)):
             result = [result]
-        result = list(result)[0]
-        if result.endswith(('.png', '.jpg', '.jpeg')):
-            path = result
-        else:
-            path = result
-        return path
-    return uri
+        return list(result)[0]
+    return None
 
 
-def render_to_pdf(template_src, context_dict={}):
+def link_callback(uri, rel):
     """
-    Render HTML template to PDF
+    Convert HTML URIs to absolute system paths so xhtml2pdf can access those resources
+    """
+    return resolve_static(uri) or uri
+
+
+def warm_pdf_resources():
+    """
+    Load what every PDF render needs once per worker rather than on its
+    first request: the compiled PDF templates, the font metrics, the static
+    files listed in PDF_PRELOAD_STATIC and xhtml2pdf's own lazily built
+    state, which a throwaway render initialises.
+    """
+    for template_name in PDF_TEMPLATES:
+        get_template(template_name)
+    for font_name in PDF_FONTS:
+        pdfmetrics.getFont(font_name)
+    for uri in getattr(settings, 'PDF_PRELOAD_STATIC', ()):
+        resolve_static(uri)
+    pisa.CreatePDF(
+        '<html><body><table><tr><td><b>&nbsp;</b></td></tr></table></body></html>',
+        dest=io.BytesIO(), link_callback=link_callback)
+
+
+def render_pdf_bytes(template_src, context_dict={}):
+    """
+    Render HTML template to PDF bytes, or None if rendering failed
     """
     template = get_template(template_src)
-    html = template.render(context_dict)
-    response = HttpResponse(content_type='application/pdf')
-    pdf_status = pisa.CreatePDF(
-        html, dest=response, link_callback=link_callback)
+    with pdf_stage('template'):
+        html = template.render(context_dict)
+    return layout_pdf(html)
+
+
+def layout_pdf(html):
+    """
+    Lay out rendered HTML as PDF bytes, or None on error. Uses the PDF render
+    service when PDF_RENDER_SOCKET is set, and lays out in-process only if it
+    cannot be reached. A service that times out or fails mid-layout is not
+    retried here, as a second layout could outlast the worker timeout.
+    """
+    path = pdf_service.socket_path()
+    if path:
+        try:
+            with pdf_stage('layout'):
+                pdf = pdf_service.render_remote(html, path, pdf_service.timeout())
+            set_backend('service')
+            return pdf
+        except pdf_service.ServiceUnavailable as exc:
+            logger.warning('PDF render service at %s unavailable (%s); rendering in-process', path, exc)
+        except OSError as exc:
+            logger.error('PDF render service at %s failed (%s)', path, exc)
+            return None
+    return html_to_pdf_bytes(html)
+
+
+def html_to_pdf_bytes(html):
+    """
+    Lay out rendered HTML as PDF bytes, or None on error. Needs no database
+    or request state, so it can run in a worker process.
+    """
+    buffer = io.BytesIO()
+    with pdf_stage('layout'):
+        pdf_status = pisa.CreatePDF(
+            html, dest=buffer, link_callback=link_callback)
     
     if pdf_status.err:
-        return HttpResponse('We had some errors with code %s' % pdf_status.err)
+        return None
     
-    return response 
\ No newline at end of file
+    return buffer.getvalue()
+
+
+def render_to_pdf(template_src, context_dict={}):
+    """
+    Render HTML template to PDF
+    """
+    pdf = render_pdf_bytes(template_src, context_dict)
+    
+    if pdf is None:
+        return HttpResponse('We had some errors rendering the PDF')
+    
+    return HttpResponse(pdf, content_type='application/pdf')
+
+def stream_json_list(rows, batch_size=500):
+    """
+    Yield a JSON array piece by piece so large result sets can be sent with a
+    StreamingHttpResponse without building the whole list in memory
+    """
+    encoder = DjangoJSONEncoder()
+    yield '['
+    batch = []
+    first = True
+    for row in rows:
+        batch.append(encoder.encode(row))
+        if len(batch) >= batch_size:
+            yield ('' if first else ',') + ','.join(batch)
+            first = False
+            batch = []
+    if batch:
+        yield ('' if first else ',') + ','.join(batch)
+    yield ']'
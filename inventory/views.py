@@ -1,26 +1,50 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.db.models import Sum, F, ExpressionWrapper, DecimalField, Q, Count, IntegerField
+from django.db.models import Sum, F, ExpressionWrapper, DecimalField, Q, Count, IntegerField, BooleanField, OuterRef, Subquery
 from django.db.models.functions import Coalesce
 from django.core.paginator import Paginator
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse, FileResponse
 from django.utils import timezone
 from datetime import datetime, timedelta
 from collections import defaultdict
 import json
+import csv
+from decimal import Decimal
+import io
+import hashlib
+from django.core.cache import cache
 from django.urls import reverse
 from urllib.parse import urlencode
 from django.views.decorators.http import require_POST
+from django.views.decorators.gzip import gzip_page
+from django.utils.cache import patch_cache_control, get_conditional_response
+from django.utils.http import http_date
 import uuid
 from django.core.exceptions import ValidationError
+from django.db import transaction as db_transaction
 
-from .models import Product, Category, Supplier, Client, StockTransaction, Invoice, Warehouse, Payment
+from .models import Product, ProductStock, StockLot, Category, Supplier, Client, StockTransaction, Invoice, InvoiceItem, InvoiceSequence, InvoiceExportJob, Warehouse, Payment, KpiCounter, ProductPriceHistory, per_transaction_invoicing
 from .forms import (
     ProductForm, CategoryForm, SupplierForm, ClientForm, 
-    StockTransactionForm, InvoiceForm, InvoiceItemFormSet, WarehouseForm, PaymentForm
+    StockTransactionForm, InvoiceForm, InvoiceItemFormSet, WarehouseForm, PaymentForm, RepriceForm,
+    InvoiceExportForm, PaymentAllocationForm,
+)
+from .utils import render_to_pdf, render_pdf_bytes, stream_json_list
+from . import pdf_cache
+from .report_tables import render_report_table, use_reportlab
+from .pdf_chunks import REPORT_ROWS, needs_chunking, render_report_chunks
+from .pdf_timing import timed_pdf
+from .invoice_export import DEFAULT_PDF_CUSTOMIZATION, invoice_pdf_context, export_invoices_zip
+from .search import search_products
+from .lookup import product_index
+from .pricing import apply_reprice, preview_reprice
+from .payment_allocation import AllocationError, apply_allocation, plan_allocation
+from .billing import remove_sale_from_invoice
+from .catalog import (
+    CatalogImporter, CATALOG_COLUMNS, BUNDLE_FIELDS, Echo, stream_catalog_csv,
+    catalog_stamp, catalog_bundle, catalog_delta,
 )
-from .utils import render_to_pdf
 from .decorators import (
     view_dashboard_required, view_products_required, 
     add_products_required, change_products_required, delete_products_required,
@@ -31,9 +55,44 @@ from .decorators import (
 )
 
 # Warehouse views
+EXPIRING_SOON_DAYS = 30
+EMPTY_WAREHOUSE_SUMMARY = {
+    'product_count': 0,
+    'total_quantity': Decimal('0'),
+    'stock_value': Decimal('0'),
+    'low_stock_count': 0,
+    'expiring_soon_count': 0,
+}
+
+def warehouse_summaries(today):
+    """
+    Stock figures for every warehouse from one grouped query over the stock
+    levels, cached until a product or stock level changes or the day rolls over
+    """
+    cache_key = f'warehouse_summaries:{today.isoformat()}:{catalog_stamp()}'
+    summaries = cache.get(cache_key)
+    if summaries is None:
+        # Counted in a subquery over the lot expiry index so the lot join does not multiply the sums
+        expiring_soon = StockLot.expiring_between(today, today + timedelta(days=EXPIRING_SOON_DAYS)).filter(
+            warehouse=OuterRef('pk')
+        ).order_by().values('warehouse').annotate(products=Count('product', distinct=True)).values('products')
+        rows = Warehouse.objects.values('id').annotate(
+            product_count=Count('stock_levels'),
+            total_quantity=Sum('stock_levels__quantity', default=Decimal('0')),
+            stock_value=Sum(
+                ExpressionWrapper(F('stock_levels__quantity') * F('stock_levels__product__buying_price'), output_field=DecimalField()),
+                default=Decimal('0'),
+            ),
+            low_stock_count=Count('stock_levels', filter=Q(stock_levels__quantity__lte=F('stock_levels__product__reorder_level'))),
+            expiring_soon_count=Coalesce(Subquery(expiring_soon, output_field=IntegerField()), 0),
+        ).order_by()
+        summaries = {row.pop('id'): row for row in rows}
+        cache.set(cache_key, summaries, timeout=60*60)
+    return summaries
+
 @login_required
 def warehouses(request):
-    """View all warehouses"""
+    """View all warehouses with their stock value, low stock and expiry counts"""
     warehouses_list = Warehouse.objects.all().order_by('name')
     
     # Search functionality
@@ -43,14 +102,48 @@ def warehouses(request):
             Q(name__icontains=search_query) | Q(location__icontains=search_query)
         )
     
+    today = timezone.now().date()
+    summaries = warehouse_summaries(today)
+    
+    # JSON variant for monitoring: every matching warehouse, no pagination
+    if request.GET.get('format') == 'json':
+        data = []
+        for warehouse in warehouses_list:
+            summary = summaries.get(warehouse.id, EMPTY_WAREHOUSE_SUMMARY)
+            data.append({
+                'id': warehouse.id,
+                'name': warehouse.name,
+                'location': warehouse.location,
+                'is_active': warehouse.is_active,
+                'product_count': summary['product_count'],
+                'total_quantity': float(summary['total_quantity']),
+                'stock_value': float(summary['stock_value']),
+                'low_stock_count': summary['low_stock_count'],
+                'expiring_soon_count': summary['expiring_soon_count'],
+            })
+        return JsonResponse({
+            'generated_on': today.isoformat(),
+            'expiring_soon_days': EXPIRING_SOON_DAYS,
+            'warehouses': data,
+        })
+    
     # Pagination
     paginator = Paginator(warehouses_list, 10)  # Show 10 warehouses per page
     page = request.GET.get('page')
     warehouses = paginator.get_page(page)
+    for warehouse in warehouses:
+        warehouse.summary = summaries.get(warehouse.id, EMPTY_WAREHOUSE_SUMMARY)
+    
+    # Totals across all listed warehouses, not just the current page
+    listed = [summaries[pk] for pk in warehouses_list.values_list('id', flat=True) if pk in summaries]
     
     context = {
         'warehouses': warehouses,
         'search_query': search_query,
+        'expiring_soon_days': EXPIRING_SOON_DAYS,
+        'total_stock_value': sum(summary['stock_value'] for summary in listed),
+        'total_low_stock_count': sum(summary['low_stock_count'] for summary in listed),
+        'total_expiring_soon_count': sum(summary['expiring_soon_count'] for summary in listed),
     }
     
     return render(request, 'inventory/warehouses.html', context)
@@ -98,11 +191,14 @@ def warehouse_delete(request, pk):
     warehouse = get_object_or_404(Warehouse, pk=pk)
     
     if request.method == 'POST':
-        # Check if warehouse has products
-        if warehouse.products.exists():
+        # Check if warehouse has products or stock on hand
+        if warehouse.products.exists() or warehouse.stock_levels.exclude(quantity=0).exists():
             messages.error(request, 'Cannot delete warehouse with associated products')
             return redirect('warehouses')
         
+        # Empty stock levels and used up lots are left behind by stock leaving the warehouse
+        warehouse.stock_levels.all().delete()
+        warehouse.lots.all().delete()
         warehouse.delete()
         messages.success(request, 'Warehouse deleted successfully')
         return redirect('warehouses')
@@ -115,14 +211,17 @@ def warehouse_delete(request, pk):
 def warehouse_inventory(request, pk):
     """View inventory in a specific warehouse"""
     warehouse = get_object_or_404(Warehouse, pk=pk)
-    products = Product.objects.filter(warehouse=warehouse).order_by('name')
+    kpis = KpiCounter.for_warehouse(warehouse.pk)
+    # Products stocked here, with their quantity in this warehouse rather than the overall total
+    products = Product.objects.filter(stock_levels__warehouse=warehouse).annotate(
+        warehouse_quantity=F('stock_levels__quantity'),
+        warehouse_low_stock=ExpressionWrapper(Q(stock_levels__quantity__lte=F('reorder_level')), output_field=BooleanField()),
+    ).order_by('name')
     
     # Search functionality
     search_query = request.GET.get('search', '')
     if search_query:
-        products = products.filter(
-            Q(name__icontains=search_query) | Q(sku__icontains=search_query)
-        )
+        products = search_products(products, search_query)
     
     # Pagination
     paginator = Paginator(products, 10)  # Show 10 products per page
@@ -133,8 +232,9 @@ def warehouse_inventory(request, pk):
         'warehouse': warehouse,
         'products': products_page,
         'search_query': search_query,
-        'total_products': products.count(),
-        'low_stock_count': products.filter(quantity__lte=F('reorder_level')).count(),
+        'total_products': products.count() if search_query else warehouse_summaries(timezone.now().date()).get(warehouse.pk, EMPTY_WAREHOUSE_SUMMARY)['product_count'],
+        'low_stock_count': products.filter(warehouse_low_stock=True).count() if search_query else kpis.low_stock_count,
+        'inventory_value': kpis.inventory_value,
     }
     
     return render(request, 'inventory/warehouse_inventory.html', context)
@@ -145,12 +245,11 @@ def dashboard(request):
     
     # Get basic stats
     total_products = Product.objects.count()
-    low_stock_count = Product.objects.filter(quantity__lte=F('reorder_level')).count()
     
-    # Calculate inventory value
-    inventory_value = Product.objects.aggregate(
-        total=Sum(ExpressionWrapper(F('quantity') * F('buying_price'), output_field=DecimalField()))
-    )['total'] or 0
+    # Inventory value, outstanding dues and low stock count are kept up to date by signal handlers
+    kpis = KpiCounter.get_global()
+    low_stock_count = kpis.low_stock_count
+    inventory_value = kpis.inventory_value
     
     # Get wastage - use wastage_amount field directly
     total_wastage = StockTransaction.objects.filter(
@@ -160,20 +259,10 @@ def dashboard(request):
     )['total'] or 0
     
     # Get due payments (money owed to us) - sales with due payment status
-    due_payments = StockTransaction.objects.filter(
-        transaction_type='out', 
-        payment_status__in=['due', 'partial']
-    ).aggregate(
-        total=Sum('amount_due')
-    )['total'] or 0
+    due_payments = kpis.due_receivables
     
     # Get due payables (money we owe) - purchases with due payment status
-    due_payables = StockTransaction.objects.filter(
-        transaction_type='in', 
-        payment_status__in=['due', 'partial']
-    ).aggregate(
-        total=Sum('amount_due')
-    )['total'] or 0
+    due_payables = kpis.due_payables
     
     # Get recent due payments (top 5)
     recent_due_payments = StockTransaction.objects.filter(
@@ -244,12 +333,9 @@ def dashboard(request):
     # Get pending invoices count
     pending_invoices_count = Invoice.objects.filter(status='pending').count()
     
-    # Products expiring in next 30 days
+    # Products expiring in next 30 days, counted live off the open lot expiry index
     thirty_days_later = today + timedelta(days=30)
-    expiring_soon_count = Product.objects.filter(
-        expiry_date__gte=today,
-        expiry_date__lte=thirty_days_later
-    ).count()
+    expiring_soon_count = StockLot.expiring_between(today, thirty_days_later).values('product').distinct().count()
     
     context = {
         'today': today,
@@ -275,6 +361,33 @@ def dashboard(request):
     
     return render(request, 'inventory/dashboard.html', context)
 
+PRODUCTS_JSON_MAX_LIMIT = 10000
+IMPORT_REPORT_ROWS = 200
+
+def product_values(queryset):
+    """Project products to plain dicts with the related names joined in one query"""
+    return queryset.values(
+        'id', 'name', 'sku', 'category_id', 'description', 'buying_price', 'selling_price',
+        'unit_of_measure', 'quantity', 'supplier_id', 'warehouse_id',
+        category_name=F('category__name'),
+        supplier_name=F('supplier__name'),
+        warehouse_name=F('warehouse__name'),
+    )
+
+def product_json(row):
+    """Prices are sent as numbers, matching the products JSON the stock form expects"""
+    row['buying_price'] = float(row['buying_price'])
+    row['selling_price'] = float(row['selling_price'])
+    return row
+
+def products_by_ids(product_ids):
+    """Fetch live product rows for ids from the lookup index, keeping the index order"""
+    rows = {
+        row['id']: product_json(row)
+        for row in product_values(Product.objects.filter(id__in=product_ids))
+    }
+    return [rows[product_id] for product_id in product_ids if product_id in rows]
+
 @view_products_required
 def products(request):
     categories = Category.objects.all()
@@ -292,86 +405,75 @@ def products(request):
         products_list = products_list.filter(category_id=category_id)
     
     if warehouse_id:
-        products_list = products_list.filter(warehouse_id=warehouse_id)
+        products_list = products_list.filter(stock_levels__warehouse_id=warehouse_id)
     
     # Filter for low stock items
     if low_stock == 'true':
-        products_list = products_list.filter(quantity__lte=F('reorder_level'))
+        products_list = products_list.filter(is_low_stock=True)
     
     # Track if search was performed
     search_performed = bool(search_query)
     
     if search_query:
-        # If search_query is numeric and matches an ID exactly, prioritize that match
+        # A numeric query that matches an ID exactly takes priority (used by the stock form)
+        exact_id_match = None
         if search_query.isdigit():
             exact_id_match = Product.objects.filter(id=int(search_query))
-            if exact_id_match.exists():
-                products_list = exact_id_match
-            else:
-                # Otherwise, perform the regular search
-                # First try to find products with matching SKU (regardless of length)
-                sku_matches = Product.objects.filter(
-                    Q(sku__iexact=search_query) | 
-                    Q(sku__exact=search_query) |
-                    Q(sku__icontains=search_query)
-                )
-                
-                # Then try to find products with matching name
-                name_matches = Product.objects.filter(name__icontains=search_query)
-                
-                # If search_query is numeric, also try to find by ID (as partial match)
-                id_matches = Product.objects.none()  # Empty queryset by default
-                if search_query.isdigit():
-                    id_matches = Product.objects.filter(id=int(search_query))
-                
-                # Combine all matches and remove duplicates
-                products_list = (sku_matches | name_matches | id_matches).distinct()
+        if exact_id_match is not None and exact_id_match.exists():
+            products_list = exact_id_match
         else:
-            # First try to find products with matching SKU (regardless of length)
-            sku_matches = Product.objects.filter(
-                Q(sku__iexact=search_query) | 
-                Q(sku__exact=search_query) |
-                Q(sku__icontains=search_query)
-            )
-            
-            # Then try to find products with matching name
-            name_matches = Product.objects.filter(name__icontains=search_query)
-            
-            # Combine all matches and remove duplicates
-            products_list = (sku_matches | name_matches).distinct()
+            # Ranked full-text search over name, SKU, description, category and supplier
+            products_list = search_products(products_list, search_query)
     
     # Return JSON if requested
     if request.GET.get('format') == 'json':
-        products_data = []
-        for product in products_list:
-            products_data.append({
-                'id': product.id,
-                'name': product.name,
-                'sku': product.sku,
-                'category_id': product.category_id,
-                'category_name': product.category.name if product.category else None,
-                'description': product.description,
-                'buying_price': float(product.buying_price),
-                'selling_price': float(product.selling_price),
-                'unit_of_measure': product.unit_of_measure,
-                'quantity': product.quantity,
-                'supplier_id': product.supplier_id,
-                'supplier_name': product.supplier.name if product.supplier else None,
-                'warehouse_id': product.warehouse_id,
-                'warehouse_name': product.warehouse.name if product.warehouse else None,
-            })
-        return JsonResponse(products_data, safe=False)
+        # Optional keyset paging for catalog sync clients: ?limit=N&cursor=<last id>
+        cursor = request.GET.get('cursor', '')
+        limit = request.GET.get('limit', '')
+        limit = min(int(limit), PRODUCTS_JSON_MAX_LIMIT) if limit.isdigit() and int(limit) > 0 else None
+        
+        if cursor.isdigit():
+            products_list = products_list.filter(id__gt=int(cursor)).order_by('id')
+        
+        next_cursor = None
+        if limit:
+            # Only id-ordered listings can be resumed from a cursor
+            if not search_query or cursor.isdigit():
+                next_cursor = products_list.order_by('id').values_list('id', flat=True)[limit - 1:limit].first()
+            products_list = products_list[:limit]
+        
+        rows = (product_json(row) for row in product_values(products_list).iterator(chunk_size=2000))
+        response = StreamingHttpResponse(stream_json_list(rows), content_type='application/json')
+        if next_cursor:
+            response['X-Next-Cursor'] = str(next_cursor)
+        return response
     
     # Pagination
-    paginator = Paginator(products_list, 10)  # Show 10 products per page
+    paginator = Paginator(products_list.select_related('reorder_suggestion'), 10)  # Show 10 products per page
     page = request.GET.get('page')
     products = paginator.get_page(page)
     
     # Calculate totals for all filtered products (not just the current page)
-    total_quantity = products_list.aggregate(total=Sum('quantity'))['total'] or 0
-    total_inventory_value = products_list.aggregate(
-        total=Sum(ExpressionWrapper(F('quantity') * F('buying_price'), output_field=DecimalField()))
-    )['total'] or 0
+    if warehouse_id and warehouse_id.isdigit():
+        # Only the stock held in the selected warehouse counts
+        stock_levels = ProductStock.objects.filter(warehouse_id=warehouse_id, product__in=products_list.values('id'))
+        total_quantity = stock_levels.aggregate(total=Sum('quantity'))['total'] or 0
+    else:
+        total_quantity = products_list.aggregate(total=Sum('quantity'))['total'] or 0
+    if not (category_id or search_query or low_stock == 'true'):
+        # Unfiltered (or warehouse-only) listings can use the KPI counters
+        if warehouse_id and warehouse_id.isdigit():
+            total_inventory_value = KpiCounter.for_warehouse(int(warehouse_id)).inventory_value
+        else:
+            total_inventory_value = KpiCounter.get_global().inventory_value
+    elif warehouse_id and warehouse_id.isdigit():
+        total_inventory_value = stock_levels.aggregate(
+            total=Sum(ExpressionWrapper(F('quantity') * F('product__buying_price'), output_field=DecimalField()))
+        )['total'] or 0
+    else:
+        total_inventory_value = products_list.aggregate(
+            total=Sum(ExpressionWrapper(F('quantity') * F('buying_price'), output_field=DecimalField()))
+        )['total'] or 0
     
     context = {
         'products': products,
@@ -407,6 +509,7 @@ def product_create(request):
     if request.method == 'POST':
         form = ProductForm(request.POST)
         if form.is_valid():
+            form.instance._price_changed_by = request.user
             product = form.save()
             messages.success(request, f'Product "{product.name}" created successfully.')
             
@@ -445,6 +548,7 @@ def product_edit(request, pk):
     if request.method == 'POST':
         form = ProductForm(request.POST, instance=product)
         if form.is_valid():
+            form.instance._price_changed_by = request.user
             product = form.save()
             messages.success(request, f'Product "{product.name}" updated successfully.')
             
@@ -498,6 +602,189 @@ def product_delete(request, pk):
         return redirect(redirect_url)
     return redirect('products')
 
+@change_products_required
+def product_reprice(request):
+    """Preview or apply a repricing rule to a filtered set of products"""
+    preview = None
+    
+    if request.method == 'POST':
+        form = RepriceForm(request.POST)
+        if form.is_valid():
+            products_list = form.filtered_products()
+            mode = form.cleaned_data['mode']
+            value = form.cleaned_data['value']
+            
+            if 'apply' in request.POST:
+                updated = apply_reprice(
+                    products_list, mode, value,
+                    user=request.user, note=form.cleaned_data['note'],
+                )
+                messages.success(request, f'Selling price updated for {updated} product(s).')
+                return redirect('product_reprice')
+            
+            count, rows, total_change = preview_reprice(products_list, mode, value)
+            preview = {
+                'count': count,
+                'rows': rows,
+                'total_change': total_change,
+                'shown': len(rows),
+            }
+    else:
+        form = RepriceForm()
+    
+    return render(request, 'inventory/product_reprice.html', {
+        'form': form,
+        'preview': preview,
+    })
+
+@add_products_required
+def product_import(request):
+    """Upload a catalog CSV to create or update products in bulk, optionally as a dry run"""
+    report = None
+    dry_run = True
+    
+    if request.method == 'POST':
+        upload = request.FILES.get('catalog_file')
+        dry_run = request.POST.get('dry_run') == 'on'
+        
+        if not upload:
+            messages.error(request, 'Please choose a CSV file to import.')
+        else:
+            # Wrap the upload so rows are decoded and parsed as they are read
+            rows = csv.DictReader(io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline=''))
+            try:
+                report = CatalogImporter(dry_run=dry_run, user=request.user).run(rows)
+            except UnicodeDecodeError:
+                messages.error(request, 'The file could not be read. Please upload a UTF-8 encoded CSV.')
+            else:
+                if dry_run:
+                    messages.info(request, report.summary())
+                else:
+                    messages.success(request, report.summary())
+    
+    context = {
+        'report': report,
+        'dry_run': dry_run,
+        'changes': report.changes[:IMPORT_REPORT_ROWS] if report else [],
+        'errors': report.errors[:IMPORT_REPORT_ROWS] if report else [],
+        'report_rows': IMPORT_REPORT_ROWS,
+        'columns': CATALOG_COLUMNS,
+        'warehouse_names': dict(Warehouse.objects.values_list('id', 'name')),
+    }
+    return render(request, 'inventory/product_import.html', context)
+
+@view_products_required
+def product_export(request):
+    """Stream the product catalog as CSV in the import format, honouring the list filters"""
+    products_list = Product.objects.all()
+    
+    category_id = request.GET.get('category')
+    warehouse_id = request.GET.get('warehouse')
+    if category_id:
+        products_list = products_list.filter(category_id=category_id)
+    if warehouse_id:
+        products_list = products_list.filter(stock_levels__warehouse_id=warehouse_id)
+    if request.GET.get('low_stock') == 'true':
+        products_list = products_list.filter(is_low_stock=True)
+    if request.GET.get('search'):
+        products_list = search_products(products_list, request.GET['search'])
+    
+    response = StreamingHttpResponse(stream_catalog_csv(products_list), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="catalog_{timezone.now().strftime("%Y%m%d")}.csv"'
+    return response
+
+def stock_pivot_queryset(products, warehouses):
+    """One grouped query over the stock levels: a row per SKU with a conditional Sum column per warehouse"""
+    warehouse_columns = {
+        f'wh_{warehouse.id}': Sum('stock_levels__quantity', filter=Q(stock_levels__warehouse_id=warehouse.id), default=0)
+        for warehouse in warehouses
+    }
+    return products.values('id', 'sku', 'name').annotate(
+        assigned=Sum('stock_levels__quantity', default=0),
+        **warehouse_columns,
+    ).annotate(
+        # Stock that was never booked to a warehouse only shows up in the product total
+        unassigned=ExpressionWrapper(F('quantity') - F('assigned'), output_field=DecimalField()),
+        total_quantity=F('quantity'),
+        total_value=ExpressionWrapper(F('quantity') * F('buying_price'), output_field=DecimalField()),
+    ).order_by('sku')
+
+@view_reports_required
+def stock_pivot(request):
+    """SKU x warehouse stock report with totals, cached until a product changes"""
+    categories = Category.objects.all()
+    all_warehouses = list(Warehouse.objects.order_by('name'))
+    
+    # Filter parameters
+    search_query = request.GET.get('search', '')
+    category_id = request.GET.get('category')
+    selected_warehouses = [int(pk) for pk in request.GET.getlist('warehouse') if pk.isdigit()]
+    warehouses = [w for w in all_warehouses if w.id in selected_warehouses] if selected_warehouses else all_warehouses
+    
+    products_list = Product.objects.all()
+    if category_id:
+        products_list = products_list.filter(category_id=category_id)
+    if selected_warehouses:
+        # A subquery rather than a join, so the per-warehouse sums still see every stock level
+        products_list = products_list.filter(
+            id__in=ProductStock.objects.filter(warehouse_id__in=selected_warehouses).values('product_id')
+        )
+    if search_query:
+        products_list = products_list.filter(
+            id__in=search_products(Product.objects.all(), search_query).values('id')
+        )
+    
+    pivot = stock_pivot_queryset(products_list, warehouses)
+    
+    if request.GET.get('format') == 'csv':
+        def csv_rows():
+            writer = csv.writer(Echo())
+            yield writer.writerow(['SKU', 'Product'] + [w.name for w in warehouses] + ['Unassigned', 'Total Quantity', 'Total Value'])
+            for row in pivot.iterator(chunk_size=2000):
+                yield writer.writerow(
+                    [row['sku'], row['name']] + [row[f'wh_{w.id}'] for w in warehouses] +
+                    [row['unassigned'], row['total_quantity'], row['total_value']]
+                )
+        response = StreamingHttpResponse(csv_rows(), content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename="stock_pivot_{timezone.now().strftime("%Y%m%d")}.csv"'
+        return response
+    
+    # The cached pivot is reused until the catalog or a stock level changes
+    query_params = request.GET.copy()
+    query_params.pop('page', None)
+    filters_key = hashlib.md5(query_params.urlencode().encode()).hexdigest()
+    cache_key = f'stock_pivot:{filters_key}:{catalog_stamp()}'
+    rows = cache.get(cache_key)
+    if rows is None:
+        rows = list(pivot)
+        cache.set(cache_key, rows, timeout=60*60)
+    
+    column_totals = [sum(row[f'wh_{w.id}'] for row in rows) for w in warehouses]
+    
+    # Pagination
+    paginator = Paginator(rows, 25)
+    page = request.GET.get('page')
+    rows_page = paginator.get_page(page)
+    for row in rows_page:
+        row['quantities'] = [row[f'wh_{w.id}'] for w in warehouses]
+    
+    context = {
+        'rows': rows_page,
+        'warehouses': warehouses,
+        'all_warehouses': all_warehouses,
+        'categories': categories,
+        'search_query': search_query,
+        'category_id': int(category_id) if category_id and category_id.isdigit() else None,
+        'selected_warehouses': selected_warehouses,
+        'column_totals': column_totals,
+        'unassigned_total': sum(row['unassigned'] for row in rows),
+        'grand_total_quantity': sum(row['total_quantity'] for row in rows),
+        'grand_total_value': sum(row['total_value'] for row in rows),
+        'sku_count': len(rows),
+        'query_string': query_params.urlencode(),
+    }
+    return render(request, 'inventory/stock_pivot.html', context)
+
 @view_suppliers_required
 def suppliers(request):
     search_query = request.GET.get('search', '')
@@ -737,15 +1024,12 @@ def stock(request):
     transaction_invoices = {}
     invoice_data = []
     for transaction in transactions_list:
-        if transaction.transaction_type == 'out' and transaction.client:
-            reference_number = f"TRANS-{transaction.id}"
-            invoice = Invoice.objects.filter(notes__contains=reference_number).first()
-            if invoice:
-                transaction_invoices[transaction.id] = invoice.id
-                invoice_data.append({
-                    'transaction_id': transaction.id,
-                    'invoice_id': invoice.id
-                })
+        if transaction.transaction_type == 'out' and transaction.client and transaction.invoice_id:
+            transaction_invoices[transaction.id] = transaction.invoice_id
+            invoice_data.append({
+                'transaction_id': transaction.id,
+                'invoice_id': transaction.invoice_id
+            })
     
     # Pagination
     paginator = Paginator(transactions_list, 10)  # Show 10 transactions per page
@@ -800,7 +1084,9 @@ def stock_create(request):
                 transaction.save()
                 
                 # Check if an invoice was automatically generated
-                if transaction.transaction_type == 'out' and transaction.client:
+                if transaction.transaction_type == 'out' and transaction.client and not per_transaction_invoicing():
+                    messages.success(request, 'Stock transaction created successfully. It will be billed in the next consolidated invoice run.')
+                elif transaction.transaction_type == 'out' and transaction.client:
                     invoice = transaction.generate_invoice()
                     if invoice:
                         messages.success(
@@ -969,6 +1255,12 @@ def reports(request):
         # Calculate stock movements for each product within the date range
         # and opening stock before the start_date
 
+        # Buying prices in effect at the start and end of the period, for valuation
+        period_start = timezone.make_aware(datetime.combine(start_date_obj, datetime.min.time()))
+        period_end = timezone.make_aware(datetime.combine(end_date_obj, datetime.max.time()))
+        products = ProductPriceHistory.annotate_prices_as_of(products, period_start, prefix='opening_')
+        products = ProductPriceHistory.annotate_prices_as_of(products, period_end, prefix='closing_')
+
         report_data = []
         for product in products:
             # Calculate opening stock
@@ -1071,6 +1363,15 @@ def reports(request):
             if closing_stock < 0:
                 closing_stock = 0
 
+            # Value stock at the buying price of the time; products without
+            # history yet fall back to their current price
+            opening_price = product.opening_buying_price_as_of
+            if opening_price is None:
+                opening_price = product.buying_price
+            closing_price = product.closing_buying_price_as_of
+            if closing_price is None:
+                closing_price = product.buying_price
+
             report_data.append({
                 'product_name': product.name,
                 'sku': product.sku,
@@ -1082,6 +1383,8 @@ def reports(request):
                 'wastage_stock': wastage_stock_in_period,
                 'total_stock': total_stock,
                 'closing_stock': closing_stock,
+                'opening_value': Decimal(str(calculated_opening_stock)) * opening_price,
+                'closing_value': Decimal(str(closing_stock)) * closing_price,
             })
 
         # Apply sorting to report_data
@@ -1103,6 +1406,8 @@ def reports(request):
         overall_total_wastage_stock = sum(item['wastage_stock'] for item in report_data)
         overall_total_stock = sum(item['total_stock'] for item in report_data)
         overall_total_closing_stock = sum(item['closing_stock'] for item in report_data)
+        overall_total_opening_value = sum(item['opening_value'] for item in report_data)
+        overall_total_closing_value = sum(item['closing_value'] for item in report_data)
         
         # PAGINATION: Show 25 products per page (customize as needed)
         from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
@@ -1124,6 +1429,8 @@ def reports(request):
             'overall_total_wastage_stock': overall_total_wastage_stock,
             'overall_total_stock': overall_total_stock,
             'overall_total_closing_stock': overall_total_closing_stock,
+            'overall_total_opening_value': overall_total_opening_value,
+            'overall_total_closing_value': overall_total_closing_value,
         })
     
     elif report_type == 'sales':
@@ -1159,8 +1466,14 @@ def reports(request):
             sales = sales.order_by('total_price')
         
         # Calculate total sales
-        total_sales = sales.aggregate(total=Sum('total_price'))['total'] or 0
-        total_quantity_sold = sales.aggregate(total=Sum('quantity'))['total'] or 0
+        # Profit comes from the cost of goods stored on each sale, so this is one aggregate
+        sales_totals = sales.aggregate(
+            total=Sum('total_price'), quantity=Sum('quantity'), cost_of_goods=Sum('cost_of_goods'), profit=Sum('profit_loss')
+        )
+        total_sales = sales_totals['total'] or 0
+        total_quantity_sold = sales_totals['quantity'] or 0
+        total_cost_of_goods = sales_totals['cost_of_goods'] or 0
+        total_profit = sales_totals['profit'] or 0
         
         # Group data if requested
         grouped_data = None
@@ -1274,6 +1587,8 @@ def reports(request):
             'sales': sales,
             'total_sales': total_sales,
             'total_quantity_sold': total_quantity_sold,
+            'total_cost_of_goods': total_cost_of_goods,
+            'total_profit': total_profit,
             'grouped_data': grouped_data,
         })
     
@@ -1951,6 +2266,7 @@ def customize_pdf(request):
     return redirect('dashboard')
 
 @view_reports_required
+@timed_pdf(report_type_kwarg='report_type')
 def generate_report_pdf(request, report_type):
     """
     Generate a PDF report based on the report type
@@ -2048,6 +2364,12 @@ def generate_report_pdf(request, report_type):
         # Calculate stock movements for each product within the date range
         # and opening stock before the start_date
 
+        # Buying prices in effect at the start and end of the period, for valuation
+        period_start = timezone.make_aware(datetime.combine(start_date_obj, datetime.min.time()))
+        period_end = timezone.make_aware(datetime.combine(end_date_obj, datetime.max.time()))
+        products = ProductPriceHistory.annotate_prices_as_of(products, period_start, prefix='opening_')
+        products = ProductPriceHistory.annotate_prices_as_of(products, period_end, prefix='closing_')
+
         report_data = []
         for product in products:
             # Calculate opening stock
@@ -2150,6 +2472,15 @@ def generate_report_pdf(request, report_type):
             if closing_stock < 0:
                 closing_stock = 0
 
+            # Value stock at the buying price of the time; products without
+            # history yet fall back to their current price
+            opening_price = product.opening_buying_price_as_of
+            if opening_price is None:
+                opening_price = product.buying_price
+            closing_price = product.closing_buying_price_as_of
+            if closing_price is None:
+                closing_price = product.buying_price
+
             report_data.append({
                 'product_name': product.name,
                 'sku': product.sku,
@@ -2161,6 +2492,8 @@ def generate_report_pdf(request, report_type):
                 'wastage_stock': wastage_stock_in_period,
                 'total_stock': total_stock,
                 'closing_stock': closing_stock,
+                'opening_value': Decimal(str(calculated_opening_stock)) * opening_price,
+                'closing_value': Decimal(str(closing_stock)) * closing_price,
             })
 
         # Apply sorting to report_data
@@ -2182,6 +2515,8 @@ def generate_report_pdf(request, report_type):
         overall_total_wastage_stock = sum(item['wastage_stock'] for item in report_data)
         overall_total_stock = sum(item['total_stock'] for item in report_data)
         overall_total_closing_stock = sum(item['closing_stock'] for item in report_data)
+        overall_total_opening_value = sum(item['opening_value'] for item in report_data)
+        overall_total_closing_value = sum(item['closing_value'] for item in report_data)
         
         context.update({
             'report_title': 'Inventory Stock Movement Report',
@@ -2192,6 +2527,8 @@ def generate_report_pdf(request, report_type):
             'overall_total_wastage_stock': overall_total_wastage_stock,
             'overall_total_stock': overall_total_stock,
             'overall_total_closing_stock': overall_total_closing_stock,
+            'overall_total_opening_value': overall_total_opening_value,
+            'overall_total_closing_value': overall_total_closing_value,
         })
     
     elif report_type == 'sales':
@@ -2227,8 +2564,14 @@ def generate_report_pdf(request, report_type):
             sales = sales.order_by('total_price')
         
         # Calculate total sales
-        total_sales = sales.aggregate(total=Sum('total_price'))['total'] or 0
-        total_quantity_sold = sales.aggregate(total=Sum('quantity'))['total'] or 0
+        # Profit comes from the cost of goods stored on each sale, so this is one aggregate
+        sales_totals = sales.aggregate(
+            total=Sum('total_price'), quantity=Sum('quantity'), cost_of_goods=Sum('cost_of_goods'), profit=Sum('profit_loss')
+        )
+        total_sales = sales_totals['total'] or 0
+        total_quantity_sold = sales_totals['quantity'] or 0
+        total_cost_of_goods = sales_totals['cost_of_goods'] or 0
+        total_profit = sales_totals['profit'] or 0
         
         # Group data if requested
         grouped_data = None
@@ -2341,6 +2684,8 @@ def generate_report_pdf(request, report_type):
             'sales': sales,
             'total_sales': total_sales,
             'total_quantity_sold': total_quantity_sold,
+            'total_cost_of_goods': total_cost_of_goods,
+            'total_profit': total_profit,
             'grouped_data': grouped_data,
         })
     
@@ -2851,8 +3196,14 @@ def generate_report_pdf(request, report_type):
                 'end_date': end_date,
             })
     
-    # Generate the PDF using the context
-    pdf = render_to_pdf('inventory/pdf/report_pdf.html', context)
+    # Generate the PDF using the context. Tabular reports can skip HTML and
+    # stream their rows straight into ReportLab tables
+    if not context.get('grouped_data') and use_reportlab(report_type, request.GET.get('backend')):
+        pdf = render_report_table(report_type, context)
+    elif needs_chunking(report_type, context):
+        pdf = render_report_chunks('inventory/pdf/report_pdf.html', context, REPORT_ROWS[report_type])
+    else:
+        pdf = render_to_pdf('inventory/pdf/report_pdf.html', context)
     
     if pdf:
         response = HttpResponse(pdf, content_type='application/pdf')
@@ -2864,39 +3215,97 @@ def generate_report_pdf(request, report_type):
     return redirect('reports')
 
 @view_invoices_required
+@timed_pdf(report_type='invoice')
 def generate_invoice_pdf(request, invoice_id):
     """
     Generate a PDF for a specific invoice
     """
-    invoice = get_object_or_404(Invoice, pk=invoice_id)
+    invoice = get_object_or_404(pdf_cache.with_pdf_items(Invoice.objects.all()), pk=invoice_id)
     
     # Get customization from session or use defaults
-    customization = request.session.get('pdf_customization', {
-        'company_name': 'QBITX IMS',
-        'company_tagline': 'Transform Suppliers',
-        'company_details': '123 Business Street, Business City, Country',
-        'terms_conditions': '',
-    })
-    
-    context = {
-        'invoice': invoice,
-        'company_name': customization.get('company_name'),
-        'company_tagline': customization.get('company_tagline'),
-        'company_details': customization.get('company_details'),
-        'terms_conditions': customization.get('terms_conditions'),
-    }
-    
-    # Render PDF
-    pdf = render_to_pdf('inventory/pdf/invoice_pdf.html', context)
-    
-    if pdf:
-        response = HttpResponse(pdf, content_type='application/pdf')
+    customization = request.session.get('pdf_customization', DEFAULT_PDF_CUSTOMIZATION)
+    
+    # Rendered PDFs are cached on disk under a hash of everything they are
+    # rendered from, which doubles as the ETag
+    key = pdf_cache.invoice_pdf_key(invoice, customization)
+    etag = f'"{key}"'
+    last_modified = max(
+        invoice.updated_at.timestamp(),
+        invoice.client.updated_at.timestamp(),
+        pdf_cache.template_mtime(pdf_cache.INVOICE_PDF_TEMPLATE) or 0,
+    )
+    
+    response = get_conditional_response(request, etag=etag, last_modified=int(last_modified))
+    if response is None:
+        path = pdf_cache.read(key)
+        pdf_file = None
+        if path:
+            try:
+                pdf_file = open(path, 'rb')
+            except FileNotFoundError:
+                # Evicted between the lookup and the open
+                pdf_file = None
+        if pdf_file is None:
+            pdf = render_pdf_bytes(pdf_cache.INVOICE_PDF_TEMPLATE, invoice_pdf_context(invoice, customization))
+            if not pdf:
+                return redirect('invoice_detail', pk=invoice_id)
+            pdf_cache.write(key, pdf)
+            response = HttpResponse(pdf, content_type='application/pdf')
+        else:
+            response = FileResponse(pdf_file, content_type='application/pdf')
         filename = f"Invoice_{invoice.invoice_number}.pdf"
         content = f"inline; filename={filename}"
         response['Content-Disposition'] = content
-        return response
     
-    return redirect('invoice_detail', pk=invoice_id)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    # Let the browser keep its copy but revalidate it against the ETag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+@view_invoices_required
+def invoice_export(request):
+    """Download the PDFs of a filtered set of invoices as one ZIP"""
+    if request.method == 'POST':
+        form = InvoiceExportForm(request.POST)
+        if form.is_valid():
+            invoices_list = form.filtered_invoices()
+            if not invoices_list.exists():
+                messages.warning(request, 'No invoices match these filters.')
+                return redirect('invoice_export')
+            
+            job = InvoiceExportJob.objects.create(filters=form.filters(), created_by=request.user)
+            customization = request.session.get('pdf_customization', DEFAULT_PDF_CUSTOMIZATION)
+            response = StreamingHttpResponse(
+                export_invoices_zip(job, invoices_list, customization),
+                content_type='application/zip',
+            )
+            filename = f"invoices_{timezone.localdate().strftime('%Y%m%d')}_{job.pk}.zip"
+            response['Content-Disposition'] = f'attachment; filename={filename}'
+            response['X-Export-Job'] = str(job.pk)
+            return response
+    else:
+        form = InvoiceExportForm()
+    
+    return render(request, 'inventory/invoice_export.html', {
+        'form': form,
+        'jobs': InvoiceExportJob.objects.select_related('created_by')[:10],
+    })
+
+@view_invoices_required
+def invoice_export_status(request, job_id):
+    """Progress of a bulk invoice export, for polling while the ZIP downloads"""
+    job = get_object_or_404(InvoiceExportJob, pk=job_id)
+    return JsonResponse({
+        'id': job.pk,
+        'status': job.status,
+        'total_invoices': job.total_invoices,
+        'completed_invoices': job.completed_invoices,
+        'failed_invoices': job.failed_invoices,
+        'progress': job.progress,
+        'error': job.error,
+        'finished_at': job.finished_at,
+    })
 
 @view_invoices_required
 def invoices(request):
@@ -2934,38 +3343,42 @@ def invoice_create(request):
         form = InvoiceForm(request.POST)
         
         if form.is_valid():
-            invoice = form.save(commit=False)
-            invoice.created_by = request.user
-            # Initialize calculated fields with default values
-            invoice.subtotal = 0
-            invoice.tax_amount = 0
-            invoice.total = 0
-            invoice.save()
-            
-            formset = InvoiceItemFormSet(request.POST, instance=invoice)
-            if formset.is_valid():
-                formset.save()
-                
-                # Calculate totals
-                subtotal = 0
-                for item in invoice.items.all():
-                    subtotal += item.total_price
-                
-                tax_amount = subtotal * (invoice.tax_rate / 100)
-                total = subtotal + tax_amount - invoice.discount
-                
-                invoice.subtotal = subtotal
-                invoice.tax_amount = tax_amount
-                invoice.total = total
+            # The invoice and its number are rolled back together if the items are invalid
+            with db_transaction.atomic():
+                invoice = form.save(commit=False)
+                invoice.created_by = request.user
+                if not invoice.invoice_number:
+                    invoice.invoice_number = InvoiceSequence.next_number(issue_date=invoice.issue_date)
+                # Initialize calculated fields with default values
+                invoice.subtotal = 0
+                invoice.tax_amount = 0
+                invoice.total = 0
                 invoice.save()
                 
+                formset = InvoiceItemFormSet(request.POST, instance=invoice)
+                items_valid = formset.is_valid()
+                if items_valid:
+                    formset.save()
+                    
+                    # Calculate totals
+                    subtotal = 0
+                    for item in invoice.items.all():
+                        subtotal += item.total_price
+                    
+                    tax_amount = subtotal * (invoice.tax_rate / 100)
+                    total = subtotal + tax_amount - invoice.discount
+                    
+                    invoice.subtotal = subtotal
+                    invoice.tax_amount = tax_amount
+                    invoice.total = total
+                    invoice.save()
+                else:
+                    db_transaction.set_rollback(True)
+            
+            if items_valid:
                 messages.success(request, f'Invoice #{invoice.invoice_number} created successfully.')
                 return redirect('invoices')
             else:
-                # If formset is invalid, we need to keep the invoice for the template
-                # but roll back the transaction in the database
-                invoice_id = invoice.id
-                invoice.delete()
                 messages.error(request, 'Please correct the errors in the invoice items.')
                 formset = InvoiceItemFormSet()  # Reset formset
         else:
@@ -2973,17 +3386,7 @@ def invoice_create(request):
             formset = InvoiceItemFormSet()
             messages.error(request, 'Please correct the errors in the invoice form.')
     else:
-        # Generate next invoice number
-        last_invoice = Invoice.objects.order_by('-id').first()
-        next_number = 1
-        if last_invoice:
-            try:
-                next_number = int(last_invoice.invoice_number) + 1
-            except ValueError:
-                next_number = 1
-        
         form = InvoiceForm(initial={
-            'invoice_number': f'{next_number:06d}',
             'issue_date': timezone.now().date(),
             'due_date': timezone.now().date() + timedelta(days=30),
             'tax_rate': 0,
@@ -3077,13 +3480,13 @@ def product_duplicate(request, pk):
                 return redirect(redirect_url)
             return redirect('products')
         
-        # Check if SKU already exists in the same warehouse
+        # Check if SKU already exists
         warehouse = None
         if warehouse_id:
             warehouse = get_object_or_404(Warehouse, pk=warehouse_id)
         
-        if Product.objects.filter(sku=sku, warehouse=warehouse).exists():
-            messages.error(request, f'SKU {sku} already exists in the selected warehouse')
+        if Product.objects.filter(sku=sku).exists():
+            messages.error(request, f'SKU {sku} already exists')
             if products_redirect_params:
                 redirect_url = reverse('products') + '?' + urlencode(products_redirect_params)
                 return redirect(redirect_url)
@@ -3289,6 +3692,54 @@ def payment_for_transaction(request, transaction_id):
     
     return render(request, 'inventory/payment_form.html', context)
 
+@login_required
+def payment_allocate(request):
+    """Preview or apply one receipt across a client's or supplier's open transactions"""
+    preview = None
+    
+    if request.method == 'POST':
+        form = PaymentAllocationForm(request.POST)
+        if form.is_valid():
+            transactions = form.open_transactions()
+            amount = form.cleaned_data['amount']
+            
+            try:
+                if 'apply' in request.POST:
+                    payments = apply_allocation(
+                        transactions, amount, form.split(transactions),
+                        payment_date=form.cleaned_data['payment_date'],
+                        payment_method=form.cleaned_data['payment_method'],
+                        reference=form.cleaned_data['reference'],
+                        notes=form.cleaned_data['notes'],
+                        user=request.user,
+                    )
+                    messages.success(request, f'Payment of {amount} allocated across {len(payments)} transaction(s).')
+                    return redirect('payments')
+                
+                open_list = list(transactions.select_related('product'))
+                plan = {
+                    stock_transaction.id: applied
+                    for stock_transaction, applied in plan_allocation(open_list, amount, form.split(open_list))
+                }
+            except AllocationError as exc:
+                messages.error(request, str(exc))
+                open_list = list(transactions.select_related('product'))
+                plan = {}
+            
+            preview = {
+                'rows': [(stock_transaction, plan.get(stock_transaction.id)) for stock_transaction in open_list],
+                'open_balance': sum(stock_transaction.amount_due for stock_transaction in open_list),
+                'allocated': sum(plan.values()),
+                'count': len(plan),
+            }
+    else:
+        form = PaymentAllocationForm()
+    
+    return render(request, 'inventory/payment_allocate.html', {
+        'form': form,
+        'preview': preview,
+    })
+
 @login_required
 def generate_invoice_from_transaction(request, transaction_id):
     """Generate an invoice from a stock transaction"""
@@ -3303,7 +3754,7 @@ def generate_invoice_from_transaction(request, transaction_id):
         try:
             # Check if an invoice already exists for this transaction
             reference_number = f"TRANS-{transaction.id}"
-            existing_invoice = Invoice.objects.filter(notes__contains=reference_number).first()
+            existing_invoice = transaction.invoice
             
             if existing_invoice:
                 messages.info(request, f'An invoice (#{existing_invoice.invoice_number}) already exists for this transaction.')
@@ -3314,39 +3765,33 @@ def generate_invoice_from_transaction(request, transaction_id):
                 else:
                     return redirect('invoice_detail', pk=existing_invoice.id)
             
-            # Generate next invoice number
-            last_invoice = Invoice.objects.order_by('-id').first()
-            next_number = 1
-            if last_invoice:
-                try:
-                    next_number = int(last_invoice.invoice_number) + 1
-                except ValueError:
-                    next_number = 1
-            
-            # Create the invoice
-            invoice = Invoice.objects.create(
-                invoice_number=f'{next_number:06d}',
-                client=transaction.client,
-                issue_date=timezone.now().date(),
-                due_date=timezone.now().date() + timedelta(days=30),
-                status='pending' if transaction.payment_status in ['due', 'partial', 'credit'] else 'paid',
-                subtotal=transaction.total_price,
-                tax_rate=transaction.vat_rate + transaction.ait_rate if transaction.apply_taxes else 0,
-                tax_amount=transaction.total_price - (transaction.quantity * transaction.final_price) if transaction.apply_taxes and transaction.final_price else 0,
-                discount=0,
-                total=transaction.total_price,
-                notes=f"{reference_number} - Generated from transaction #{transaction.id} on {timezone.now().strftime('%Y-%m-%d')}",
-                created_by=request.user
-            )
-            
-            # Create invoice item
-            InvoiceItem.objects.create(
-                invoice=invoice,
-                product=transaction.product,
-                quantity=transaction.quantity,
-                unit_price=transaction.unit_price,
-                total_price=transaction.total_price
-            )
+            # The number is only taken if the invoice is created
+            with db_transaction.atomic():
+                invoice = Invoice.objects.create(
+                    invoice_number=InvoiceSequence.next_number(),
+                    client=transaction.client,
+                    issue_date=timezone.now().date(),
+                    due_date=timezone.now().date() + timedelta(days=30),
+                    status='pending' if transaction.payment_status in ['due', 'partial', 'credit'] else 'paid',
+                    subtotal=transaction.total_price,
+                    tax_rate=transaction.vat_rate + transaction.ait_rate if transaction.apply_taxes else 0,
+                    tax_amount=transaction.total_price - (transaction.quantity * transaction.final_price) if transaction.apply_taxes and transaction.final_price else 0,
+                    discount=0,
+                    total=transaction.total_price,
+                    notes=f"{reference_number} - Generated from transaction #{transaction.id} on {timezone.now().strftime('%Y-%m-%d')}",
+                    created_by=request.user
+                )
+                
+                # Create invoice item
+                InvoiceItem.objects.create(
+                    invoice=invoice,
+                    product=transaction.product,
+                    quantity=transaction.quantity,
+                    unit_price=transaction.unit_price,
+                    total_price=transaction.total_price
+                )
+                
+                StockTransaction.objects.filter(pk=transaction.pk).update(invoice=invoice, invoiced_at=timezone.now())
             
             messages.success(request, f'Invoice #{invoice.invoice_number} created successfully.')
             
@@ -3363,6 +3808,134 @@ def generate_invoice_from_transaction(request, transaction_id):
     # If not POST, redirect back to stock page
     return redirect('stock')
 
+@view_products_required
+def product_lookup(request):
+    """Typeahead API: products whose SKU or name starts with ?q=, served from the in-memory index"""
+    query = request.GET.get('q', '')
+    warehouse_id = request.GET.get('warehouse')
+    limit = request.GET.get('limit', '')
+    limit = min(int(limit), 50) if limit.isdigit() and int(limit) > 0 else 10
+    
+    product_ids = product_index.prefix(
+        query,
+        limit=limit,
+        warehouse_id=int(warehouse_id) if warehouse_id and warehouse_id.isdigit() else None,
+    )
+    return JsonResponse(products_by_ids(product_ids), safe=False)
+
+@view_products_required
+def product_detail_api(request, product_id):
+    """API endpoint to get a single product by ID"""
+    rows = products_by_ids([product_id])
+    if not rows:
+        return JsonResponse({'error': 'Product not found'}, status=404)
+    return JsonResponse(rows[0])
+
+@view_products_required
+def product_sku_api(request, sku):
+    """API endpoint to get products by exact SKU (case-insensitive), optionally only if stocked in ?warehouse="""
+    warehouse_id = request.GET.get('warehouse')
+    warehouse_id = int(warehouse_id) if warehouse_id and warehouse_id.isdigit() else None
+    product_ids = product_index.by_sku(sku, warehouse_id=warehouse_id)
+    if not product_ids:
+        # The index may not have caught up with a product created in another worker yet
+        products = Product.objects.filter(sku__iexact=sku)
+        if warehouse_id:
+            products = products.filter(stock_levels__warehouse_id=warehouse_id)
+        product_ids = list(products.values_list('id', flat=True))
+    return JsonResponse(products_by_ids(product_ids), safe=False)
+
+def parse_as_of(value):
+    """Parse an ISO date or datetime; a bare date means the end of that day"""
+    try:
+        when = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if len(value) <= 10:
+        when = datetime.combine(when.date(), datetime.max.time())
+    if timezone.is_naive(when):
+        when = timezone.make_aware(when)
+    return when
+
+@view_products_required
+def product_prices_as_of(request):
+    """API endpoint: buying and selling prices in effect at ?as_of= for a product set"""
+    when = parse_as_of(request.GET.get('as_of'))
+    if when is None:
+        return JsonResponse({'error': 'as_of must be an ISO date or datetime'}, status=400)
+    
+    products_list = Product.objects.all()
+    ids = [int(pk) for pk in request.GET.get('ids', '').split(',') if pk.strip().isdigit()]
+    if ids:
+        products_list = products_list.filter(id__in=ids)
+    if request.GET.get('warehouse', '').isdigit():
+        products_list = products_list.filter(stock_levels__warehouse_id=request.GET['warehouse'])
+    if request.GET.get('category', '').isdigit():
+        products_list = products_list.filter(category_id=request.GET['category'])
+    
+    rows = ProductPriceHistory.annotate_prices_as_of(products_list, when).filter(
+        buying_price_as_of__isnull=False
+    ).order_by('id').values('id', 'sku', 'name', 'buying_price_as_of', 'selling_price_as_of')
+    
+    return JsonResponse({
+        'as_of': when.isoformat(),
+        'prices': [
+            {
+                'id': row['id'],
+                'sku': row['sku'],
+                'name': row['name'],
+                'buying_price': float(row['buying_price_as_of']),
+                'selling_price': float(row['selling_price_as_of']),
+            }
+            for row in rows
+        ],
+    })
+
+@gzip_page
+@view_products_required
+def product_bundle(request):
+    """
+    Compact catalog bundle for client-side product pickers.
+    
+    - no parameters: the current bundle, revalidated with an ETag
+    - ?version=<v>: the same bundle with far-future cache headers (redirects if v is stale)
+    - ?since_version=<v>: only the rows changed since v, or the full bundle if v is unknown
+    """
+    version, rows = catalog_bundle()
+    since_version = request.GET.get('since_version')
+    requested_version = request.GET.get('version')
+    
+    if since_version:
+        delta = ([], []) if since_version == version else catalog_delta(since_version, rows)
+        if delta is not None:
+            upserts, deleted = delta
+            response = JsonResponse(
+                {'version': version, 'since_version': since_version, 'full': False, 'upserts': upserts, 'deleted': deleted},
+                json_dumps_params={'separators': (',', ':')},
+            )
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+    
+    if requested_version and requested_version != version:
+        return redirect(f"{reverse('product_bundle')}?version={version}")
+    
+    etag = f'"{version}"'
+    # gzip_page turns the ETag into a weak one, so ignore the W/ prefix when comparing
+    if etag in request.headers.get('If-None-Match', '').replace('W/', ''):
+        response = HttpResponse(status=304)
+    else:
+        response = JsonResponse(
+            {'version': version, 'full': True, 'fields': BUNDLE_FIELDS, 'rows': rows},
+            json_dumps_params={'separators': (',', ':')},
+        )
+    response['ETag'] = etag
+    if requested_version:
+        # A versioned URL never changes content, so browsers can keep it indefinitely
+        patch_cache_control(response, private=True, max_age=60*60*24*365, immutable=True)
+    else:
+        patch_cache_control(response, private=True, no_cache=True)
+    return response
+
 @login_required
 def get_transaction_details(request, transaction_id):
     """API endpoint to get transaction details by ID"""
@@ -3543,28 +4116,38 @@ def stock_transaction_delete(request, pk):
         transaction_id = transaction.transaction_id
         product_name = transaction.product.name
         
-        # Check if this transaction has an associated invoice
-        reference_number = f"TRANS-{transaction.id}"
-        invoice = Invoice.objects.filter(notes__contains=reference_number).first()
-        
-        # If there's an associated invoice, delete it first
-        if invoice:
-            invoice.delete()
-        
-        # Revert the product quantity changes
-        product = transaction.product
-        if transaction.transaction_type == 'in' or transaction.transaction_type == 'return':
-            # If it was stock in, reduce the quantity
-            product.quantity -= transaction.quantity
-        elif transaction.transaction_type == 'out' or transaction.transaction_type == 'wastage':
-            # If it was stock out or wastage, add the quantity back
-            product.quantity += transaction.quantity
-        
-        # Save the product with updated quantity
-        product.save()
-        
-        # Delete the transaction
-        transaction.delete()
+        # Revert the stock, the invoice and the transaction together, or not at all
+        try:
+            with db_transaction.atomic():
+                # Revert the product quantity changes; the lots are restored from the transaction
+                product = transaction.product
+                product._stock_source = transaction
+                if transaction.transaction_type == 'in' or transaction.transaction_type == 'return':
+                    # If it was stock in, reduce the quantity
+                    product.quantity -= transaction.quantity
+                    product._stock_warehouse_id = transaction.destination_warehouse_id
+                elif transaction.transaction_type == 'out' or transaction.transaction_type == 'wastage':
+                    # If it was stock out or wastage, add the quantity back
+                    product.quantity += transaction.quantity
+                    product._stock_warehouse_id = transaction.source_warehouse_id
+                elif transaction.transaction_type == 'transfer':
+                    # Move the stock back to the source warehouse
+                    ProductStock.transfer(product, transaction.destination_warehouse_id, transaction.source_warehouse_id, transaction.quantity)
+                    StockLot.revert_transfer(transaction)
+                
+                # Save the product with updated quantity
+                product.save()
+                
+                # Take the sale off its invoice: a consolidated invoice loses the
+                # sale's line, an invoice for this sale alone is deleted
+                if transaction.invoice_id:
+                    remove_sale_from_invoice(transaction)
+                
+                # Delete the transaction
+                transaction.delete()
+        except ValidationError as e:
+            messages.error(request, f'Cannot delete transaction {transaction_id}: {" ".join(e.messages)}')
+            return redirect('stock')
         
         messages.success(request, f'Transaction {transaction_id} for {product_name} deleted successfully.')
         
@@ -140,3 +140,90 @@ LOGOUT_REDIRECT_URL = '/imstransform/login/'
 CSRF_COOKIE_SECURE = False
 SESSION_COOKIE_SECURE = False
 CSRF_TRUSTED_ORIGINS = ['http://69.62.75.219']
+
+# Cost of stock out/wastage: 'fifo' (oldest cost layer first) or 'average'
+# (weighted average of the open cost layers)
+INVENTORY_COSTING_METHOD = 'fifo'
+
+# Invoice numbering series. 'prefix' may contain {year}; 'yearly' series
+# restart at 1 each year, e.g. {'prefix': 'INV-{year}-', 'padding': 5,
+# 'yearly': True}. All invoices are numbered from the 'default' series.
+INVOICE_NUMBER_SERIES = {
+    'default': {'prefix': '', 'padding': 6, 'yearly': False},
+}
+
+# 'per_transaction' invoices every sale to a client as it is saved;
+# 'consolidated' leaves sales uninvoiced for the build_invoices command, which
+# bills each client once per INVOICE_BILLING_PERIOD ('week' or 'month')
+INVOICE_BILLING_MODE = 'per_transaction'
+INVOICE_BILLING_PERIOD = 'month'
+
+# The default cache is per process. Catalog bundle versions live in a file
+# cache shared by the gunicorn workers, so any worker can answer a
+# ?since_version= delta request
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'catalog': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'catalog',
+        'OPTIONS': {'MAX_ENTRIES': 200},
+    },
+}
+
+# Rendered invoice PDFs are cached on disk; least recently used files are
+# evicted once the cache grows past this size
+INVOICE_PDF_CACHE_DIR = MEDIA_ROOT / 'pdf_cache' / 'invoices'
+INVOICE_PDF_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# PDF backend per report type: 'html' renders report_pdf.html with xhtml2pdf,
+# 'reportlab' streams the rows into ReportLab tables (sales, purchase and
+# wastage only). ?backend=html|reportlab on the request overrides this.
+REPORT_PDF_BACKENDS = {
+    'sales': 'reportlab',
+    'purchase': 'reportlab',
+    'wastage': 'reportlab',
+}
+
+# HTML report PDFs with more rows than this are rendered in chunks of this
+# many rows and merged; REPORT_PDF_WORKERS > 1 lays chunks out in parallel
+# processes. REPORT_PDF_MAX_ROWS (None for no cap) truncates larger reports.
+REPORT_PDF_CHUNK_ROWS = 500
+REPORT_PDF_WORKERS = 2
+REPORT_PDF_MAX_ROWS = 20000
+
+# Worker processes for bulk invoice PDF exports (None: the available cores)
+INVOICE_EXPORT_WORKERS = None
+
+# Unix socket of the pdf_render_server daemon (e.g.
+# '/run/imstransform/pdf-render.sock'). When set, invoice and report PDFs
+# are laid out by the daemon, falling back to the web worker only if it is
+# down. A layout that takes longer than PDF_RENDER_TIMEOUT seconds fails
+# rather than being redone in the worker; keep it well under the gunicorn
+# timeout. None renders in-process.
+PDF_RENDER_SOCKET = None
+PDF_RENDER_TIMEOUT = 30
+
+# PDF stage timings are kept in the database for the admin summary for
+# this many days (None keeps them all)
+PDF_TIMING_RETENTION_DAYS = 30
+
+# PDF stage timings are logged as 'pdf_render {json}' lines on the
+# inventory.pdf logger
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'inventory.pdf': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
@@ -0,0 +1,71 @@
+// Client-side copy of the product catalog bundle (/api/products/bundle/).
+// The bundle is kept in localStorage and refreshed with small deltas, so
+// product pickers can filter locally without a request per keystroke.
+const CatalogBundle = (function() {
+    const STORAGE_KEY = 'ims_catalog_bundle';
+    const BUNDLE_URL = '/imstransform/api/products/bundle/';
+    let loading = null;
+    
+    function readStored() {
+        try {
+            return JSON.parse(localStorage.getItem(STORAGE_KEY));
+        } catch (e) {
+            return null;
+        }
+    }
+    
+    function store(bundle) {
+        try {
+            localStorage.setItem(STORAGE_KEY, JSON.stringify(bundle));
+        } catch (e) {
+            // Storage full or disabled; the bundle is still used for this page
+        }
+    }
+    
+    function applyDelta(stored, delta) {
+        const rowsById = new Map(stored.rows.map(row => [row[0], row]));
+        delta.upserts.forEach(row => rowsById.set(row[0], row));
+        delta.deleted.forEach(id => rowsById.delete(id));
+        return { version: delta.version, fields: stored.fields, rows: Array.from(rowsById.values()) };
+    }
+    
+    function toProducts(bundle) {
+        return bundle.rows.map(row => {
+            const product = {};
+            bundle.fields.forEach((field, index) => { product[field] = row[index]; });
+            return product;
+        });
+    }
+    
+    // Resolve with an array of product objects (fetched at most once per page)
+    function load() {
+        if (loading) {
+            return loading;
+        }
+        
+        const stored = readStored();
+        const url = stored && stored.version
+            ? `${BUNDLE_URL}?since_version=${encodeURIComponent(stored.version)}`
+            : BUNDLE_URL;
+        
+        loading = fetch(url, { credentials: 'same-origin' })
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`Catalog bundle request failed: ${response.status}`);
+                }
+                return response.json();
+            })
+            .then(data => {
+                const bundle = data.full ? { version: data.version, fields: data.fields, rows: data.rows } : applyDelta(stored, data);
+                store(bundle);
+                return toProducts(bundle);
+            })
+            .catch(error => {
+                loading = null;
+                throw error;
+            });
+        return loading;
+    }
+    
+    return { load: load };
+})();
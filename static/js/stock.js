@@ -118,6 +118,8 @@ function updateFormFields() {
     const sourceWarehouseField = document.getElementById('id_source_warehouse').closest('.mb-3');
     const destinationWarehouseField = document.getElementById('id_destination_warehouse').closest('.mb-3');
     const wastageField = document.getElementById('id_wastage_amount').closest('.mb-3');
+    const lotNumberField = document.getElementById('id_lot_number').closest('.mb-3');
+    const lotExpiryField = document.getElementById('id_expiry_date').closest('.mb-3');
     const paymentOptionsSection = document.getElementById('paymentOptionsSection');
     
     // Hide all conditional fields first
@@ -126,12 +128,16 @@ function updateFormFields() {
     sourceWarehouseField.style.display = 'none';
     destinationWarehouseField.style.display = 'none';
     wastageField.style.display = 'none';
+    lotNumberField.style.display = 'none';
+    lotExpiryField.style.display = 'none';
     
     // Show relevant fields based on transaction type
     switch (transactionType) {
         case 'in':
             supplierField.style.display = 'block';
             destinationWarehouseField.style.display = 'block';
+            lotNumberField.style.display = 'block';
+            lotExpiryField.style.display = 'block';
             paymentOptionsSection.style.display = 'block'; // Show payment options for stock in
             break;
         case 'out':
@@ -153,6 +159,8 @@ function updateFormFields() {
             supplierField.style.display = 'block';
             clientField.style.display = 'block';
             destinationWarehouseField.style.display = 'block';
+            lotNumberField.style.display = 'block';
+            lotExpiryField.style.display = 'block';
             paymentOptionsSection.style.display = 'block'; // Show payment options for returns
             break;
         case 'transfer':
@@ -238,14 +246,11 @@ function updateProductPrices() {
     const productId = document.getElementById('id_product').value;
     if (!productId) return;
     
-    // Fetch product data using AJAX with exact ID match
-    fetch(`/imstransform/products/?format=json&search=${productId}`)
+    // Fetch product data by exact ID
+    fetch(`/imstransform/api/products/${productId}/`)
         .then(response => response.json())
-        .then(data => {
-            if (data && data.length > 0) {
-                // Find the exact product by ID
-                const product = data.find(p => p.id === parseInt(productId)) || data[0];
-                
+        .then(product => {
+            if (product && product.id) {
                 // Update buying and selling price fields
                 document.getElementById('id_buying_price').value = product.buying_price;
                 document.getElementById('id_selling_price').value = product.selling_price;
@@ -284,12 +289,10 @@ function showProductInfo(productData) {
     }
     
     // Otherwise fetch the product data
-    fetch(`/imstransform/products/?format=json&search=${productId}`)
+    fetch(`/imstransform/api/products/${productId}/`)
         .then(response => response.json())
-        .then(data => {
-            if (data && data.length > 0) {
-                // Find the exact product by ID
-                const product = data.find(p => p.id === parseInt(productId)) || data[0];
+        .then(product => {
+            if (product && product.id) {
                 updateProductInfoCard(product);
             }
         })